@@ -4,8 +4,16 @@
 
 import pysam
 import os
+import re
+import shutil
+import subprocess
+import threading
 import global_values
 from cmd_runner import *
+from x_kmer_prefilter import iter_fastq_batches
+from x_realign_cache import *
+
+CIGAR_OPS = "MIDNSHP=X"  # in order of the pysam cigar operation codes
 
 class BWAlign():
     def __init__(self, BWA_PATH, BWA_REALIGN_CUTOFF, n_jobs):
@@ -15,49 +23,129 @@ class BWAlign():
         self.BWA_SEED_FREQ=10 #by default, this value is 500 in bwa mem
         self.BWA_SEED_MEDIUM_FREQ = 70 #by default, this value is 500 in bwa mem
         self.cmd_runner=CMD_RUNNER()
+        self.sf_cache_folder = None  # folder of the realignment cache, not used if None
+
+    ####reuse the realignments of the same sequences saved in this folder (see XRealignCache)
+    def set_realign_cache_folder(self, sf_cache_folder):
+        if global_values.REALIGN_CACHE == True:
+            self.sf_cache_folder = sf_cache_folder
 
     # re-align the collected clipped and discordant reads
     def realign_clipped_reads(self, sf_ref, sf_reads, sf_out_sam):
-        cmd = "{0} mem -t {1} -T {2} -k {3} -o {4} {5} {6}" \
-              "".format(self.BWA_PATH, self.n_jobs, self.BWA_REALIGN_CUTOFF, self.BWA_REALIGN_CUTOFF, sf_out_sam,
-                        sf_ref, sf_reads)
+        self._realign_with_cache(self._get_clip_realign_opts(), sf_ref, sf_reads, sf_out_sam)
+
+    def _get_clip_realign_opts(self):
+        return "-T {0} -k {1}".format(self.BWA_REALIGN_CUTOFF, self.BWA_REALIGN_CUTOFF)
+
+    def _get_polyA_realign_opts(self):
+        return "-T {0} -k {1} -c {2}".format(global_values.MINIMUM_POLYA_CLIP, global_values.MINIMUM_POLYA_CLIP,
+                                            self.BWA_SEED_MEDIUM_FREQ)
+
+    def _run_bwa_mem(self, s_opts, sf_ref, sf_reads, sf_out_sam):
+        cmd = "{0} mem -t {1} {2} -o {3} {4} {5}".format(self.BWA_PATH, self.n_jobs, s_opts, sf_out_sam, sf_ref, sf_reads)
         #Popen(cmd, shell=True, stdout=PIPE).communicate()
         self.cmd_runner.run_cmd_small_output(cmd)
 
+    ####align the reads (fastq/fasta) with "bwa mem" with options "s_opts"
+    ####if the cache folder is set, only the reads not in the cache are aligned, and the cached records are added back
+    def _realign_with_cache(self, s_opts, sf_ref, sf_reads, sf_out_sam):
+        if self.sf_cache_folder is None:
+            self._run_bwa_mem(s_opts, sf_ref, sf_reads, sf_out_sam)
+            return
+        xcache = XRealignCache(self.sf_cache_folder, sf_ref, s_opts, self.BWA_PATH)
+        sf_miss = sf_out_sam + ".cache_miss"
+        sf_miss_sam = sf_miss + ".sam"
+        sf_hit_sam = sf_out_sam + ".cache_hit"
+        m_miss_seq = {}  # read name to sequence of the reads to align
+        n_hits = 0
+        with pysam.FastxFile(sf_reads) as fin_reads, open(sf_miss, "w") as fout_miss, open(sf_hit_sam, "w") as fout_hit:
+            l_entries = []
+            for entry in fin_reads:
+                l_entries.append(entry)
+                if len(l_entries) >= global_values.REALIGN_CACHE_BATCH_READS:
+                    n_hits += self._split_cached_entries(xcache, l_entries, fout_miss, fout_hit, m_miss_seq)
+                    l_entries = []
+            n_hits += self._split_cached_entries(xcache, l_entries, fout_miss, fout_hit, m_miss_seq)
+        xcache.count_hits(n_hits, len(m_miss_seq))
+
+        with open(sf_out_sam, "w") as fout_sam:
+            l_header = []
+            b_header = False
+            if len(m_miss_seq) > 0:
+                self._run_bwa_mem(s_opts, sf_ref, sf_miss, sf_miss_sam)
+                with open(sf_miss_sam) as fin_miss_sam:
+                    for s_qname, l_lines in iter_sam_read_records(fin_miss_sam, l_header):
+                        if b_header == False:
+                            fout_sam.write("".join(l_header))
+                            b_header = True
+                        fout_sam.write("".join(l_lines))
+                        if s_qname in m_miss_seq:
+                            xcache.add(m_miss_seq[s_qname], l_lines)
+                if len(l_header) > 0:
+                    xcache.set_header(l_header)
+                os.remove(sf_miss_sam)
+            if b_header == False:
+                if len(l_header) == 0:
+                    l_header = [xcache.get_header()]
+                fout_sam.write("".join(l_header))
+            with open(sf_hit_sam) as fin_hit:
+                shutil.copyfileobj(fin_hit, fout_sam)
+        xcache.close()
+        os.remove(sf_miss)
+        os.remove(sf_hit_sam)
+
+    ####write the restored records of the cached reads to "fout_hit", and the other reads to "fout_miss"
+    def _split_cached_entries(self, xcache, l_entries, fout_miss, fout_hit, m_miss_seq):
+        m_hits = xcache.lookup([entry.sequence for entry in l_entries])
+        n_hits = 0
+        for entry in l_entries:
+            s_qname = get_sam_qname(entry.name)
+            if entry.sequence in m_hits:
+                fout_hit.write(xcache.restore(s_qname, entry.quality, m_hits[entry.sequence]))
+                n_hits += 1
+            else:
+                fout_miss.write(str(entry) + "\n")
+                m_miss_seq[s_qname] = entry.sequence
+        return n_hits
+
     # this is assume the clipped parts including the short polyA
     # So we need to split the original "sf_readds" to polyA-reads and non-polyA reads,
     # then, align them seperately
     # Note, input "sf_reads" is in "fastq" format
     def realign_clipped_read_with_polyA(self, sf_ref, sf_reads, sf_out_sam):
-        sf_reads1=sf_reads+".non_polyA.fq"
-        sf_reads2=sf_reads+".polyA.fq"
-
-        with pysam.FastxFile(sf_reads) as fh, open(sf_reads1,"w") as fout_non, open(sf_reads2, "w") as fout_polya:
-            for entry in fh:
-                len_seq=len(entry.sequence)
-                if len_seq<global_values.BWA_REALIGN_CUTOFF:
-                    fout_polya.write(str(entry)+"\n")
-                else:
-                    fout_non.write(str(entry)+"\n")
-        sf_sam1=sf_out_sam+".non_polyA.sam"
-        self.realign_clipped_reads(sf_ref, sf_reads1, sf_sam1)
-        sf_sam2 = sf_out_sam + ".polyA.sam"
-        self.realign_clipped_polyA(sf_ref, sf_reads2, sf_sam2)
-
-        #merge the alignment
-        with open(sf_out_sam,"w") as fout_sam:
-            with open(sf_sam1) as fin_sam1:
-                for line in fin_sam1:
-                    fout_sam.write(line)
-            with open(sf_sam2) as fin_sam2:
-                for line in fin_sam2:
-                    if line[0]=="@":
-                        continue
-                    fout_sam.write(line)
-        os.remove(sf_reads1)
-        os.remove(sf_reads2)
-        os.remove(sf_sam1)
-        os.remove(sf_sam2)
+        ####the two alignments run at the same time, the reads are streamed in, and the outputs are merged as they come
+        n_cores_polyA = self.n_jobs // 4
+        if n_cores_polyA <= 0:
+            n_cores_polyA = 1
+        n_cores = self.n_jobs - n_cores_polyA
+        if n_cores <= 0:
+            n_cores = 1
+        xmerger = XSamMerger(sf_out_sam, 2)
+        l_aligners = []
+        for i_input, (s_opts, i_cores, s_suffix) in enumerate([(self._get_clip_realign_opts(), n_cores, ".non_polyA"),
+                                                              (self._get_polyA_realign_opts(), n_cores_polyA, ".polyA")]):
+            cmd = "{0} mem -t {1} {2} {3} -".format(self.BWA_PATH, i_cores, s_opts, sf_ref)
+            xcache = None
+            if self.sf_cache_folder is not None:
+                xcache = XRealignCache(self.sf_cache_folder, sf_ref, s_opts, self.BWA_PATH)
+            l_aligners.append(XStreamAligner(cmd, xmerger.get_input(i_input), None, xcache,
+                                             sf_out_sam + s_suffix + ".cache_hit"))
+        with open(sf_reads) as fin_reads:
+            for l_records in iter_fastq_batches(fin_reads, global_values.REALIGN_PREFILTER_BATCH_READS):
+                l_non_polyA = []
+                l_polyA = []
+                for l_lines in l_records:
+                    if len(l_lines[1].rstrip()) < global_values.BWA_REALIGN_CUTOFF:
+                        l_polyA.append(l_lines)
+                    else:
+                        l_non_polyA.append(l_lines)
+                l_aligners[0].add_fastq_records(l_non_polyA)
+                l_aligners[1].add_fastq_records(l_polyA)
+        l_errcodes = [xaligner.close() for xaligner in l_aligners]
+        for (errcode, s_job) in zip(l_errcodes, ["non-polyA", "polyA"]):
+            if errcode != 0:  #the merged sam is partial
+                raise RuntimeError("Realignment of the {0} clipped parts to {1} failed with exit code {2}".format(
+                    s_job, sf_ref, errcode))
 ####
     def index_ref_file(self, sf_fa):
         cmd="%s index %s" % (self.BWA_PATH, sf_fa)
@@ -65,13 +153,7 @@ class BWAlign():
 
     # re-align the collected clipped and discordant reads
     def realign_clipped_polyA(self, sf_ref, sf_reads, sf_out_sam):
-        cmd = "{0} mem -t {1} -T {2} -k {3} -o {4} -c {5} {6} {7}".format(self.BWA_PATH, self.n_jobs,
-                                                                   global_values.MINIMUM_POLYA_CLIP,
-                                                                   global_values.MINIMUM_POLYA_CLIP, sf_out_sam,
-                                                                          self.BWA_SEED_MEDIUM_FREQ, sf_ref, sf_reads)
-        #Popen(cmd, shell=True, stdout=PIPE).communicate()
-        #self.cmd_runner.run_cmd_to_file(cmd, sf_out_sam)
-        self.cmd_runner.run_cmd_small_output(cmd)
+        self._realign_with_cache(self._get_polyA_realign_opts(), sf_ref, sf_reads, sf_out_sam)
 
     # re-align the collected clipped and discordant reads
     def realign_clipped_reads_low_mem(self, sf_ref, sf_reads, sf_out_sam):
@@ -118,9 +200,7 @@ class BWAlign():
 
     # re-align the collected clipped and discordant reads
     def realign_disc_reads(self, sf_ref, sf_reads, sf_out_sam):
-        cmd = "{0} mem -t {1} -o {2} {3} {4}".format(self.BWA_PATH, self.n_jobs, sf_out_sam, sf_ref, sf_reads)
-        #Popen(cmd, shell=True, stdout=PIPE).communicate()
-        self.cmd_runner.run_cmd_small_output(cmd)
+        self._realign_with_cache("", sf_ref, sf_reads, sf_out_sam)
 
     # re-align the collected clipped and discordant reads
     def realign_disc_reads_low_mem(self, sf_ref, sf_reads, sf_out_sam):
@@ -149,7 +229,9 @@ class BWAlign():
     # 1) First, align to consensus, to collect those can be fully aligned to repeat copies
     # 2) Second, for those unmapped or poorly mapped, realign the copies with flank regions, use small value for "-c"
     def is_full_map(self, algnmt, max_clip_len):
-        l_cigar = algnmt.cigar
+        return self.is_full_map_cigar(algnmt.cigar, max_clip_len)
+
+    def is_full_map_cigar(self, l_cigar, max_clip_len):
         if len(l_cigar) < 1:  # wrong alignment
             return False
         if len(l_cigar) == 1 and l_cigar[0][0] == 0:  ##fully mapped
@@ -242,25 +324,47 @@ class BWAlign():
         return s_sq
     ####
     # here need to add the consensus to the repeat copy library file
-    def two_stage_realign(self, sf_ref_cns, sf_ref2, sf_reads, sf_out):
-        # align to consensus first
-        sf_sam_cns = sf_out + "_cns.sam"
-        n_cores = self.n_jobs - 1
+    def two_stage_realign(self, sf_ref_cns, sf_ref2, sf_reads, sf_out, xprefilter=None):
+        xstage1 = self.start_two_stage_realign(sf_ref_cns, sf_out, xprefilter=xprefilter)
+        xstage1.add_reads_file(sf_reads)
+        self.finish_two_stage_realign(xstage1, sf_ref_cns, sf_ref2, sf_out)
+
+    ####start the first stage of "two_stage_realign": align to consensus
+    ####the reads are streamed in with "add_reads_file" (e.g. while they are still being collected), and the output is
+    ####split into fully mapped, partial polyA and unmapped ones on the fly, so the sam is never written to disk
+    ####if "xprefilter" is set (XKmerPrefilter), the fastq reads sharing no k-mer with the consensus are not aligned
+    def start_two_stage_realign(self, sf_ref_cns, sf_out, n_cores=None, xprefilter=None):
+        if n_cores is None:
+            n_cores = self.n_jobs - 1
         if n_cores <= 0:
             n_cores = 1
-        cmd = "{0} mem -t {1} -T {2} -k {3} -o {4} {5} {6}".format(self.BWA_PATH, n_cores,
-                                                                   self.BWA_REALIGN_CUTOFF, self.BWA_REALIGN_CUTOFF,
-                                                                   sf_sam_cns, sf_ref_cns, sf_reads)
-        #Popen(cmd, shell=True, stdout=PIPE).communicate()
-        #self.cmd_runner.run_cmd_to_file(cmd, sf_sam_cns)
-        self.cmd_runner.run_cmd_small_output(cmd)
-
         sf_fully_sam = sf_out + ".sam"
         sf_unmap_fa = sf_out + "_unmapped_phase1.fa"
         max_clip_len = 2
         #here at the same time, will keep those short polyA ones in a seperate file
         sf_polyA_fa=sf_out+"_partial_polyA.fa"
-        self.get_fully_mapped_algnmts(sf_sam_cns, sf_ref_cns, max_clip_len, sf_fully_sam, sf_unmap_fa, sf_polyA_fa)
+        xsplitter = XFullMapSplitter(self, max_clip_len, sf_fully_sam, sf_unmap_fa, sf_polyA_fa)
+        s_opts = self._get_clip_realign_opts()
+        cmd = "{0} mem -t {1} {2} {3} -".format(self.BWA_PATH, n_cores, s_opts, sf_ref_cns)
+        xcache = None
+        if self.sf_cache_folder is not None:
+            xcache = XRealignCache(self.sf_cache_folder, sf_ref_cns, s_opts, self.BWA_PATH)
+        return XStreamAligner(cmd, xsplitter, xprefilter, xcache, sf_out + ".cache_hit")
+
+    ####wait for the first stage to finish, and run the rest of "two_stage_realign"
+    def finish_two_stage_realign(self, xstage1, sf_ref_cns, sf_ref2, sf_out):
+        errcode = xstage1.close()
+        if errcode != 0:  #the stage-1 output is empty or truncated
+            raise RuntimeError("Realignment of the clipped parts to {0} failed with exit code {1}".format(sf_ref_cns,
+                                                                                                         errcode))
+        xsplitter = xstage1.get_consumer()
+        if xstage1.xprefilter is not None:
+            n_screened, n_kept = xstage1.xprefilter.get_stats()
+            print(("{0} of {1} clipped parts share k-mers with {2} and are aligned\n".format(n_kept, n_screened,
+                                                                                           sf_ref_cns)))
+        sf_fully_sam = xsplitter.sf_fully_sam
+        sf_unmap_fa = xsplitter.sf_unmap_fa
+        sf_polyA_fa = xsplitter.sf_polyA_fa
 
         #align the small polyA regions to repeat consensus
         sf_polyA_sam=sf_out+"_partial_polyA.sam"
@@ -271,17 +375,10 @@ class BWAlign():
         #create the SQ fields from the rep-copy file
         self._gnrt_SQ_from_fa(sf_ref2, sf_sq)
 
-        with open(sf_sq,"a") as fout_fq:
-            samfile = pysam.AlignmentFile(sf_sam_cns, 'r')
-            m_header = samfile.header.copy()
-            if 'SQ' in m_header:#get the SQ fields
-                l_sq = m_header['SQ']
-                for sq_rcd in l_sq:
-                    sq_ln = sq_rcd['LN']
-                    sq_sn = sq_rcd['SN']
-                    s_sq = "@SQ\tSN:{0}\tLN:{1}\n".format(sq_sn, sq_ln)
-                    fout_fq.write(s_sq)
-            samfile.close()
+        with open(sf_sq,"a") as fout_fq:#get the SQ fields of the consensus
+            for (sq_sn, sq_ln) in xsplitter.get_sq():
+                s_sq = "@SQ\tSN:{0}\tLN:{1}\n".format(sq_sn, sq_ln)
+                fout_fq.write(s_sq)
 
         # then align again to the repeat copies
         #sf_realign_sam = sf_out
@@ -294,7 +391,6 @@ class BWAlign():
 
 
         #clean the temporary files
-        os.remove(sf_sam_cns)
         os.remove(sf_fully_sam)
         os.remove(sf_unmap_fa)
         os.remove(sf_polyA_fa)
@@ -306,6 +402,320 @@ class BWAlign():
         self.cmd_runner.run_cmd_to_file(cmd, sf_calmd_sam)
     ####
 ####
+
+####Keep the bwa indexes in shared memory ("bwa shm") during a step, so the "bwa mem" runs on the same reference (e.g.
+####stage-1, polyA and stage-2 realignment of each family, for each bam) attach to it instead of reloading it from disk.
+####"bwa mem" picks up an index in shared memory by its file name, so the commands themselves are not changed.
+####As the file name is the only identity, an index of the same name already in shared memory (e.g. another version of
+####the repeat library loaded by another job) can't be told apart from ours, so the session refuses to run with it.
+####"bwa shm -d" drops all the indexes in shared memory, so at the end it is called only if all of them were loaded
+####by this session. The check and the drop are not atomic, so BWA_SHM_PRELOAD (off by default, "--bwa_shm") should
+####only be set on nodes where no other job uses "bwa shm".
+class XBwaIndexSession():
+    def __init__(self, BWA_PATH=None):
+        self.BWA_PATH = BWA_PATH
+        if BWA_PATH is None:
+            self.BWA_PATH = global_values.BWA_PATH
+        self.s_loaded = set()  # names of the indexes loaded by this session
+
+    ####names of the indexes currently in shared memory
+    def _list_shm(self):
+        cmd = "{0} shm -l".format(self.BWA_PATH)
+        s_out = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 universal_newlines=True).communicate()[0]
+        s_names = set()
+        for line in s_out.split("\n"):
+            fields = line.split()
+            if len(fields) > 0:
+                s_names.add(fields[0])
+        return s_names
+
+    ####load the indexes (same path as used in "bwa mem") to shared memory
+    ####an index of the same name in shared memory, but not loaded by this session, is an error
+    def preload(self, l_sf_ref):
+        if global_values.BWA_SHM_PRELOAD == False:
+            return
+        s_in_shm = self._list_shm()
+        for sf_ref in l_sf_ref:
+            s_name = os.path.basename(sf_ref)
+            if s_name in self.s_loaded:
+                continue
+            if s_name in s_in_shm:
+                raise RuntimeError("bwa index {0} is already in shared memory but not loaded by this run, \"bwa mem\" "
+                                   "would use it instead of {1}. Drop it with \"{2} shm -d\", or run without "
+                                   "--bwa_shm".format(s_name, sf_ref, self.BWA_PATH))
+            if os.path.isfile(sf_ref + ".bwt") == False:
+                print("Warning: bwa index of {0} doesn't exist, not preloaded!".format(sf_ref))
+                continue
+            cmd = "{0} shm {1}".format(self.BWA_PATH, sf_ref)
+            print(("Running command: {0}\n".format(cmd)))
+            p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+            p.communicate()
+            if p.returncode != 0:  # "bwa mem" will load the index from disk as before
+                print("Warning: fail to load bwa index {0} to shared memory!".format(sf_ref))
+                continue
+            self.s_loaded.add(s_name)
+
+    ####drop the indexes loaded by this session
+    def close(self):
+        if len(self.s_loaded) == 0:
+            return
+        s_in_shm = self._list_shm()
+        if s_in_shm.issubset(self.s_loaded) == True:
+            cmd = "{0} shm -d".format(self.BWA_PATH)
+            print(("Running command: {0}\n".format(cmd)))
+            subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).communicate()
+        else:
+            print("Other bwa indexes are in shared memory, keep them: {0}".format(", ".join(sorted(s_in_shm))))
+        self.s_loaded = set()
+####
+
+####An aligner command reading the reads from stdin, so the reads can be streamed in while they are still collected.
+####The output is passed line by line to the consumer ("add_line" method) in a reader thread, so the output is not
+####written to disk, and the two pipes never block each other
+####If "xcache" (XRealignCache) is set, only the fastq reads not in the cache are aligned, the restored records of the
+####cached ones are saved in "sf_hit" and passed to the consumer after the aligner finishes (after the sam header)
+####If "xprefilter" (XKmerPrefilter) is set, the fastq reads it drops (can't be aligned) are sent as a one base
+####placeholder to keep the read order, and their unmapped records are restored with the original sequence
+class XStreamAligner():
+    def __init__(self, cmd, xconsumer, xprefilter=None, xcache=None, sf_hit=None):
+        print(("Running command with streamed input: {0}\n".format(cmd)))
+        self.xconsumer = xconsumer
+        self.xprefilter = xprefilter
+        self.m_skip_seq = {}  # read name to [(sequence, qualities)] of the reads sent as placeholder
+        self.skip_lock = threading.Lock()
+        self.xcache = xcache
+        self.sf_hit = sf_hit
+        if xcache is not None:
+            self.fout_hit = open(sf_hit, "w")
+            self.m_miss_seq = {}  # read name to sequence of the reads sent to the aligner
+            self.l_header = []
+        self.proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     universal_newlines=True)
+        self.reader = threading.Thread(target=self._read_output)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _read_output(self):
+        if self.xcache is None:
+            for line in self.proc.stdout:
+                self.xconsumer.add_line(self._restore_skipped(line))
+            return
+        for s_qname, l_lines in iter_sam_read_records(self._iter_output_lines(), self.l_header):
+            for line in l_lines:
+                self.xconsumer.add_line(self._restore_skipped(line))
+            s_seq = self.m_miss_seq.pop(s_qname, None)
+            if s_seq is not None:
+                self.xcache.add(s_seq, l_lines)
+
+    ####pass the header lines to the consumer as they come, the records are passed per read by "_read_output"
+    def _iter_output_lines(self):
+        for line in self.proc.stdout:
+            if line[0] == "@":
+                self.xconsumer.add_line(line)
+            yield line
+
+    ####restore the sequence and qualities of the unmapped record of a placeholder
+    def _restore_skipped(self, line):
+        if len(self.m_skip_seq) == 0 or line[0] == "@":
+            return line
+        s_qname = line[:line.find("\t")]
+        if s_qname not in self.m_skip_seq:
+            return line
+        fields = line.split("\t")
+        if len(fields) < 11 or fields[9] != "N":  # another read of the same name
+            return line
+        with self.skip_lock:
+            l_skip = self.m_skip_seq[s_qname]
+            (s_seq, s_qual) = l_skip.pop(0)
+            if len(l_skip) == 0:
+                del self.m_skip_seq[s_qname]
+        fields[9] = s_seq
+        fields[10] = s_qual
+        return "\t".join(fields)
+
+    def get_consumer(self):
+        return self.xconsumer
+
+    ####stream the reads (fastq/fasta) saved in a file, the prefilter and the cache (if any) only support fastq
+    def add_reads_file(self, sf_reads):
+        with open(sf_reads) as fin_reads:
+            if self.xprefilter is None and self.xcache is None:
+                shutil.copyfileobj(fin_reads, self.proc.stdin)
+                return
+            for l_records in iter_fastq_batches(fin_reads, global_values.REALIGN_PREFILTER_BATCH_READS):
+                self.add_fastq_records(l_records)
+
+    ####stream the fastq records (each is a list of the 4 lines)
+    def add_fastq_records(self, l_records):
+        if self.xcache is not None:
+            l_records = self._split_cached_records(l_records)
+        if self.xprefilter is not None:
+            l_records = self._replace_skipped_records(l_records)
+        self.proc.stdin.write("".join(["".join(l_lines) for l_lines in l_records]))
+
+    ####replace the reads dropped by the prefilter with placeholders, they are not saved in the cache
+    def _replace_skipped_records(self, l_records):
+        a_keep = self.xprefilter.screen([l_lines[1].rstrip() for l_lines in l_records])
+        l_out = []
+        for l_lines, b_keep in zip(l_records, a_keep):
+            if b_keep == False:
+                s_qname = get_sam_qname(l_lines[0][1:].split()[0])
+                if self.xcache is not None:
+                    self.m_miss_seq.pop(s_qname, None)
+                with self.skip_lock:
+                    if s_qname not in self.m_skip_seq:
+                        self.m_skip_seq[s_qname] = []
+                    self.m_skip_seq[s_qname].append((l_lines[1].rstrip(), l_lines[3].rstrip()))
+                l_lines = [l_lines[0], "N\n", l_lines[2], "!\n"]
+            l_out.append(l_lines)
+        return l_out
+
+    ####save the restored records of the cached reads, and return the other ones
+    def _split_cached_records(self, l_records):
+        m_hits = self.xcache.lookup([l_lines[1].rstrip() for l_lines in l_records])
+        l_miss = []
+        for l_lines in l_records:
+            s_seq = l_lines[1].rstrip()
+            s_qname = get_sam_qname(l_lines[0][1:].split()[0])
+            if s_seq in m_hits:
+                self.fout_hit.write(self.xcache.restore(s_qname, l_lines[3].rstrip(), m_hits[s_seq]))
+            else:
+                self.m_miss_seq[s_qname] = s_seq
+                l_miss.append(l_lines)
+        self.xcache.count_hits(len(l_records) - len(l_miss), len(l_miss))
+        return l_miss
+
+    ####no more reads, wait for the aligner to finish
+    def close(self):
+        self.proc.stdin.close()
+        self.reader.join()
+        self.proc.stdout.close()
+        errcode = self.proc.wait()
+        if self.xcache is not None:
+            self.fout_hit.close()
+            with open(self.sf_hit) as fin_hit:
+                for line in fin_hit:
+                    self.xconsumer.add_line(line)
+            os.remove(self.sf_hit)
+            if len(self.l_header) > 0:
+                self.xcache.set_header(self.l_header)
+            self.xcache.close()
+        self.xconsumer.close()
+        return errcode
+####
+
+####Merge the sam outputs of several aligners (on the same reference) into one file as they come. The header is taken
+####from the first aligner, and the records of the others are held until the header is written.
+####Each aligner gets its own input ("get_input"), which is called from the reader thread of the aligner.
+class XSamMerger():
+    def __init__(self, sf_out_sam, n_inputs):
+        self.fout_sam = open(sf_out_sam, "w")
+        self.lock = threading.Lock()
+        self.b_header_done = False
+        self.l_held = []
+        self.n_open = n_inputs
+
+    def get_input(self, i_input):
+        return XSamMergerInput(self, i_input)
+
+    def _release_held(self):
+        self.b_header_done = True
+        self.fout_sam.write("".join(self.l_held))
+        self.l_held = []
+
+    def add_line(self, i_input, line):
+        with self.lock:
+            if line[0] == "@":
+                if i_input == 0:
+                    self.fout_sam.write(line)
+                return
+            if self.b_header_done == True:
+                self.fout_sam.write(line)
+            elif i_input == 0:
+                self._release_held()
+                self.fout_sam.write(line)
+            else:
+                self.l_held.append(line)
+
+    def close_input(self, i_input):
+        with self.lock:
+            if i_input == 0 and self.b_header_done == False:
+                self._release_held()
+            self.n_open -= 1
+            if self.n_open == 0:
+                self._release_held()
+                self.fout_sam.close()
+####
+
+class XSamMergerInput():
+    def __init__(self, xmerger, i_input):
+        self.xmerger = xmerger
+        self.i_input = i_input
+
+    def add_line(self, line):
+        self.xmerger.add_line(self.i_input, line)
+
+    def close(self):
+        self.xmerger.close_input(self.i_input)
+####
+
+####Split the sam lines (aligned to consensus) same as "BWAlign.get_fully_mapped_algnmts":
+####fully mapped ones are saved to sam, short (polyA) ones and the others are saved to two fasta files
+class XFullMapSplitter():
+    def __init__(self, bwa_align, max_clip_len, sf_fully_sam, sf_unmap_fa, sf_polyA_fa):
+        self.bwa_align = bwa_align
+        self.max_clip_len = max_clip_len
+        self.sf_fully_sam = sf_fully_sam
+        self.sf_unmap_fa = sf_unmap_fa
+        self.sf_polyA_fa = sf_polyA_fa
+        self.fout_sam = open(sf_fully_sam, "w")
+        self.fout_fa = open(sf_unmap_fa, "w")
+        self.fout_polyA = open(sf_polyA_fa, "w")
+        self.l_sq = []  # (SN, LN) of the header, in order
+        self.re_cigar = re.compile(r"(\d+)([MIDNSHP=X])")
+        self.i_skip_flag = 0x400 | 0x800 | 0x100  # duplicate, supplementary and secondary ones are skipped
+
+    def add_line(self, line):
+        if line[0] == "@":
+            self.fout_sam.write(line)
+            if line.startswith("@SQ"):
+                s_sn = ""
+                s_ln = ""
+                for field in line.rstrip("\n").split("\t")[1:]:
+                    if field[:3] == "SN:":
+                        s_sn = field[3:]
+                    elif field[:3] == "LN:":
+                        s_ln = field[3:]
+                self.l_sq.append((s_sn, s_ln))
+            return
+        fields = line.split("\t", 10)
+        if len(fields) < 10:
+            return
+        if int(fields[1]) & self.i_skip_flag:
+            return
+        l_cigar = [(CIGAR_OPS.index(s_op), int(s_len)) for (s_len, s_op) in self.re_cigar.findall(fields[5])]
+        if self.bwa_align.is_full_map_cigar(l_cigar, self.max_clip_len) == True:
+            self.fout_sam.write(line)
+        else:
+            query_name = fields[0]
+            query_seq = fields[9]
+            len_seq = len(query_seq)
+            if len_seq >= global_values.MINIMUM_POLYA_CLIP and len_seq < global_values.BWA_REALIGN_CUTOFF:
+                self.fout_polyA.write(">" + query_name + "\n")
+                self.fout_polyA.write(query_seq + "\n")
+            else:
+                self.fout_fa.write(">" + query_name + "\n")
+                self.fout_fa.write(query_seq + "\n")
+
+    def get_sq(self):
+        return self.l_sq
+
+    def close(self):
+        self.fout_sam.close()
+        self.fout_fa.close()
+        self.fout_polyA.close()
+####
 #
 # ####
 # ## for test only
@@ -3,6 +3,7 @@
 ##@@contact: chong_chu@hms.harvard.edu
 
 
+import re
 import pysam
 from x_annotation import *
 from x_alignments import *
@@ -10,6 +11,14 @@ from x_intermediate_sites import *
 import global_values
 from x_polyA import *
 from bwa_align import *
+from x_evidence_scanner import *
+from x_annotation_index import *
+from x_clip_position import *
+from x_clip_record_table import *
+from x_disc_sidecar import *
+from x_chrom_registry import get_chrom_registry
+from x_region_planner import XRegionPlanner
+from x_bam_stamp import get_bam_key, save_bam_stamp
 
 class OneClipRead():
     def __init__(self):
@@ -66,6 +75,15 @@ class ClipReadInfo():
         self.working_folder = "./"
         self.n_jobs = n_jobs
         self.sf_reference = sf_ref
+        self.evidence_folder = None #where the evidence store is saved, by default the working folder
+
+    def set_evidence_folder(self, evidence_folder):
+        self.evidence_folder = evidence_folder
+
+    def _get_evidence_folder(self):
+        if self.evidence_folder is None:
+            return self.working_folder
+        return self.evidence_folder
 
     def set_working_folder(self, working_folder):
         self.working_folder = working_folder
@@ -76,29 +94,27 @@ class ClipReadInfo():
     ####return two files:
     ####1. the clip_position file
     ####2. the soft-clipped part for re-alignment
-    ####Here as part of a preprocessing step, also output all the discordant pairs in a single file (ALL_DISC_SUFFIX)
+    ####Here as part of a preprocessing step, also save all the discordant pairs in the sidecar (see XDiscSidecar)
     def collect_clipped_reads_with_position_by_chrm(self, record):
         chrm = record[0]
         sf_bam = record[1]
         working_folder = record[2]
-        sf_annotation = record[3]
-        b_with_chr = record[4]
+        sf_rmsk_index = record[3] #compiled from the rmsk annotation by the main process
 
-        xannotation = XAnnotation(sf_annotation)
-        xannotation.set_with_chr(b_with_chr)
-        xannotation.load_rmsk_annotation()
-        xannotation.index_rmsk_annotation()
+        #same regions as "XAnnotation.load_rmsk_annotation": only the start is extended
+        xannotation = XAnnotationIndex(sf_rmsk_index).get_family_view(0, global_values.LOAD_RMSK_LEFT_EXTND, 0)
 
         sf_clip_fq = working_folder + chrm + global_values.CLIP_FQ_SUFFIX  # this is to save the clipped part for re-alignment
         f_clip_fq = open(sf_clip_fq, "w")
 
         samfile = pysam.AlignmentFile(sf_bam, "rb", reference_filename=self.sf_reference)
-        m_clip_pos = {}
-        sf_all_disc = sf_bam + global_values.ALL_DISC_SUFFIX
-        out_disc_bam = pysam.Samfile(sf_all_disc, 'wb', template=samfile)
+        xclip_counter = XClipPosCounter(CLIP_POS_FIELDS)
+        xdisc_writer = XDiscSidecarWriter(samfile.get_tid(chrm))
         xalgnmt = XAlignment()
         m_chrm_id=self._get_chrm_id_name(samfile)
+        xannotation.bind_registry(get_chrom_registry(sf_bam, self.sf_reference, samfile)) #mates are queried by tid
         for algnmt in samfile.fetch(chrm):  ##fetch reads mapped to "chrm"
+            xdisc_writer.add(algnmt)
             ##here need to skip the secondary and supplementary alignments?
             # if algnmt.is_secondary or algnmt.is_supplementary:
             #     continue
@@ -120,28 +136,21 @@ class ClipReadInfo():
             query_quality = algnmt.query_qualities  ##this is different from the one saved in the fastq/sam, no offset 33 to subtract
             map_pos = algnmt.reference_start
             mate_chrm = '*'
+            mate_tid = -1
             mate_pos = 0
             if algnmt.next_reference_id not in m_chrm_id:
                 continue
             if algnmt.mate_is_unmapped == False and algnmt.next_reference_id>=0:
                 mate_chrm = algnmt.next_reference_name
+                mate_tid = algnmt.next_reference_id
                 mate_pos = algnmt.next_reference_start
 
             # if xalgnmt.is_discordant_pair_no_unmap(chrm, map_pos, )
-            b_mate_in_rep, rep_start_pos = xannotation.is_within_repeat_region(mate_chrm, mate_pos)
+            b_mate_in_rep, rep_start_pos = xannotation.is_within_repeat_region_tid(mate_tid, mate_pos)
             if l_cigar[0][0] == 4 or l_cigar[0][0] == 5:  # left clipped
-                if map_pos not in m_clip_pos:
-                    m_clip_pos[map_pos] = []
-                    m_clip_pos[map_pos].append(1)  ##record # of left clip
-                    m_clip_pos[map_pos].append(0)  ##record # of right clip
-                    if b_mate_in_rep:
-                        m_clip_pos[map_pos].append(1)  ##record # of mate-reads within repeat region
-                    else:
-                        m_clip_pos[map_pos].append(0)
-                else:
-                    m_clip_pos[map_pos][0] += 1
-                    if b_mate_in_rep:
-                        m_clip_pos[map_pos][2] += 1
+                xclip_counter.add(map_pos, 0)  ##record # of left clip
+                if b_mate_in_rep:
+                    xclip_counter.add(map_pos, 2)  ##record # of mate-reads within repeat region
 
                 if algnmt.is_supplementary or algnmt.is_secondary:  ###secondary and supplementary are not considered
                     continue
@@ -174,18 +183,9 @@ class ClipReadInfo():
                     else:
                         map_pos += lenth
 
-                if map_pos not in m_clip_pos:
-                    m_clip_pos[map_pos] = []
-                    m_clip_pos[map_pos].append(0)
-                    m_clip_pos[map_pos].append(1)
-                    if b_mate_in_rep:
-                        m_clip_pos[map_pos].append(1)  ##record # of mate-reads within repeat region
-                    else:
-                        m_clip_pos[map_pos].append(0)
-                else:
-                    m_clip_pos[map_pos][1] += 1
-                    if b_mate_in_rep:
-                        m_clip_pos[map_pos][2] += 1
+                xclip_counter.add(map_pos, 1)  ##record # of right clip
+                if b_mate_in_rep:
+                    xclip_counter.add(map_pos, 2)  ##record # of mate-reads within repeat region
 
                 if algnmt.is_supplementary or algnmt.is_secondary:  ###secondary and supplementary are not considered
                     continue
@@ -210,14 +210,16 @@ class ClipReadInfo():
                     f_clip_fq.write(clipped_qulity + "\n")
         f_clip_fq.close()
 
-        sf_clip_pos = working_folder + chrm + global_values.CLIP_POS_SUFFIX
-        with open(sf_clip_pos, "w") as fout_clip_pos:
-            for pos in m_clip_pos:
-                fout_clip_pos.write(
-                    str(pos) + "\t" + str(m_clip_pos[pos][0]) + "\t" + str(m_clip_pos[pos][1]) + "\t" +
-                    str(m_clip_pos[pos][2]) + "\n")
+        sf_clip_pos = working_folder + chrm + global_values.CLIP_POS_NPY_SUFFIX
+        save_clip_pos(sf_clip_pos, xclip_counter.get_counts())
+        self._save_disc_sidecar_chrm(samfile, chrm, xdisc_writer)
         samfile.close()
-        out_disc_bam.close()
+
+    ####the whole chromosome is scanned, so the sidecar covers all of it
+    def _save_disc_sidecar_chrm(self, samfile, chrm, xdisc_writer):
+        xsidecar = XDiscSidecar(self._get_evidence_folder(), self.sf_bam)
+        xsidecar.save_chrm(chrm, xdisc_writer.get_reads(),
+                           [(0, samfile.get_reference_length(chrm), xdisc_writer.get_max_span())])
 
     def _cvt_to_Ascii_quality(self, l_score):
         new_score = [x + 33 for x in l_score]
@@ -239,39 +241,32 @@ class ClipReadInfo():
     ####2. all the clipped part in fastq format
     def collect_clipped_reads_with_position(self, sf_all_clip_fq, sf_annotation):
         samfile = pysam.AlignmentFile(self.sf_bam, "rb", reference_filename=self.sf_reference)
-        bam_info = BamInfo(self.sf_bam, self.sf_reference)
-        b_with_chr = bam_info.is_chrm_contain_chr()
 
         references = samfile.references
         l_chrm_records = []
+        sf_rmsk_index = compile_rmsk_index(self.working_folder, [sf_annotation])
         for chrm in references:
-            l_chrm_records.append((chrm, self.sf_bam, self.working_folder, sf_annotation, b_with_chr))
+            l_chrm_records.append((chrm, self.sf_bam, self.working_folder, sf_rmsk_index))
         samfile.close()
 
+        xsidecar = XDiscSidecar(self._get_evidence_folder(), self.sf_bam)
+        xsidecar.clean()
         pool = Pool(self.n_jobs)
         pool.map(unwrap_self_cnt_clip, list(zip([self] * len(l_chrm_records), l_chrm_records)), 1)
         pool.close()
         pool.join()
+        xsidecar.save_info()
 
         m_clip_freq = {}  ##in format {chrm: {map_pos: (left_cnt, right_cnt, mate_within_rep_cnt)}}
         for chrm in references:#
-            sf_clip_pos = self.working_folder + chrm + global_values.CLIP_POS_SUFFIX
-            if os.path.isfile(sf_clip_pos) == False:
+            a_clip_pos, sf_clip_pos = load_clip_pos(self.working_folder + chrm, CLIP_POS_FIELDS)
+            if a_clip_pos is None:
                 print(("Error: Position file for chrom {0} doesn't exist!!!!".format(chrm)))
                 continue
 
             m_clip_pos_freq = {}
-            with open(sf_clip_pos) as fin_clip_pos:
-                for line in fin_clip_pos:
-                    fields = line.split()
-                    cur_pos = int(fields[0])
-                    left_cnt = int(fields[1])
-                    right_cnt = int(fields[2])
-                    mate_within_rep_cnt = int(fields[3])
-                    m_clip_pos_freq[cur_pos] = []
-                    m_clip_pos_freq[cur_pos].append(left_cnt)
-                    m_clip_pos_freq[cur_pos].append(right_cnt)
-                    m_clip_pos_freq[cur_pos].append(mate_within_rep_cnt)
+            for (cur_pos, left_cnt, right_cnt, mate_within_rep_cnt) in a_clip_pos.tolist():
+                m_clip_pos_freq[cur_pos] = [left_cnt, right_cnt, mate_within_rep_cnt]
             m_clip_freq[chrm] = m_clip_pos_freq
 
         ##merge the clipped reads
@@ -298,25 +293,22 @@ class ClipReadInfo():
         chrm = record[0]
         sf_bam = record[1]
         working_folder = record[2]
-        sf_annotation = record[3]
-        b_with_chr = record[4]
-        i_clip_cutoff = int(record[5])
-        b_se = record[6] #whether this is single end reads
+        i_clip_cutoff = int(record[3])
+        b_se = record[4] #whether this is single end reads
+        sf_rmsk_index = record[5] #compiled from the rmsk annotation by the main process
 ####
-        xannotation = XAnnotation(sf_annotation)
-        xannotation.set_with_chr(b_with_chr)
-        #xannotation.load_rmsk_annotation()
-        i_min_copy_len=0
         i_boundary_extnd=0
         if global_values.IS_CALL_SVA==True:
             i_boundary_extnd=global_values.SVA_ANNOTATION_EXTND
-        xannotation.load_rmsk_annotation_with_extnd_with_lenth_cutoff(i_boundary_extnd, i_min_copy_len)
-        xannotation.index_rmsk_annotation_interval_tree()
+        xannotation = XAnnotationIndex(sf_rmsk_index).get_family_view(0, i_boundary_extnd)
 
         samfile = pysam.AlignmentFile(sf_bam, "rb", reference_filename=self.sf_reference)
         m_clip_pos = {}
         m_chrm_id_name = self._get_chrm_id_name(samfile)
+        xannotation.bind_registry(get_chrom_registry(sf_bam, self.sf_reference, samfile)) #mates are queried by tid
+        xdisc_writer = XDiscSidecarWriter(samfile.get_tid(chrm))
         for algnmt in samfile.fetch(chrm):  ##fetch reads mapped to "chrm"
+            xdisc_writer.add(algnmt)
             ##here need to skip the secondary and supplementary alignments?
             # if algnmt.is_secondary or algnmt.is_supplementary:
             #     continue
@@ -338,18 +330,18 @@ class ClipReadInfo():
             if algnmt.next_reference_id not in m_chrm_id_name:
                 continue
             map_pos = algnmt.reference_start
-            mate_chrm = '*'
+            mate_tid = -1
             mate_pos = 0
 
             if algnmt.mate_is_unmapped == False and algnmt.next_reference_id>=0:
-                mate_chrm = algnmt.next_reference_name
+                mate_tid = algnmt.next_reference_id
                 mate_pos = algnmt.next_reference_start
-            # print mate_chrm, mate_pos ################################################################################
+            # print mate_tid, mate_pos #################################################################################
             b_mate_in_rep = False
             rep_start_pos = 0
             #b_mate_in_rep, rep_start_pos = xannotation.is_within_repeat_region(mate_chrm, mate_pos)
             if b_se == False:
-                b_mate_in_rep, rep_start_pos = xannotation.is_within_repeat_region_interval_tree(mate_chrm, mate_pos)
+                b_mate_in_rep, rep_start_pos = xannotation.is_within_repeat_region_interval_tree_tid(mate_tid, mate_pos)
 
             # print b_mate_in_rep, rep_start_pos #######################################################################
             if l_cigar[0][0] == 4 or l_cigar[0][0] == 5:  # left clipped
@@ -398,48 +390,202 @@ class ClipReadInfo():
                     fout_clip_pos.write(
                         str(pos) + "\t" + str(m_clip_pos[pos][0]) + "\t" + str(m_clip_pos[pos][1]) + "\t" +
                         str(m_clip_pos[pos][2]) + "\n")
+        self._save_disc_sidecar_chrm(samfile, chrm, xdisc_writer)
         samfile.close()
 
 
     # YW 2021/09/29 new function, only collect info and clipped parts for predefined loci
-    def collect_clip_info_and_parts(self, locus_dict, sf_annotation_Alu, sf_annotation_L1, sf_annotation_SVA, i_clip_cutoff, b_se, sf_pub_folder, sf_all_clip_fq_ori):
-        bam_info = BamInfo(self.sf_bam, self.sf_reference)
-        b_with_chr = bam_info.is_chrm_contain_chr()
+    ####l_realigners: the clipped parts of each finished scan unit are also streamed into these aligners (optional)
+    def collect_clip_info_and_parts(self, locus_dict, sf_annotation_Alu, sf_annotation_L1, sf_annotation_SVA, i_clip_cutoff, b_se, sf_pub_folder, sf_all_clip_fq_ori, l_realigners=None, n_scan_jobs=None):
+        ####n_scan_jobs: size of the scan pool, smaller than n_jobs if the realigners run at the same time
+        if n_scan_jobs is None:
+            n_scan_jobs = self.n_jobs
         samfile = pysam.AlignmentFile(self.sf_bam, "rb", reference_filename=self.sf_reference)
         references = samfile.references
         xchrom=XChromosome()
         l_chrm_records = []
+        #parse the annotations once here, the workers only memory-map the compiled index
+        #SVA annotation is extended a little bit, as the rmsk annotation of SVA is bad
+        sf_rmsk_index = compile_multi_family_index(self.working_folder,
+                                                   [sf_annotation_Alu, sf_annotation_L1, sf_annotation_SVA],
+                                                   [0, 0, global_values.SVA_ANNOTATION_EXTND])
+        #plan the scan windows of each chromosome, and split them into units of similar size
+        #so large chromosomes are scanned by several workers, and do not hold up the others
+        xscanner = XEvidenceScanner(self._get_evidence_folder(), self.sf_bam)
+        xplanner = XRegionPlanner()
+        m_chrm_scan = {}
+        i_total_size = 0
         for chrm in locus_dict:
             if xchrom.is_decoy_contig_chrms(chrm) == True:  ###decoy sequnces and contigs are not considered
                 continue
-            l_chrm_records.append((chrm, locus_dict[chrm], self.sf_bam, self.working_folder,
-                                   sf_annotation_Alu, sf_annotation_L1, sf_annotation_SVA,
-                                   b_with_chr, i_clip_cutoff, b_se)) # YW 2021/03/18 update sf_annotation
+            focal_windows, l_scan = xscanner.plan_locus_scan(locus_dict[chrm])
+            m_chrm_scan[chrm] = (focal_windows, l_scan)
+            for (start_pos, end_pos, sub_windows) in l_scan:
+                i_total_size += (end_pos - start_pos)
+        i_unit_size = i_total_size // (n_scan_jobs * global_values.LOCUS_SCAN_UNITS_PER_JOB) + 1
+        m_chrm_n_parts = {}
+        l_unit_size = []
+        for chrm in m_chrm_scan:
+            focal_windows, l_scan = m_chrm_scan[chrm]
+            l_groups = xplanner.split_windows(l_scan, i_unit_size)
+            if len(l_groups) == 0:#still scan once, so the outputs of the chromosome exist
+                l_groups = [[]]
+            i_prev_end = -1
+            for i_part, l_group in enumerate(l_groups):
+                t_unit = (focal_windows, l_group, i_prev_end, i_part)
+                #the unit index is the prefix of the record ids of its clipped parts
+                l_chrm_records.append((chrm, t_unit, self.sf_bam, self.working_folder, b_se, sf_rmsk_index,
+                                       len(l_chrm_records)))
+                l_unit_size.append(sum([end_pos - start_pos for (start_pos, end_pos, sub_windows) in l_group]))
+                if len(l_group) > 0:
+                    i_prev_end = l_group[-1][1]
+            m_chrm_n_parts[chrm] = len(l_groups)
         samfile.close()
-
-        pool = Pool(self.n_jobs)
-        pool.map(unwrap_self_collect_clip_info_and_parts, list(zip([self] * len(l_chrm_records), l_chrm_records)), 1)
+        #largest units first, so the small ones fill in the idle workers at the end
+        l_order = sorted(range(len(l_chrm_records)), key=lambda idx: l_unit_size[idx], reverse=True)
+        l_chrm_records = [l_chrm_records[idx] for idx in l_order]
+
+        #the clipped parts are merged as soon as each unit is done, so the realignment runs along with the scanning
+        if l_realigners is None:
+            l_realigners = []
+        pool = Pool(n_scan_jobs)
+        with open(sf_all_clip_fq_ori, "w") as fout_all:
+            for sf_clip_fq in pool.imap_unordered(unwrap_self_collect_clip_info_and_parts,
+                                                  list(zip([self] * len(l_chrm_records), l_chrm_records)), 1):
+                if os.path.isfile(sf_clip_fq) == False:
+                    continue
+                with open(sf_clip_fq) as fin_clip:
+                    for line in fin_clip:
+                        fout_all.write(line)
+                for xrealigner in l_realigners:
+                    xrealigner.add_reads_file(sf_clip_fq)
+                os.remove(sf_clip_fq)#clean the temporary file
         pool.close()
         pool.join()
 
+        #provenance of the clipped parts, looked up by record id when the realignments are counted
+        l_sf_part_records = []
+        for chrm in m_chrm_n_parts:
+            for i_part in range(m_chrm_n_parts[chrm]):
+                l_sf_part_records.append(self._get_part_prefix(self.working_folder, chrm, i_part) +
+                                         global_values.CLIP_RECORD_NPY_SUFFIX)
+        merge_clip_records(l_sf_part_records, self._get_clip_record_file(self.working_folder))
+        save_bam_stamp(self._get_clip_record_file(self.working_folder) + global_values.BAM_STAMP_SUFFIX, self.sf_bam)
+
+        #stitch the units of each chromosome back together
+        xstore = XEvidenceStore(self._get_evidence_folder(), self.sf_bam)
+        #the discordant reads of the scanned windows are also saved to the sidecar
+        xsidecar = XDiscSidecar(self._get_evidence_folder(), self.sf_bam)
+        xsidecar.clean()
+        for chrm in m_chrm_n_parts:
+            xstore.merge_chrm_parts(chrm, m_chrm_n_parts[chrm])
+            a_reads, a_windows = xstore.get_chrm(chrm)
+            xsidecar.save_chrm(chrm, select_disc_reads(a_reads, references.index(chrm)), a_windows)
+            l_counts = []
+            for i_part in range(m_chrm_n_parts[chrm]):
+                a_part_pos, sf_part_pos = load_clip_pos(self._get_part_prefix(self.working_folder, chrm, i_part),
+                                                        CLIP_POS_FIELDS_LOCUS)
+                if a_part_pos is None:
+                    print("Error: Position file for chrom {0} part {1} doesn't exist!!!!".format(chrm, i_part))
+                    continue
+                l_counts.append(a_part_pos)
+                os.remove(sf_part_pos)
+            #clips of one position may come from two units, so the cutoff is applied after summing them up
+            a_clip_pos = merge_clip_pos(l_counts, CLIP_POS_FIELDS_LOCUS)
+            ####set a cutoff for the total number of clipped ones
+            a_clip_pos = a_clip_pos[(a_clip_pos["lclip"] + a_clip_pos["rclip"]) >= i_clip_cutoff]
+            save_clip_pos(self.working_folder + chrm + global_values.CLIP_POS_NPY_SUFFIX, a_clip_pos)
+            #the clips resolved by the "SA" tag are added to the realignment counts of the chromosome
+            sf_sa_pos = self.working_folder + chrm + global_values.CLIP_SA_POS_NPY_SUFFIX
+            if global_values.CLIP_SA_FAST_PATH == True:
+                l_sa_counts = []
+                for i_part in range(m_chrm_n_parts[chrm]):
+                    a_part_sa, sf_part_sa = load_clip_pos(self._get_part_prefix(self.working_folder, chrm, i_part),
+                                                          CLIP_SA_FIELDS, global_values.CLIP_SA_POS_NPY_SUFFIX)
+                    if a_part_sa is None:
+                        continue
+                    l_sa_counts.append(a_part_sa)
+                    os.remove(sf_part_sa)
+                save_clip_pos(sf_sa_pos, merge_clip_pos(l_sa_counts, CLIP_SA_FIELDS))
+            elif os.path.isfile(sf_sa_pos) == True:#from an earlier run, all the clipped parts are realigned this time
+                os.remove(sf_sa_pos)
+        #all chromosomes are scanned, mark the evidence store and sidecar as available for the later steps
+        xstore.save_references(references)
+        xsidecar.save_info()
+
         #soft_link clip pos
-        for rcd in l_chrm_records:
-            sf_clip_pos = self.working_folder + rcd[0] + global_values.CLIP_POS_SUFFIX
-            sf_pub_pos=sf_pub_folder + rcd[0] + global_values.CLIP_POS_SUFFIX
+        for chrm in m_chrm_n_parts:
+            sf_clip_pos = self.working_folder + chrm + global_values.CLIP_POS_NPY_SUFFIX
+            sf_pub_pos=sf_pub_folder + chrm + global_values.CLIP_POS_NPY_SUFFIX
             if os.path.islink(sf_pub_pos)==True or os.path.isfile(sf_pub_pos)==True:
                 os.remove(sf_pub_pos)
             cmd="ln -s {0} {1}".format(sf_clip_pos, sf_pub_folder)
             Popen(cmd, shell=True, stdout=PIPE).communicate()
-            
-        with open(sf_all_clip_fq_ori, "w") as fout_all:
-            for chrm in references:
-                sf_clip_fq = self.working_folder + chrm + global_values.CLIP_FQ_SUFFIX
-                if os.path.isfile(sf_clip_fq) == False:
-                    continue
-                with open(sf_clip_fq) as fin_clip:
-                    for line in fin_clip:
-                        fout_all.write(line)
-                os.remove(sf_clip_fq)#clean the temporary file
+
+    #outputs of one scan unit of the chromosome
+    def _get_part_prefix(self, working_folder, chrm, i_part):
+        return working_folder + "{0}.part{1}".format(chrm, i_part)
+
+    #provenance of the clipped parts of the bam, saved next to the clipped parts file
+    def _get_clip_record_file(self, working_folder):
+        return working_folder + get_bam_key(self.sf_bam) + global_values.CLIP_RECORD_NPY_SUFFIX
+
+    ####the families (mask in bit order of: Alu, L1, SVA) of the annotated repeats the clipped part is aligned to,
+    ####according to the supplementary alignments in the "SA" tag. Same as the realignment, at least 3/4 of the clipped
+    ####part should be aligned, and the aligned region (both ends) should be within the repeat. Return 0 if none.
+    def _get_sa_clip_families(self, algnmt, b_left, n_clip, xrmsk_index, xregistry, re_cigar):
+        if algnmt.has_tag("SA") == False:
+            return 0
+        n_query = algnmt.infer_read_length()
+        if n_query is None:
+            return 0
+        i_clip_start = 0
+        i_clip_end = n_clip
+        if b_left == False:
+            i_clip_start = n_query - n_clip
+            i_clip_end = n_query
+        i_mask = 0
+        for s_sa in algnmt.get_tag("SA").split(";"):
+            fields = s_sa.split(",")
+            if len(fields) < 6:
+                continue
+            sa_tid = xregistry.get_tid(fields[0])
+            sa_pos = int(fields[1]) - 1
+            l_sa_cigar = re_cigar.findall(fields[3])
+            if len(l_sa_cigar) == 0:
+                continue
+            i_lead_clip = 0
+            if l_sa_cigar[0][1] == "S" or l_sa_cigar[0][1] == "H":
+                i_lead_clip = int(l_sa_cigar[0][0])
+            n_aligned = 0
+            n_ref = 0
+            for (s_len, s_op) in l_sa_cigar:
+                if s_op in "MI=X":
+                    n_aligned += int(s_len)
+                if s_op in "MDN=X":
+                    n_ref += int(s_len)
+            #aligned part in the orientation of the read in this alignment
+            i_start = i_lead_clip
+            i_end = i_lead_clip + n_aligned
+            if (fields[2] == "-") != algnmt.is_reverse:
+                i_start = n_query - (i_lead_clip + n_aligned)
+                i_end = n_query - i_lead_clip
+            n_overlap = min(i_end, i_clip_end) - max(i_start, i_clip_start)
+            if n_overlap * 4 < n_clip * 3:
+                continue
+            i_start_mask, t_rep_start = xrmsk_index.find_families_tid(sa_tid, sa_pos)
+            i_end_mask, t_rep_start = xrmsk_index.find_families_tid(sa_tid, sa_pos + n_ref - 1)
+            i_mask |= (i_start_mask & i_end_mask)
+        return i_mask
+
+    ####count the clip resolved by the "SA" tag as realigned to each of the families
+    def _add_sa_clip(self, xsa_counter, map_pos, b_left, i_sa_mask):
+        for i_family in range(3):#Alu, L1, SVA
+            if i_sa_mask & (1 << i_family):
+                if b_left == True:
+                    xsa_counter.add(map_pos, 2 * i_family)
+                else:
+                    xsa_counter.add(map_pos, 2 * i_family + 1)
 
 
     # YW 2021/10/07 to modularize collect_clip_info_and_parts_by_chrm, so we can fix errors with reads with left and right clipped sequences and left clip seq not passing the filter
@@ -459,214 +605,194 @@ class ClipReadInfo():
             return False
         return True
     
-    def _write_clipped_parts(self, L_R, b_first, l_query_quality, query_name, mate_chrm, mate_pos, chrm, map_pos, f_clip_fq, clipped_seq):
-        # left clipped
+    ####the clipped part is named by its record id, the provenance is saved in the record table of the unit
+    def _write_clipped_parts(self, L_R, b_first, l_query_quality, query_name, mate_tid, mate_pos, tid, map_pos, f_clip_fq,
+                             clipped_seq, xrecord_writer):
         clipped_qulity = self._cvt_to_Ascii_quality(l_query_quality)
-        clipped_rname = global_values.SEPARATOR.join([query_name, mate_chrm, str(mate_pos), ""])
-        if L_R == "L":
-            s_tmp = "{0}{1}{2}{3}{4}{5}2".format(chrm, global_values.SEPARATOR, map_pos, global_values.SEPARATOR,
-                                             global_values.FLAG_LEFT_CLIP, global_values.SEPARATOR)
-            if b_first:
-                s_tmp = "{0}{1}{2}{3}{4}{5}1".format(chrm, global_values.SEPARATOR, map_pos, global_values.SEPARATOR,
-                                                 global_values.FLAG_LEFT_CLIP, global_values.SEPARATOR)
-        else:
-            s_tmp = "{0}{1}{2}{3}{4}{5}2".format(chrm, global_values.SEPARATOR, map_pos, global_values.SEPARATOR,
-                                             global_values.FLAG_RIGHT_CLIP, global_values.SEPARATOR)
-            if b_first:
-                s_tmp = "{0}{1}{2}{3}{4}{5}1".format(chrm, global_values.SEPARATOR, map_pos, global_values.SEPARATOR,
-                                                 global_values.FLAG_RIGHT_CLIP, global_values.SEPARATOR)
-        clipped_rname += s_tmp
+        clipped_rname = xrecord_writer.add(tid, map_pos, mate_tid, mate_pos, L_R == "L", b_first, query_name)
 
         f_clip_fq.write("".join(["@", clipped_rname, "\n"]))
         f_clip_fq.write("".join([clipped_seq, "\n+\n"]))
         f_clip_fq.write("".join([clipped_qulity, "\n"]))
 
+    ####collect the clip info and clipped parts of one scan unit (part of the loci windows of one chromosome)
     def collect_clip_info_and_parts_by_chrm(self, record):
         chrm = record[0]
-        pos_list = [x[:-1] for x in record[1]]
+        focal_windows, l_scan, i_prev_end, i_part = record[1] #scan unit planned by the main process
         sf_bam = record[2]
         working_folder = record[3]
-        sf_annotation_Alu = record[4]
-        sf_annotation_L1 = record[5]
-        sf_annotation_SVA = record[6]
-        b_with_chr = record[7]
-        i_clip_cutoff = int(record[8])
-        b_se = record[9] #whether this is single end reads
-        sf_clip_fq = working_folder + chrm + global_values.CLIP_FQ_SUFFIX  # this is to save the clipped part for re-alignment
+        b_se = record[4] #whether this is single end reads
+        sf_rmsk_index = record[5] #Alu, L1 and SVA annotations combined by the main process
+        i_unit = record[6]
+        sf_part_prefix = self._get_part_prefix(working_folder, chrm, i_part)
+        sf_clip_fq = sf_part_prefix + global_values.CLIP_FQ_SUFFIX  # this is to save the clipped part for re-alignment
         f_clip_fq = open(sf_clip_fq, "w")
 ####
-        xannotation_Alu = XAnnotation(sf_annotation_Alu)
-        xannotation_Alu.set_with_chr(b_with_chr)
-        xannotation_L1 = XAnnotation(sf_annotation_L1)
-        xannotation_L1.set_with_chr(b_with_chr)
-        xannotation_SVA = XAnnotation(sf_annotation_SVA)
-        xannotation_SVA.set_with_chr(b_with_chr)
-        #xannotation.load_rmsk_annotation()
-        i_min_copy_len=0
-        i_boundary_extnd=0
-        # if global_values.IS_CALL_SVA==True:
-        #     i_boundary_extnd=global_values.SVA_ANNOTATION_EXTND
-        xannotation_Alu.load_rmsk_annotation_with_extnd_with_lenth_cutoff(i_boundary_extnd, i_min_copy_len)
-        xannotation_Alu.index_rmsk_annotation_interval_tree()
-        xannotation_L1.load_rmsk_annotation_with_extnd_with_lenth_cutoff(i_boundary_extnd, i_min_copy_len)
-        xannotation_L1.index_rmsk_annotation_interval_tree()
-        xannotation_SVA.load_rmsk_annotation_with_extnd_with_lenth_cutoff(global_values.SVA_ANNOTATION_EXTND, i_min_copy_len)
-        xannotation_SVA.index_rmsk_annotation_interval_tree()
-        xpolyA=PolyA()
+        #one lookup gives the hit families, in bit order of: Alu, L1, SVA
+        xrmsk_index = XMultiFamilyIndex(sf_rmsk_index)
         
         
         samfile = pysam.AlignmentFile(sf_bam, "rb", reference_filename=self.sf_reference)
-        m_clip_pos = {}
+        xclip_counter = XClipPosCounter(CLIP_POS_FIELDS_LOCUS)
+        b_sa_fast_path = global_values.CLIP_SA_FAST_PATH
+        xsa_counter = XClipPosCounter(CLIP_SA_FIELDS) #clipped parts resolved by the "SA" tag, not realigned
+        re_cigar = re.compile(r"(\d+)([MIDNSHP=X])")
         m_chrm_id_name = self._get_chrm_id_name(samfile)
-        for insertion_pos in pos_list:
-            try: # 2021/11/29 added this try except to deal with input with both start and end positions
-                int(insertion_pos)
-                start_pos = insertion_pos - global_values.NEARBY_REGION
-                end_pos = insertion_pos + global_values.NEARBY_REGION + 1
-            except TypeError:
-                start_pos, end_pos = insertion_pos
-            if start_pos <= 0:
-                start_pos = 1
-            
-            for algnmt in samfile.fetch(chrm, start_pos, end_pos):  ##fetch reads mapped to "chrm"
-                ##here need to skip the secondary and supplementary alignments?
-                # YW 2021/10/02 uncomment the first if statement below
-                if algnmt.is_secondary or algnmt.is_supplementary:
-                    continue
-                if algnmt.is_duplicate == True:  ##duplicate
-                    continue
-                b_first = True
-                if algnmt.is_read2 == True:
-                    b_first = False
-                if algnmt.is_unmapped == True:  # unmapped
-                    continue
-                l_cigar = algnmt.cigar
-                if len(l_cigar) < 1:  # wrong alignment
-                    continue
-                if len(l_cigar) == 1 and l_cigar[0][0] == 0:  ##fully mapped
-                    continue
-                if algnmt.mapping_quality < global_values.MINIMUM_CLIP_MAPQ:#by default this is set to 12
-                    continue
+        xrecord_writer = XClipRecordWriter(i_unit)
+        xregistry = get_chrom_registry(sf_bam, self.sf_reference, samfile)
+        xrmsk_index.bind_registry(xregistry) #mates are queried by tid
+        tid = xregistry.get_tid(chrm)
+        #nearby loci are coalesced into one fetch window, so each read is streamed (and counted) only once
+        #the reads around the loci are also saved to the evidence store for the disc, depth and genotype steps
+        xscanner = XEvidenceScanner(self._get_evidence_folder(), sf_bam)
+        ##reads overlap the loci windows
+        for algnmt in xscanner.iter_scan_windows(samfile, chrm, focal_windows, l_scan, i_prev_end, i_part):
+            ##here need to skip the secondary and supplementary alignments?
+            # YW 2021/10/02 uncomment the first if statement below
+            if algnmt.is_secondary or algnmt.is_supplementary:
+                continue
+            if algnmt.is_duplicate == True:  ##duplicate
+                continue
+            b_first = True
+            if algnmt.is_read2 == True:
+                b_first = False
+            if algnmt.is_unmapped == True:  # unmapped
+                continue
+            l_cigar = algnmt.cigar
+            if len(l_cigar) < 1:  # wrong alignment
+                continue
+            if len(l_cigar) == 1 and l_cigar[0][0] == 0:  ##fully mapped
+                continue
+            if algnmt.mapping_quality < global_values.MINIMUM_CLIP_MAPQ:#by default this is set to 12
+                continue
     ####
-                if algnmt.next_reference_id not in m_chrm_id_name:
-                    continue
-                
-                map_pos = algnmt.reference_start
-                mate_chrm = '*'
-                mate_pos = 0
+            if algnmt.next_reference_id not in m_chrm_id_name:
+                continue
+            
+            map_pos = algnmt.reference_start
+            mate_tid = -1
+            mate_pos = 0
+    
+            if algnmt.mate_is_unmapped == False and algnmt.next_reference_id>=0:
+                mate_tid = algnmt.next_reference_id
+                mate_pos = algnmt.next_reference_start
+            
+            # YW 2021/10/02 added from collect_clipped_parts_by_chrm
+            query_name = algnmt.query_name
+            query_seq = algnmt.query_sequence
+            query_quality = algnmt.query_qualities
+            # print mate_tid, mate_pos #################################################################################
+            b_mate_in_rep_Alu, b_mate_in_rep_L1, b_mate_in_rep_SVA = False, False, False
+            #b_mate_in_rep, rep_start_pos = xannotation.is_within_repeat_region(mate_chrm, mate_pos)
+            if b_se == False:
+                i_rep_mask, t_rep_start = xrmsk_index.find_families_tid(mate_tid, mate_pos)
+                b_mate_in_rep_Alu = (i_rep_mask & 1) != 0
+                b_mate_in_rep_L1 = (i_rep_mask & 2) != 0
+                b_mate_in_rep_SVA = (i_rep_mask & 4) != 0
     
-                if algnmt.mate_is_unmapped == False and algnmt.next_reference_id>=0:
-                    mate_chrm = algnmt.next_reference_name
-                    mate_pos = algnmt.next_reference_start
+            # print b_mate_in_rep, rep_start_pos #######################################################################
+            if l_cigar[0][0] == 4 :  # left clipped
+                xclip_counter.add(map_pos, 0)
+                if b_mate_in_rep_Alu:
+                    xclip_counter.add(map_pos, 2)
+                if b_mate_in_rep_L1:
+                    xclip_counter.add(map_pos, 3)
+                if b_mate_in_rep_SVA:
+                    xclip_counter.add(map_pos, 4)
                 
-                # YW 2021/10/02 added from collect_clipped_parts_by_chrm
-                query_name = algnmt.query_name
-                query_seq = algnmt.query_sequence
-                query_quality = algnmt.query_qualities
-                # print mate_chrm, mate_pos ################################################################################
-                b_mate_in_rep_Alu, b_mate_in_rep_L1, b_mate_in_rep_SVA = False, False, False
-                rep_start_pos_Alu, rep_start_pos_L1, rep_start_pos_SVA = 0, 0, 0
-                #b_mate_in_rep, rep_start_pos = xannotation.is_within_repeat_region(mate_chrm, mate_pos)
-                if b_se == False:
-                    b_mate_in_rep_Alu, rep_start_pos_Alu = xannotation_Alu.is_within_repeat_region_interval_tree(mate_chrm, mate_pos)
-                    b_mate_in_rep_L1, rep_start_pos_L1 = xannotation_L1.is_within_repeat_region_interval_tree(mate_chrm, mate_pos)
-                    b_mate_in_rep_SVA, rep_start_pos_SVA = xannotation_SVA.is_within_repeat_region_interval_tree(mate_chrm, mate_pos)
+                # YW 2021/10/02 commented out below
+                # if algnmt.is_supplementary or algnmt.is_secondary:  ###secondary and supplementary are not considered
+                #     continue
+                
+                #######################################################################
+                # YW 2021/10/02 copied below from collect_clipped_parts_by_chrm
+                clipped_seq = query_seq[:l_cigar[0][1]]
+                len_clip_seq=len(clipped_seq)
+                for ch in query_seq:
+                    if ch=="N":
+                        len_clip_seq -= 1
+                l_query_quality = query_quality[:l_cigar[0][1]]
+                pass_filter = self._filter_clipped_parts(len_clip_seq, clipped_seq, l_query_quality)
+                if pass_filter and b_sa_fast_path:
+                    i_sa_mask = self._get_sa_clip_families(algnmt, True, l_cigar[0][1], xrmsk_index, xregistry,
+                                                           re_cigar)
+                    if i_sa_mask != 0:
+                        self._add_sa_clip(xsa_counter, map_pos, True, i_sa_mask)
+                        pass_filter = False
+                if pass_filter:
+                    self._write_clipped_parts("L", b_first, l_query_quality, query_name, mate_tid, mate_pos, tid, map_pos,
+                                              f_clip_fq, clipped_seq, xrecord_writer)
+                #######################################################################
     
-                # print b_mate_in_rep, rep_start_pos #######################################################################
-                if l_cigar[0][0] == 4 :  # left clipped
-                    if map_pos not in m_clip_pos:
-                        m_clip_pos[map_pos] = [1, 0, 0, 0, 0]
+            if l_cigar[-1][0] == 4:  # right clipped
+                ##calculate the exact clip position
+                for (type, lenth) in l_cigar[:-1]:
+                    if type == 4 or type == 5 or type == 1:  # (1 for insertion)
+                        continue
                     else:
-                        m_clip_pos[map_pos][0] += 1
-                    if b_mate_in_rep_Alu:
-                        m_clip_pos[map_pos][2] += 1
-                    if b_mate_in_rep_L1:
-                        m_clip_pos[map_pos][3] += 1
-                    if b_mate_in_rep_SVA:
-                        m_clip_pos[map_pos][4] += 1
-                    
-                    # YW 2021/10/02 commented out below
-                    # if algnmt.is_supplementary or algnmt.is_secondary:  ###secondary and supplementary are not considered
-                    #     continue
-                    
-                    #######################################################################
-                    # YW 2021/10/02 copied below from collect_clipped_parts_by_chrm
-                    clipped_seq = query_seq[:l_cigar[0][1]]
-                    len_clip_seq=len(clipped_seq)
-                    for ch in query_seq:
-                        if ch=="N":
-                            len_clip_seq -= 1
-                    l_query_quality = query_quality[:l_cigar[0][1]]
-                    pass_filter = self._filter_clipped_parts(len_clip_seq, clipped_seq, l_query_quality)
-                    if pass_filter:
-                        self._write_clipped_parts("L", b_first, l_query_quality, query_name, mate_chrm, mate_pos, chrm, map_pos, f_clip_fq, clipped_seq)
-                    #######################################################################
-    
-                if l_cigar[-1][0] == 4:  # right clipped
-                    ##calculate the exact clip position
-                    for (type, lenth) in l_cigar[:-1]:
-                        if type == 4 or type == 5 or type == 1:  # (1 for insertion)
-                            continue
-                        else:
-                            map_pos += lenth
+                        map_pos += lenth
     
-                    if map_pos not in m_clip_pos:
-                        m_clip_pos[map_pos] = [0, 1, 0, 0, 0]
-                    else:
-                        m_clip_pos[map_pos][1] += 1
-                    if b_mate_in_rep_Alu:
-                        m_clip_pos[map_pos][2] += 1
-                    if b_mate_in_rep_L1:
-                        m_clip_pos[map_pos][3] += 1
-                    if b_mate_in_rep_SVA:
-                        m_clip_pos[map_pos][4] += 1
-                    
-                    #######################################################################
-                    # YW 2021/10/02 copied below from collect_clipped_parts_by_chrm
-                    clip_start_pos = -1 * l_cigar[-1][1]
-                    clipped_seq = query_seq[clip_start_pos:]
-                    len_clip_seq = len(clipped_seq)
-                    for ch in query_seq:
-                        if ch=="N":
-                            len_clip_seq -= 1
-                    
-                    l_query_quality = query_quality[clip_start_pos:]
-                    pass_filter = self._filter_clipped_parts(len_clip_seq, clipped_seq, query_quality[clip_start_pos:])
-                    if pass_filter:
-                        self._write_clipped_parts("R", b_first, l_query_quality, query_name, mate_chrm, mate_pos, chrm, map_pos, f_clip_fq, clipped_seq)
-                    ##################################################################
-
-        sf_clip_pos = working_folder + chrm + global_values.CLIP_POS_SUFFIX
-        with open(sf_clip_pos, "w") as fout_clip_pos:
-            for pos in m_clip_pos:
-                i_all_clip = m_clip_pos[pos][0] + m_clip_pos[pos][1]
-                if i_all_clip >= i_clip_cutoff:  ####set a cutoff for the total number of clipped ones
-                    fout_clip_pos.write("\t".join([str(pos), str(m_clip_pos[pos][0]), str(m_clip_pos[pos][1]),
-                                                   str(m_clip_pos[pos][2]), str(m_clip_pos[pos][3]), str(m_clip_pos[pos][4])+"\n"]))
+                xclip_counter.add(map_pos, 1)
+                if b_mate_in_rep_Alu:
+                    xclip_counter.add(map_pos, 2)
+                if b_mate_in_rep_L1:
+                    xclip_counter.add(map_pos, 3)
+                if b_mate_in_rep_SVA:
+                    xclip_counter.add(map_pos, 4)
+                
+                #######################################################################
+                # YW 2021/10/02 copied below from collect_clipped_parts_by_chrm
+                clip_start_pos = -1 * l_cigar[-1][1]
+                clipped_seq = query_seq[clip_start_pos:]
+                len_clip_seq = len(clipped_seq)
+                for ch in query_seq:
+                    if ch=="N":
+                        len_clip_seq -= 1
+                
+                l_query_quality = query_quality[clip_start_pos:]
+                pass_filter = self._filter_clipped_parts(len_clip_seq, clipped_seq, query_quality[clip_start_pos:])
+                if pass_filter and b_sa_fast_path:
+                    i_sa_mask = self._get_sa_clip_families(algnmt, False, l_cigar[-1][1], xrmsk_index, xregistry,
+                                                           re_cigar)
+                    if i_sa_mask != 0:
+                        self._add_sa_clip(xsa_counter, map_pos, False, i_sa_mask)
+                        pass_filter = False
+                if pass_filter:
+                    self._write_clipped_parts("R", b_first, l_query_quality, query_name, mate_tid, mate_pos, tid, map_pos,
+                                              f_clip_fq, clipped_seq, xrecord_writer)
+                ##################################################################
+
+        #the cutoff is applied when the units of the chromosome are stitched together
+        save_clip_pos(sf_part_prefix + global_values.CLIP_POS_NPY_SUFFIX, xclip_counter.get_counts())
+        if b_sa_fast_path:
+            save_clip_pos(sf_part_prefix + global_values.CLIP_SA_POS_NPY_SUFFIX, xsa_counter.get_counts())
+        xrecord_writer.save(sf_part_prefix + global_values.CLIP_RECORD_NPY_SUFFIX)
         samfile.close()
         # YW 2021/10/02 copied below from collect_clipped_parts_by_chrm
         f_clip_fq.close()
+        return sf_clip_fq
 ####
     ####This function return:
     ########1. dictionary of clip position, ##in format {chrm: {map_pos: (left_cnt, right_cnt)}}
     def collect_clip_positions(self, sf_annotation, i_clip_cutoff, b_se, sf_pub_folder):
-        bam_info = BamInfo(self.sf_bam, self.sf_reference)
-        b_with_chr = bam_info.is_chrm_contain_chr()
         samfile = pysam.AlignmentFile(self.sf_bam, "rb", reference_filename=self.sf_reference)
         references = samfile.references
         xchrom=XChromosome()
         l_chrm_records = []
+        sf_rmsk_index = compile_rmsk_index(self.working_folder, [sf_annotation])
         for chrm in references:
             if xchrom.is_decoy_contig_chrms(chrm) == True:  ###decoy sequnces and contigs are not considered
                 continue
-            l_chrm_records.append((chrm, self.sf_bam, self.working_folder, sf_annotation, b_with_chr, i_clip_cutoff,
-                                   b_se))
+            l_chrm_records.append((chrm, self.sf_bam, self.working_folder, i_clip_cutoff, b_se, sf_rmsk_index))
         samfile.close()
 
+        xsidecar = XDiscSidecar(self._get_evidence_folder(), self.sf_bam)
+        xsidecar.clean()
         pool = Pool(self.n_jobs)
         pool.map(unwrap_self_cnt_clip_pos, list(zip([self] * len(l_chrm_records), l_chrm_records)), 1)
         pool.close()
         pool.join()
+        xsidecar.save_info()
 
         #soft_link clip pos
         for rcd in l_chrm_records:
@@ -1005,6 +1131,7 @@ class ClipReadInfo():
         sf_sam_L1 = record[2]
         sf_sam_SVA = record[3]
         working_folder = record[4]
+        ref_tid = record[5]
 
         ####clip positions for specific chrm
         # sf_clip_pos = working_folder + ref_chrm + global_values.CLIP_POS_SUFFIX
@@ -1015,8 +1142,18 @@ class ClipReadInfo():
         sf_out_clip_pos = working_folder + ref_chrm + global_values.CLIP_RE_ALIGN_POS_SUFFIX
 
         m_sites_chrm = {}
+        #clips resolved by the "SA" tag when collecting, they are not in the realignments
+        a_sa_pos, sf_sa_pos = load_clip_pos(working_folder + ref_chrm, CLIP_SA_FIELDS, global_values.CLIP_SA_POS_NPY_SUFFIX)
+        if a_sa_pos is not None:
+            for rcd in a_sa_pos.tolist():
+                m_sites_chrm[rcd[0]] = list(rcd[1:])
+        #the clipped parts are named by record id, and the clip position and side are looked up in the record table
+        sf_record_table = self._get_clip_record_file(working_folder)
+        xrecord_table = XClipRecordTable(sf_record_table, self.sf_bam)
+        m_rep_col = {"Alu": 0, "L1": 2, "SVA": 4}
         def run_cnt_clip_part_aligned_to_rep_by_chrm_helper(sf_sam, rep_type): # YW 2021/03/18 added to avoid duplicating code
-            nonlocal m_sites_chrm # so we can change m_sites_chrm
+            l_sites = [] #(ori_mpos, b_left, index in l_rids), index is -1 for the names of earlier runs
+            l_rids = []
             samfile = pysam.AlignmentFile(sf_sam, "r")
             for algnmt in samfile.fetch():  ##fetch reads mapped to "chrm"
                 ##here need to skip the secondary and supplementary alignments?
@@ -1028,13 +1165,15 @@ class ClipReadInfo():
                     continue
     
                 qname = algnmt.query_name
-                qname_fields = qname.split(global_values.SEPARATOR)
-                # chrm, map_pos, global_values.FLAG_LEFT_CLIP, first_read
-                ori_chrm = qname_fields[-4]  #############check reverse-complementary consistent here ??????????????
-                ori_mpos = int(qname_fields[-3])
-    
-                if ori_chrm != ref_chrm:  ###not the interesting chromosome
-                    continue
+                b_record = xrecord_table.is_record_name(qname)
+                if b_record == False:
+                    qname_fields = qname.split(global_values.SEPARATOR)
+                    # chrm, map_pos, global_values.FLAG_LEFT_CLIP, first_read
+                    ori_chrm = qname_fields[-4]  #############check reverse-complementary consistent here ??????????????
+                    ori_mpos = int(qname_fields[-3])
+        
+                    if ori_chrm != ref_chrm:  ###not the interesting chromosome
+                        continue
     
                 l_cigar = algnmt.cigar
                 if len(l_cigar) < 1:  # wrong alignment
@@ -1075,45 +1214,37 @@ class ClipReadInfo():
                 if n_map < (n_total * 3 / 4):  ########################require at least 3/4 of the seq is mapped !!!!!!!!!!!
                     continue
     
+                if b_record == True:
+                    l_sites.append((-1, True, len(l_rids)))
+                    l_rids.append(int(qname))
+                    continue
                 b_left = True
                 if qname_fields[-2] == global_values.FLAG_RIGHT_CLIP:
                     b_left = False
-                
-                # merge counts from Alu, L1, SVA sam files
-                if (ori_mpos in m_sites_chrm) == False:
-                    m_sites_chrm[ori_mpos] = []
-                    if rep_type == "Alu":
-                        if b_left == True:
-                            m_sites_chrm[ori_mpos].extend([1, 0, 0, 0, 0, 0])
-                        else:
-                            m_sites_chrm[ori_mpos].extend([0, 1, 0, 0, 0, 0])
-                    elif rep_type == "L1":
-                        if b_left == True:
-                            m_sites_chrm[ori_mpos].extend([0, 0, 1, 0, 0, 0])
-                        else:
-                            m_sites_chrm[ori_mpos].extend([0, 0, 0, 1, 0, 0])
-                    elif rep_type == "SVA":
-                        if b_left == True:
-                            m_sites_chrm[ori_mpos].extend([0, 0, 0, 0, 1, 0])
-                        else:
-                            m_sites_chrm[ori_mpos].extend([0, 0, 0, 0, 0, 1])
-                else:
-                    if rep_type == "Alu":
-                        if b_left == True:
-                            m_sites_chrm[ori_mpos][0] += 1
-                        else:
-                            m_sites_chrm[ori_mpos][1] += 1
-                    elif rep_type == "L1":
-                        if b_left == True:
-                            m_sites_chrm[ori_mpos][2] += 1
-                        else:
-                            m_sites_chrm[ori_mpos][3] += 1
-                    elif rep_type == "SVA":
-                        if b_left == True:
-                            m_sites_chrm[ori_mpos][4] += 1
-                        else:
-                            m_sites_chrm[ori_mpos][5] += 1      
+                l_sites.append((ori_mpos, b_left, -1))
             samfile.close()
+
+            #look up all the record ids of the file at once
+            if len(l_rids) > 0 and xrecord_table.is_available() == False:
+                print("Error: Record table {0} of the clipped parts doesn't exist!!!!".format(sf_record_table))
+            a_rows, a_found = xrecord_table.lookup(l_rids)
+            l_keep = (a_found & (a_rows["tid"] == ref_tid)).tolist()
+            l_map_pos = a_rows["map_pos"].tolist()
+            l_b_left = a_rows["b_left"].tolist()
+
+            # merge counts from Alu, L1, SVA sam files
+            for (ori_mpos, b_left, i_rid) in l_sites:
+                if i_rid >= 0:
+                    if l_keep[i_rid] == False:###not the interesting chromosome
+                        continue
+                    ori_mpos = l_map_pos[i_rid]
+                    b_left = l_b_left[i_rid]
+                i_col = m_rep_col[rep_type]
+                if b_left == False:
+                    i_col += 1
+                if (ori_mpos in m_sites_chrm) == False:
+                    m_sites_chrm[ori_mpos] = [0, 0, 0, 0, 0, 0]
+                m_sites_chrm[ori_mpos][i_col] += 1
         run_cnt_clip_part_aligned_to_rep_by_chrm_helper(sf_sam_Alu, "Alu")
         run_cnt_clip_part_aligned_to_rep_by_chrm_helper(sf_sam_L1, "L1")
         run_cnt_clip_part_aligned_to_rep_by_chrm_helper(sf_sam_SVA, "SVA")
@@ -1133,10 +1264,10 @@ class ClipReadInfo():
         l_chrm_records = []
         #here filter out those uninterested contigs
         xchrom=XChromosome()
-        for chrm in references:
+        for tid, chrm in enumerate(references):
             if xchrom.is_decoy_contig_chrms(chrm) == True:  ###filter out decoy and other contigs
                 continue
-            l_chrm_records.append((chrm, sf_clip_sam_Alu, sf_clip_sam_L1, sf_clip_sam_SVA, self.working_folder))
+            l_chrm_records.append((chrm, sf_clip_sam_Alu, sf_clip_sam_L1, sf_clip_sam_SVA, self.working_folder, tid))
         samfile.close()
 
         pool = Pool(self.n_jobs)
@@ -1334,37 +1465,7 @@ class ClipReadInfo():
         samfile.close()
 ####
     def merge_clip_positions_locus(self, sf_pclip, sf_out):
-        samfile = pysam.AlignmentFile(self.sf_bam, "rb", reference_filename=self.sf_reference)
-        references = samfile.references
-
-        with open(sf_out, "w") as fout_clip_pos:
-            for chrm in references:
-                ##first, load in the whole file into dict
-                m_realign_pos = {}
-                sf_chrm_re_align_clip_pos = self.working_folder + chrm + global_values.CLIP_RE_ALIGN_POS_SUFFIX
-                if os.path.isfile(sf_chrm_re_align_clip_pos) == True:
-                    with open(sf_chrm_re_align_clip_pos) as fin_realign_clip_chrm:
-                        for line in fin_realign_clip_chrm:
-                            fields = line.split()
-                            m_realign_pos[int(fields[0])] = "\t".join(fields[1:])
-
-                sf_clip_pos = sf_pclip + chrm + global_values.CLIP_POS_SUFFIX
-                if os.path.isfile(sf_clip_pos) == False:
-                    continue
-                with open(sf_clip_pos) as fin_clip_pos:
-                    for line in fin_clip_pos:
-                        fields = line.split()
-                        pos = int(fields[0])
-                        if pos in m_realign_pos:
-                            fout_clip_pos.write(chrm + "\t")
-                            fout_clip_pos.write(line.rstrip() + "\t")
-                            fout_clip_pos.write(m_realign_pos[pos] + "\n")
-                        else:
-                            fout_clip_pos.write(chrm + "\t")
-                            fout_clip_pos.write(line.rstrip() + "\t")
-                            fout_clip_pos.write(([str(0)]*6) + "\n")
-                #os.remove(sf_clip_pos)
-        samfile.close()
+        self.merge_clip_positions_with_cutoff_locus(0, 0, -1, sf_pclip, sf_out)
     ####
     def merge_clip_positions_with_cutoff(self, cutoff_left_clip, cutoff_right_clip, max_cov_cutoff, sf_pclip, sf_out):
         samfile = pysam.AlignmentFile(self.sf_bam, "rb", reference_filename=self.sf_reference)
@@ -1406,7 +1507,9 @@ class ClipReadInfo():
                 os.remove(sf_clip_pos)
         samfile.close()
 
-    ####
+    ####max_cov_cutoff<0 means no cutoff is applied, and the input files are kept
+    ####output is sorted by pos within one block of each chrom (in order of the bam header), as required by the k-way
+    ####merge of bams
     def merge_clip_positions_with_cutoff_locus(self, cutoff_left_clip, cutoff_right_clip, max_cov_cutoff, sf_pclip, sf_out):
         samfile = pysam.AlignmentFile(self.sf_bam, "rb", reference_filename=self.sf_reference)
         references = samfile.references
@@ -1421,30 +1524,25 @@ class ClipReadInfo():
                         for line in fin_realign_clip_chrm:
                             fields = line.split()
                             m_realign_pos[int(fields[0])] = "\t".join(fields[1:])
-                    os.remove(sf_chrm_re_align_clip_pos)
+                    if max_cov_cutoff >= 0:
+                        os.remove(sf_chrm_re_align_clip_pos)
 
-                sf_clip_pos = sf_pclip + chrm + global_values.CLIP_POS_SUFFIX
-                if os.path.isfile(sf_clip_pos) == False:
+                a_clip_pos, sf_clip_pos = load_clip_pos(sf_pclip + chrm, CLIP_POS_FIELDS_LOCUS)
+                if a_clip_pos is None:
                     continue
-                with open(sf_clip_pos) as fin_clip_pos:
-                    for line in fin_clip_pos:
-                        fields = line.split()
-                        pos = int(fields[0])
-                        i_left_clip = int(fields[1])
-                        i_right_clip = int(fields[2])
-                        if i_left_clip < cutoff_left_clip and i_right_clip < cutoff_right_clip:
-                            continue
-                        if (i_left_clip+i_right_clip) > max_cov_cutoff:
-                            continue
-                        if pos in m_realign_pos:
-                            fout_clip_pos.write(chrm + "\t")
-                            fout_clip_pos.write(line.rstrip() + "\t")
-                            fout_clip_pos.write(m_realign_pos[pos] + "\n")
-                        else:
-                            fout_clip_pos.write(chrm + "\t")
-                            fout_clip_pos.write(line.rstrip() + "\t")
-                            fout_clip_pos.write("\t".join([str(0)]*6) + "\n")
-                os.remove(sf_clip_pos)
+                if max_cov_cutoff >= 0:
+                    a_left_clip = a_clip_pos["lclip"]
+                    a_right_clip = a_clip_pos["rclip"]
+                    a_pass = ((a_left_clip >= cutoff_left_clip) | (a_right_clip >= cutoff_right_clip)) \
+                             & ((a_left_clip + a_right_clip) <= max_cov_cutoff)
+                    a_clip_pos = a_clip_pos[a_pass]
+                s_no_realign = "\t".join([str(0)] * 6)
+                for rcd in a_clip_pos.tolist():#(pos, lclip, rclip, Alu, L1, SVA)
+                    fout_clip_pos.write(chrm + "\t")
+                    fout_clip_pos.write("\t".join([str(i_value) for i_value in rcd]) + "\t")
+                    fout_clip_pos.write(m_realign_pos.get(rcd[0], s_no_realign) + "\n")
+                if max_cov_cutoff >= 0:
+                    os.remove(sf_clip_pos)
         samfile.close()
 ####
     def merge_clip_positions_with_cutoff_polyA(
@@ -25,6 +25,16 @@ def set_initial_min_clip_cutoff(nclip):
 
 BWA_REALIGN_CUTOFF = 9
 MINIMUM_POLYA_CLIP=7 #if the clipped part is pure polyA/T, and length is large enough, then keep them
+#opt-in, the clipped parts sharing no k-mer (k is the "-k" of the realignment) with the repeat consensus are passed to
+#bwa as placeholders instead of being aligned, they can't be aligned to it (see x_kmer_prefilter.py)
+REALIGN_PREFILTER = False
+def set_realign_prefilter():
+    global REALIGN_PREFILTER
+    REALIGN_PREFILTER=True
+REALIGN_PREFILTER_MAX_AMBIGUOUS = 2 #consensus with a window of more ambiguous bases (random in the bwa index) isn't screened
+REALIGN_PREFILTER_SUFFIX = ".realign_kmers.npy"
+REALIGN_PREFILTER_BATCH_BASES = 16000000 #bases of the repeat sequences processed at a time when collecting the k-mers
+REALIGN_PREFILTER_BATCH_READS = 100000 #clipped parts screened at a time
 MAX_CLIP_CLIP_LEN = 8
 CLIP_PHRED_SCORE_CUTOFF=15#cutoff phred score
 
@@ -45,12 +55,31 @@ MAX_BKGRND_LOW_MAPQ = 10#if a read has lower than this value mapq, then view as
 MAX_BKGRND_LOW_MAPQ_RATIO=0.1
 
 BWA_PATH = "bwa"
+#opt-in, keep the repeat/flank bwa indexes in shared memory while they are repeatedly aligned to. Only for nodes where
+#no other job uses "bwa shm": bwa finds the indexes by file name only, and "bwa shm -d" drops all of them
+BWA_SHM_PRELOAD = False
+def set_bwa_shm_preload():
+    global BWA_SHM_PRELOAD
+    BWA_SHM_PRELOAD=True
+REALIGN_CACHE = False #reuse the realignments of the same sequences (across bams and reruns), off by default: for reads
+#with several equally good hits, a cached record may report another one of the hits than a fresh bwa run
+def set_realign_cache():
+    global REALIGN_CACHE
+    REALIGN_CACHE=True
+REALIGN_CACHE_FOLDER = "realign_cache/"
+REALIGN_CACHE_SUFFIX = ".realign_cache.db"
+REALIGN_CACHE_BATCH_READS = 100000 #reads looked up at a time
+REALIGN_CACHE_QUERY_SIZE = 500 #sequences per query/insert of the cache database
 SAMTOOLS_PATH = "samtools"
 CLIP_FQ_SUFFIX = ".clipped.fq"
 CLIP_BAM_SUFFIX = ".clipped.sam"
 CLIP_BAM_SUFFIX2 = ".clipped.bam"
 CLIP_POS_SUFFIX = ".clip_pos"
+CLIP_POS_NPY_SUFFIX = ".clip_pos.npy" #clip position counts saved as a binary array
 CLIP_RE_ALIGN_POS_SUFFIX = ".clip_realign_pos"
+CLIP_SA_POS_NPY_SUFFIX = ".clip_sa_pos.npy" #clips resolved by the "SA" tag, counted as realigned
+CLIP_RECORD_NPY_SUFFIX = ".clip_records.npy" #provenance of the clipped parts named by record id
+CLIP_RECORD_UNIT_SHIFT = 32 #record id of a clipped part: (scan unit index << shift) + index in the unit
 LCLIP_FA_SUFFIX = '.lr_clipped.fa'  # for long reads or contigs
 FLAG_LEFT_CLIP = "L"
 FLAG_RIGHT_CLIP = "R"
@@ -74,6 +103,8 @@ LONG_READ="long_read"
 ####originally used x_TEI_locator.py
 MIN_CLIP_FOR_CANDIDATE=2# if a site has left-right clipped reads like (1,1), (1,0), or (0,1), these will be filtered out
 NEARBY_REGION = 50
+LOCUS_FETCH_MERGE_GAP = 500 #loci windows closer than this are fetched together from the alignment (locus mode)
+LOCUS_SCAN_UNITS_PER_JOB = 4 #each chromosome is split into scan units of about (total scan size / (n_jobs * this)) bp
 CLIP_FREQ = 10
 TRIM_CLIP_FREQ = 2
 PEAK_WINDOW = 100
@@ -81,6 +112,23 @@ OUTPUT_BAM_SUFFIX = ".out_bam"
 OUTPUT_BAM_HEADER = ".bam_header.sam"
 CLIP_FOLDER = "clip"
 CLIP_LOCUS_FOLDER = "clip_locus"
+EVIDENCE_FOLDER = "evidence" #single pass evidence store of the locus pipeline, one sub-folder per bam
+EVIDENCE_READS_SUFFIX = ".evidence_reads.npy"
+EVIDENCE_WINDOWS_SUFFIX = ".evidence_windows.npy"
+EVIDENCE_REFERENCES = "references.txt"
+BAM_STAMP_FILE = "bam_stamp.txt" #path, size and mtime of the bam the evidence/sidecar was saved from
+BAM_STAMP_SUFFIX = ".bam_stamp"
+EVIDENCE_SCAN_EXTND = 1500 #scan this far around the loci, so the disc/depth/genotype windows of nearby sites are covered
+DISC_SIDECAR_FOLDER = "disc_sidecar" #discordant reads saved by the clip step, one sub-folder per bam
+DISC_SIDECAR_SUFFIX = ".disc_reads.npy"
+DISC_SIDECAR_WINDOWS_SUFFIX = ".disc_windows.npy"
+DISC_SIDECAR_INFO = "disc_sidecar.info"
+DISC_SIDECAR_MIN_MATE_DIST = 10000 #same chromosome pairs closer than this are not saved in the sidecar
+RMSK_INDEX_SUFFIX = ".rmsk_index.npy" #compiled repeat annotation, memory-mapped by the workers
+RMSK_INDEX_BLOCKS_SUFFIX = ".blocks"
+RMSK_MULTI_INDEX_SUFFIX = ".rmsk_multi_index.npy" #Alu/L1/SVA combined, one lookup gives the hit families
+CLIP_POS_COUNTER_BUFFER = 1000000 #clip events buffered before folding them into the position counts
+SAM_PARSE_CHUNK_SIZE = 32000000 #bytes of sam records parsed by one worker at a time
 DISC_FOLDER = "disc"
 DISC_SUFFIX = '.discord_pos.txt'
 DISC_SUFFIX_FILTER = '.discdt'
@@ -124,6 +172,8 @@ DISC_NAME_SUFFIX = ".disc_names"
 DISC_POS_SUFFIX = ".disc_pos"
 GNTP_FEATURE_SUFFIX=".gntp_features"
 ALLELE_FREQUENCY_SUFFIX = '.af'
+GNTP_SITES_PER_TASK = 64 #candidate sites collected by each pool task, the features are returned to a single writer
+KEEP_SITE_FEATURE_FILES = False #debug only, also save the features of each site (AF of each chrm) to the working folder
 NOT_TRANSDUCTION = "not_transduction"
 ONE_SIDE_FLANKING="may_two_side_with_one_side_on_flanking"
 TWO_SIDE="two_side"
@@ -249,6 +299,12 @@ FORCE_CLEAN=False
 def set_force_clean():
     global FORCE_CLEAN
     FORCE_CLEAN=True
+
+#clipped parts with a supplementary alignment ("SA" tag) within the repeat annotation are counted without realignment
+CLIP_SA_FAST_PATH=False
+def set_clip_sa_fast_path():
+    global CLIP_SA_FAST_PATH
+    CLIP_SA_FAST_PATH=True
 ###############################################################################
 ###############################################################################
 ####originally used in l_asm.py
@@ -275,6 +275,24 @@ def parse_option():
     parser.add_option("--locus_disc", 
                       action="store_true", dest="locus_disc", default=False,
                       help="Extract disc info from predefined loci")
+    parser.add_option("--clip_sa",
+                      action="store_true", dest="clip_sa", default=False,
+                      help="Count the clipped parts with supplementary alignment (SA tag) in repeat annotation "
+                           "without realignment, used with --locus_clip")
+    parser.add_option("--realign_cache",
+                      action="store_true", dest="realign_cache", default=False,
+                      help="Reuse the realignments of the same clipped/discordant sequences across bams and reruns "
+                           "(saved in the working folder). For reads with several equally good hits, a reused record "
+                           "may report another one of the hits than a fresh bwa run")
+    parser.add_option("--realign_prefilter",
+                      action="store_true", dest="realign_prefilter", default=False,
+                      help="Skip aligning the clipped parts that share no k-mer (k is the bwa seed length) with the "
+                           "repeat consensus, as bwa can't align them. The output is not changed, used with --locus_clip")
+    parser.add_option("--bwa_shm",
+                      action="store_true", dest="bwa_shm", default=False,
+                      help="Keep the repeat bwa indexes in shared memory (bwa shm) while they are realigned to. Only use "
+                           "it on nodes where no other job uses bwa shm: bwa finds the indexes by file name only, and "
+                           "they are dropped with \"bwa shm -d\" (which drops all of them) at the end of each step")
     (options, args) = parser.parse_args()
     return (options, args)
 ####
@@ -374,6 +392,12 @@ if __name__ == '__main__':
         global_values.turn_on_check_by_sample()
     if options.sva:
         global_values.turn_on_sva()
+    if options.realign_cache:
+        global_values.set_realign_cache()
+    if options.bwa_shm:
+        global_values.set_bwa_shm_preload()
+    if options.realign_prefilter:
+        global_values.set_realign_prefilter()
 
     b_automatic=True
     if options.user_specific:
@@ -507,6 +531,8 @@ if __name__ == '__main__':
         #i_iniclip=options.iniclip#
         if b_force == True:
             global_values.set_force_clean()
+        if options.clip_sa == True:
+            global_values.set_clip_sa_fast_path()
         site_clip_cutoff=options.siteclip #this is the cutoff for the exact position, use larger value for 10X
         global_values.set_initial_min_clip_cutoff(site_clip_cutoff)
         
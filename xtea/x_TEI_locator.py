@@ -4,11 +4,16 @@
 
 import os
 import sys
+import heapq
 import pysam
 from subprocess import *
 from multiprocessing import Pool
 from clip_read import ClipReadInfo
 from x_annotation import *
+from x_annotation_index import *
+from x_kmer_prefilter import get_realign_prefilter
+from x_disc_sidecar import get_disc_sidecar
+from x_chrom_registry import get_chrom_registry
 from x_alignments import *
 from x_intermediate_sites import *
 from bwa_align import *
@@ -175,6 +180,87 @@ class TE_Multi_Locator():
                     # self.chain_regions(sf_out_merged_sorted, global_values.NEARBY_REGION, cutoff_left_clip, cutoff_right_clip,
                     #                    cutoff_clip_mate_in_rep, sf_out, sf_peak_events)
 
+####
+    ####Merge the per-bam clip files in one streaming k-way pass, and sum the values of the same position.
+    ####Each file has one block for each chromosome (in order of its own bam header), sorted by pos. The bams of a sample
+    ####may list the chromosomes in different orders, so each file is read block by block in the order of l_chrms.
+    ####Return (chrm, {pos: [summed values]}) chromosome by chromosome, in order of l_chrms
+    def _merge_sorted_clip_tmp_by_chrm(self, l_sf_tmp, bam_info, b_with_chr, l_chrms):
+        m_chrm_rank = {}
+        for i_rank, chrm in enumerate(l_chrms):
+            m_chrm_rank[chrm] = i_rank
+        l_fin_tmp = []
+        l_rcd_iters = []
+        for sf_tmp in l_sf_tmp:
+            if os.path.isfile(sf_tmp) == False:
+                print("Errors happen, file {0} doens't exist!".format(sf_tmp))
+                continue
+            l_blocks = self._get_clip_tmp_blocks(sf_tmp, bam_info, b_with_chr, m_chrm_rank)
+            fin_tmp = open(sf_tmp, "rb")
+            l_fin_tmp.append(fin_tmp)
+            l_rcd_iters.append(self._iter_sorted_clip_tmp(fin_tmp, sf_tmp, l_blocks))
+
+        cur_rank = -1
+        m_sites_chrm = {}
+        for (i_rank, pos, l_values) in heapq.merge(*l_rcd_iters):
+            if i_rank != cur_rank:
+                if len(m_sites_chrm) > 0:
+                    yield l_chrms[cur_rank], m_sites_chrm
+                cur_rank = i_rank
+                m_sites_chrm = {}
+            if pos not in m_sites_chrm:
+                m_sites_chrm[pos] = l_values
+            else:
+                ###sum (left-realign, right-realign, mate_in_rep)
+                l_sum = m_sites_chrm[pos]
+                for i_value in range(len(l_values)):
+                    l_sum[i_value] += l_values[i_value]
+        if len(m_sites_chrm) > 0:
+            yield l_chrms[cur_rank], m_sites_chrm
+        for fin_tmp in l_fin_tmp:
+            fin_tmp.close()
+
+    ####byte ranges of the chromosome blocks of one per-bam clip file, in format: [(rank, start, end)], sorted by rank
+    ####blocks of chromosomes not in m_chrm_rank are skipped
+    def _get_clip_tmp_blocks(self, sf_tmp, bam_info, b_with_chr, m_chrm_rank):
+        l_blocks = []
+        i_offset = 0
+        with open(sf_tmp, "rb") as fin_tmp:
+            for line in fin_tmp:
+                s_chrm = line.split(None, 1)[0]
+                if len(l_blocks) == 0 or l_blocks[-1][0] != s_chrm:
+                    l_blocks.append([s_chrm, i_offset, i_offset])
+                i_offset += len(line)
+                l_blocks[-1][2] = i_offset
+        l_rank_blocks = []
+        for (s_chrm, i_start, i_end) in l_blocks:
+            tmp_chrm = bam_info.process_chrm_name(s_chrm.decode(), b_with_chr)
+            if tmp_chrm in m_chrm_rank:
+                l_rank_blocks.append((m_chrm_rank[tmp_chrm], i_start, i_end))
+        l_rank_blocks.sort()
+        return l_rank_blocks
+
+    ####parse the blocks of one per-bam clip file, in the given order
+    ####raise RuntimeError if the records are not sorted (e.g. the positions of a block, or a chromosome in two blocks)
+    def _iter_sorted_clip_tmp(self, fin_tmp, sf_tmp, l_blocks):
+        prev_rank = -1
+        prev_pos = -1
+        for (i_rank, i_start, i_end) in l_blocks:
+            fin_tmp.seek(i_start)
+            i_offset = i_start
+            while i_offset < i_end:
+                line = fin_tmp.readline()
+                i_offset += len(line)
+                fields = line.split()
+                pos = int(fields[1])
+                #the k-way merge needs sorted inputs, otherwise a chromosome would be yielded more than once
+                if i_rank == prev_rank and pos < prev_pos:
+                    raise RuntimeError("{0} is not sorted by (chrom, pos) at {1}:{2}".format(sf_tmp, fields[0].decode(),
+                                                                                          pos))
+                prev_rank = i_rank
+                prev_pos = pos
+                yield (i_rank, pos, [int(value) for value in fields[2:]])
+
 ####
         # new function for locus_clip option
     def collect_clip_info_from_TEI_candidate_sites(self, locus_dict, 
@@ -187,6 +273,9 @@ class TE_Multi_Locator():
         cnt = 0
         s_sample_bam = ""
         b_set = False
+        ####the consensus and copies are aligned to several times for each bam, keep their indexes loaded
+        xbwa_session = XBwaIndexSession()
+        xbwa_session.preload([sf_rep_cns_Alu, sf_rep_cns_L1, sf_rep_cns_SVA, sf_rep_Alu, sf_rep_L1, sf_rep_SVA])
         with open(self.sf_list) as fin_bam_list:
             i_idx_bam=0#indicates which bam this is
             for line in fin_bam_list:  ###for each bam file
@@ -239,6 +328,7 @@ class TE_Multi_Locator():
                                            b_se, cutoff_hit_rep_copy, cutoff_hit_rep_copy, b_cutoff,
                                            sf_new_pub, i_idx_bam, b_force, max_cov, sf_out_tmp)
                 i_idx_bam+=1
+        xbwa_session.close()
 ####
         # get all the chromsomes names
         bam_info = BamInfo(s_sample_bam, self.sf_ref)
@@ -247,36 +337,16 @@ class TE_Multi_Locator():
         
         xfilter = XIntermediateSites()
         xchrom=XChromosome()
+        l_chrms = []
+        for chrm in m_chrms:
+            if xchrom.is_decoy_contig_chrms(chrm) == True:  ###filter out decoy and other contigs
+                continue
+            l_chrms.append(chrm)
+        l_sf_tmp = [self.working_folder + global_values.CLIP_TMP + "{0}".format(i) for i in range(cnt)]
         sf_out_merged = sf_out + "_tmp"
         with open(sf_out_merged, "w") as fout_sites_merged, open(sf_out, "w") as fout_sites:
-            for chrm in m_chrms:  # write out chrm by chrm to save memory
-                if xchrom.is_decoy_contig_chrms(chrm) == True:  ###filter out decoy and other contigs
-                    continue
-                m_sites_chrm = {}
-                for i in range(cnt):
-                    sf_tmp = self.working_folder + global_values.CLIP_TMP + "{0}".format(i)
-                    if os.path.isfile(sf_tmp) == False:
-                        print("Errors happen, file {0} doens't exist!".format(sf_tmp))
-                        continue
-                    with open(sf_tmp) as fin_tmp:
-                        for line in fin_tmp:
-                            fields = line.split()
-                            tmp_chrm = bam_info.process_chrm_name(fields[0], b_with_chr)
-                            if tmp_chrm != chrm:
-                                continue
-                            pos = int(fields[1])
-                            
-                            if pos not in m_sites_chrm:
-                                m_sites_chrm[pos] = []
-                                for value in fields[2:]:
-                                    m_sites_chrm[pos].append(int(value))
-                            else:
-                                i_value = 0
-                                for value in fields[2:]:
-                                    ###sum (left-realign, right-realign, mate_in_rep)
-                                    m_sites_chrm[pos][i_value] += int(value)
-                                    i_value += 1
-
+            # write out chrm by chrm to save memory
+            for chrm, m_sites_chrm in self._merge_sorted_clip_tmp_by_chrm(l_sf_tmp, bam_info, b_with_chr, l_chrms):
                 for pos in m_sites_chrm:
                     fout_sites_merged.write(chrm + "\t" + str(pos) + "\t")
                     fout_sites_merged.write("\t".join([str(i) for i in m_sites_chrm[pos]]) + "\n")
@@ -730,6 +800,7 @@ class TELocator():
         sf_bam_name = os.path.basename(self.sf_bam)
         sf_all_clip_fq = sf_pub_folder + sf_bam_name + CLIP_FQ_SUFFIX
         clip_info.set_working_folder(sf_clip_working_folder)
+        clip_info.set_evidence_folder(self.working_folder) #found by the later steps running in the same folder
         if os.path.islink(sf_all_clip_fq)==False or b_force==True:
             print(("Collected clipped reads file {0} doesn't exist. Generate it now!".format(sf_all_clip_fq)))
             ##collect the clip positions
@@ -792,38 +863,61 @@ class TELocator():
         sf_bam_name = os.path.basename(self.sf_bam)
         sf_all_clip_fq = sf_pub_folder + sf_bam_name + global_values.CLIP_FQ_SUFFIX
         clip_info.set_working_folder(sf_clip_working_folder)
+        clip_info.set_evidence_folder(self.working_folder) #found by the later steps running in the same folder
         sf_all_clip_fq_ori=sf_clip_working_folder+sf_bam_name + global_values.CLIP_FQ_SUFFIX
+        # YW 2021/03/18 add Alu, L1, SVA
+        l_rep_realign = [(sf_rep_cns_Alu, sf_rep_Alu, self.working_folder + sf_bam_name + global_values.CLIP_BAM_SUFFIX + ".Alu"),
+                         (sf_rep_cns_L1, sf_rep_L1, self.working_folder + sf_bam_name + global_values.CLIP_BAM_SUFFIX + ".L1"),
+                         (sf_rep_cns_SVA, sf_rep_SVA, self.working_folder + sf_bam_name + global_values.CLIP_BAM_SUFFIX + ".SVA")]
+        sf_algnmt_Alu = l_rep_realign[0][2]
+        sf_algnmt_L1 = l_rep_realign[1][2]
+        sf_algnmt_SVA = l_rep_realign[2][2]
+        bwa_align = BWAlign(global_values.BWA_PATH, global_values.BWA_REALIGN_CUTOFF, self.n_jobs)
+        bwa_align.set_realign_cache_folder(self.working_folder + global_values.REALIGN_CACHE_FOLDER)
+        ####k-mers of the consensus of each family, the clipped parts sharing none of them can't be aligned to it
+        l_prefilters = [get_realign_prefilter(self.working_folder, [sf_rep_cns], bwa_align.BWA_REALIGN_CUTOFF)
+                        for (sf_rep_cns, sf_rep, sf_algnmt) in l_rep_realign]
         if os.path.islink(sf_all_clip_fq)==False or b_force==True:
             print("Collected clipped reads file {0} doesn't exist. Generate it now!".format(sf_all_clip_fq))
             ##collect the clip positions
             initial_clip_pos_freq_cutoff = global_values.INITIAL_MIN_CLIP_CUTOFF ##########################################################################
             print("Initial minimum clip cutoff is {0}".format(initial_clip_pos_freq_cutoff))
             print("Output info: Collect clipped parts for file ", self.sf_bam)
+            ####align the clipped parts to repeat consensus while they are collected (first stage of the realignment)
+            ####the scan pool and the three aligners share the n_jobs cores: about half of them go to the aligners (at
+            ####least one each), and the rest to the scan. With too few cores, the parts are realigned after the scan
+            print("Output info: Re-align clipped parts for file ", self.sf_bam)
+            n_realign_cores = max(1, (self.n_jobs // 2) // len(l_rep_realign))
+            n_scan_jobs = self.n_jobs - n_realign_cores * len(l_rep_realign)
+            l_realigners = []
+            if n_scan_jobs >= 1:
+                for (sf_rep_cns, sf_rep, sf_algnmt), xprefilter in zip(l_rep_realign, l_prefilters):
+                    l_realigners.append(bwa_align.start_two_stage_realign(sf_rep_cns, sf_algnmt, n_realign_cores,
+                                                                          xprefilter))
+            else:
+                n_scan_jobs = self.n_jobs
             # YW 2021/09/29 can combine collect_clip_info and collect_clipped_parts into one function
             clip_info.collect_clip_info_and_parts(locus_dict, sf_annotation_Alu, sf_annotation_L1, sf_annotation_SVA,
-                            initial_clip_pos_freq_cutoff, b_se, sf_pub_folder, sf_all_clip_fq_ori) ##save clip pos and clipped parts by chrm
+                            initial_clip_pos_freq_cutoff, b_se, sf_pub_folder, sf_all_clip_fq_ori, l_realigners,
+                            n_scan_jobs) ##save clip pos and clipped parts by chrm
             # clip_info.collect_clipped_parts(sf_all_clip_fq_ori)
             
             if os.path.isfile(sf_all_clip_fq)==True or os.path.islink(sf_all_clip_fq)==True:
                 os.remove(sf_all_clip_fq)
             cmd="ln -s {0} {1}".format(sf_all_clip_fq_ori, sf_all_clip_fq)
             self.cmd_runner.run_cmd_small_output(cmd)
+            for xrealigner, (sf_rep_cns, sf_rep, sf_algnmt) in zip(l_realigners, l_rep_realign):
+                bwa_align.finish_two_stage_realign(xrealigner, sf_rep_cns, sf_rep, sf_algnmt)
+            if len(l_realigners) == 0:
+                for (sf_rep_cns, sf_rep, sf_algnmt), xprefilter in zip(l_rep_realign, l_prefilters):
+                    bwa_align.two_stage_realign(sf_rep_cns, sf_rep, sf_all_clip_fq, sf_algnmt, xprefilter)
         else:
             print("Collected clipped reads file {0} already exist!".format(sf_all_clip_fq))
+            ####align the clipped parts to repeat copies
+            print("Output info: Re-align clipped parts for file ", self.sf_bam)
+            for (sf_rep_cns, sf_rep, sf_algnmt), xprefilter in zip(l_rep_realign, l_prefilters):
+                bwa_align.two_stage_realign(sf_rep_cns, sf_rep, sf_all_clip_fq, sf_algnmt, xprefilter)
 ####
-        ####align the clipped parts to repeat copies
-        # YW 2021/03/18 add Alu, L1, SVA
-        sf_algnmt_Alu = self.working_folder + sf_bam_name + global_values.CLIP_BAM_SUFFIX + ".Alu"
-        sf_algnmt_L1 = self.working_folder + sf_bam_name + global_values.CLIP_BAM_SUFFIX + ".L1"
-        sf_algnmt_SVA = self.working_folder + sf_bam_name + global_values.CLIP_BAM_SUFFIX + ".SVA"
-        print("Output info: Re-align clipped parts for file ", self.sf_bam)
-        
-        bwa_align = BWAlign(global_values.BWA_PATH, global_values.BWA_REALIGN_CUTOFF, self.n_jobs)
-        # YW 2021/03/18 add Alu, L1, SVA
-        bwa_align.two_stage_realign(sf_rep_cns_Alu, sf_rep_Alu, sf_all_clip_fq, sf_algnmt_Alu)
-        bwa_align.two_stage_realign(sf_rep_cns_L1, sf_rep_L1, sf_all_clip_fq, sf_algnmt_L1)
-        bwa_align.two_stage_realign(sf_rep_cns_SVA, sf_rep_SVA, sf_all_clip_fq, sf_algnmt_SVA)
-        
         ####cnt number of clipped reads aligned to repeat copies from the re-alignment
         # YW 2021/03/18 add Alu, L1, SVA
         clip_info.cnt_clip_part_aligned_to_rep(sf_algnmt_Alu, sf_algnmt_L1, sf_algnmt_SVA)  ##require at least 3/4 of the seq is mapped !!!!
@@ -872,6 +966,7 @@ class TELocator():
         sf_bam_name = os.path.basename(self.sf_bam)
         sf_all_clip_fq = sf_pub_folder + sf_bam_name + CLIP_FQ_SUFFIX
         clip_info.set_working_folder(sf_clip_working_folder)
+        clip_info.set_evidence_folder(self.working_folder) #found by the later steps running in the same folder
 
         ##collect the clip positions
         initial_clip_pos_freq_cutoff = global_values.INITIAL_MIN_CLIP_CUTOFF  ##########################################################################
@@ -1259,9 +1354,9 @@ class TELocator():
         iextend = int(record[2])###extend some region on both sides in order to collect all barcodes
         i_is = int(record[3])
         f_dev = int(record[4])
-        sf_annotation = record[5]
-        sf_disc_working_folder = record[6]
-        s_suffix = record[7]
+        sf_disc_working_folder = record[5]
+        s_suffix = record[6]
+        sf_rmsk_index = record[7] #compiled from the rmsk annotation by the main process
 
         sf_candidate_list = sf_disc_working_folder + site_chrm1 + s_suffix
         if os.path.exists(sf_candidate_list) == False:
@@ -1274,37 +1369,59 @@ class TELocator():
                 m_candidate_pos[pos] = "\t".join(fields[2:])
 
         bam_info = BamInfo(sf_bam, self.sf_reference)
-        b_with_chr = bam_info.is_chrm_contain_chr()  # indicate whether the bam chrom has "chr" or not
-        m_chrms = bam_info.get_all_reference_names()
+        xregistry = get_chrom_registry(sf_bam, self.sf_reference)
+        b_with_chr = xregistry.is_chrm_contain_chr()  # indicate whether the bam chrom has "chr" or not
         site_chrm = bam_info.process_chrm_name(site_chrm1, b_with_chr)
-        if site_chrm not in m_chrms:
+        if xregistry.get_name(xregistry.get_tid(site_chrm)) != site_chrm:
             return
         # print site_chrm ##########################################################################################
 
-        xannotation = XAnnotation(sf_annotation)
-        xannotation.set_with_chr(b_with_chr)
-        # xannotation.load_rmsk_annotation()
-        # xannotation.index_rmsk_annotation()
-        i_min_copy_len=0
         boundary_extnd=0
         ####For SVA, because the rmsk annotation is bad, so we extend a little bit
         if global_values.IS_CALL_SVA is True:
             boundary_extnd=global_values.SVA_ANNOTATION_EXTND
-        xannotation.load_rmsk_annotation_with_extnd_with_lenth_cutoff(boundary_extnd, i_min_copy_len)
-        xannotation.index_rmsk_annotation_interval_tree()
+        xannotation = XAnnotationIndex(sf_rmsk_index).get_family_view(0, boundary_extnd)
 
         bamfile = pysam.AlignmentFile(sf_bam, "rb", reference_filename=self.sf_reference)
         m_new_candidate_sites = {}
         m_raw_disc_sites={}
         m_chrm_ids=self._get_chrm_id_name(bamfile)
+        xstore = get_evidence_store(self.working_folder, sf_bam) #reads saved by the clip step, if any
+        xsidecar = get_disc_sidecar(self.working_folder, sf_bam) #discordant reads saved by the clip step, if any
+        ####the sites not covered by the sidecar or the evidence store are counted from the bam in one sweep,
+        ####so the reads shared by the windows of nearby sites are fetched only once
+        l_sweep_windows = []
+        m_sweep_idx = {}
+        m_site_store = {} #the sidecar or the evidence store to count from
+        for site_pos in m_candidate_pos:
+            if site_pos < iextend:
+                continue
+            if (xsidecar is not None) and \
+                    xsidecar.can_count_disc(site_chrm, site_pos - iextend, site_pos + iextend, i_is) == True:
+                m_site_store[site_pos] = xsidecar
+                continue
+            if (xstore is not None) and xstore.is_covered(site_chrm, site_pos - iextend, site_pos + iextend) == True:
+                m_site_store[site_pos] = xstore
+                continue
+            m_sweep_idx[site_pos] = len(l_sweep_windows)
+            l_sweep_windows.append((site_pos - iextend, site_pos))
+            l_sweep_windows.append((site_pos + 1, site_pos + iextend))
+        l_sweep_results = bam_info.cnt_discordant_pairs_sweep(bamfile, m_chrm_ids, site_chrm, l_sweep_windows, i_is,
+                                                              f_dev, xannotation)
         for site_pos in m_candidate_pos:  ####candidate site position # structure: {barcode:[alignmts]}
             if site_pos < iextend:
                 continue
 
-            n_left_discdt, n_lraw_disc, l_cluster = bam_info.cnt_discordant_pairs(bamfile, m_chrm_ids, site_chrm, site_pos - iextend,
-                                                          site_pos, i_is, f_dev, xannotation)
-            n_right_discdt, n_rraw_disc, r_cluster = bam_info.cnt_discordant_pairs(bamfile, m_chrm_ids, site_chrm, site_pos + 1,
-                                                           site_pos + iextend, i_is, f_dev, xannotation)
+            if site_pos in m_sweep_idx:
+                i_window = m_sweep_idx[site_pos]
+                n_left_discdt, n_lraw_disc, l_cluster = l_sweep_results[i_window]
+                n_right_discdt, n_rraw_disc, r_cluster = l_sweep_results[i_window + 1]
+            else:
+                xsite_store = m_site_store[site_pos]
+                n_left_discdt, n_lraw_disc, l_cluster = bam_info.cnt_discordant_pairs_from_evidence(xsite_store,
+                                        m_chrm_ids, site_chrm, site_pos - iextend, site_pos, i_is, f_dev, xannotation)
+                n_right_discdt, n_rraw_disc, r_cluster = bam_info.cnt_discordant_pairs_from_evidence(xsite_store,
+                                        m_chrm_ids, site_chrm, site_pos + 1, site_pos + iextend, i_is, f_dev, xannotation)
             m_new_candidate_sites[site_pos] = [str(n_left_discdt), str(n_right_discdt)]
             #if l_cluster[0]==True or r_cluster[0]==True:#for transductions, require at least one side form cluster
             s_lcluster="0"
@@ -1359,13 +1476,15 @@ class TELocator():
         self.output_candidate_sites_by_chrm(m_candidate_sites, sf_disc_working_folder, global_values.DISC_SUFFIX)
         xchrm=XChromosome()
         l_chrm_records = []
+        sf_rmsk_index = compile_rmsk_index(sf_disc_working_folder, [sf_annotation])
         for chrm in m_candidate_sites:
             ###filter out those contigs!!!!!!!
             if xchrm.is_decoy_contig_chrms(chrm)==True:
                 continue
 
             l_chrm_records.append(
-                (chrm, self.sf_bam, iextend, i_is, f_dev, sf_annotation, sf_disc_working_folder, global_values.DISC_SUFFIX))
+                (chrm, self.sf_bam, iextend, i_is, f_dev, sf_disc_working_folder, global_values.DISC_SUFFIX,
+                 sf_rmsk_index))
 
         pool = Pool(self.n_jobs)
         pool.map(unwrap_self_filter_by_discordant_non_barcode, list(zip([self] * len(l_chrm_records), l_chrm_records)), 1)
@@ -4,11 +4,16 @@
 
 import os
 import sys
+import bisect
+from array import array
+import numpy as np
 import pysam
 from x_intermediate_sites import *
 from x_reference import *
 import global_values
 from disc_cluster import *
+from x_evidence_scanner import *
+from x_chrom_registry import get_chrom_registry
 
 #
 def unwrap_self_extract_reads_for_region(arg, **kwarg):
@@ -24,6 +29,7 @@ class BamInfo():#
         self.out_header = None
         self.chrm_id_name = {}
         self.sf_reference=sf_ref
+        self.disc_mate_mask = None #(m_chrm_ids, mask of the mate tids, chromosome registry), see "_get_disc_mate_mask"
         # if the chromosome name in format: chr1, then return true,
 
     def index_reference_name_id(self):
@@ -94,15 +100,10 @@ class BamInfo():#
 ####
     ###Note: hard code here, use mapping quality 20 as cutoff for anchor reads
     def cnt_discordant_pairs(self, bamfile, m_chrm_ids, chrm, start, end, i_is, f_dev, xannotation):
-        n_cnt = 0
-        n_raw_cnt=0 #this save the raw discordant PE pairs, including: abnormal insert size, abnormal direction
         iter_alignmts = bamfile.fetch(chrm, start, end)
-        xchrom = XChromosome()
-        i_max_is=2500
-        if int(i_is+3*f_dev)>i_max_is:
-            i_max_is=int(i_is+3*f_dev)
-
-        m_mate_pos={}
+        #mates of the qualified anchor reads, classified all at once after the loop
+        a_mate_tid = array("q")
+        a_mate_pos = array("q")
         for algnmt in iter_alignmts:
             if algnmt.is_duplicate == True or algnmt.is_supplementary == True:  ##skip duplicate and supplementary ones
                 continue
@@ -114,41 +115,134 @@ class BamInfo():#
                 continue
             if algnmt.next_reference_id<0:
                 continue
-####
-            map_pos=algnmt.reference_start
-            if algnmt.next_reference_id not in m_chrm_ids:
-                continue
-            mate_chrm = algnmt.next_reference_name
-            if xchrom.is_decoy_contig_chrms(mate_chrm) == True:
-                continue
-            mate_pos = algnmt.next_reference_start
-
-            # ####This version consider the discordant event happen within the same chromosome
-            # template_lth = abs(algnmt.template_length)
-            # xalgnmt = XAlignment()
-            # if xalgnmt.is_discordant_pair_no_unmap(chrm, mate_chrm, template_lth, i_is, f_dev):
-            #     b_mate_within_rep, rep_start_mate = xannotation.is_within_repeat_region(mate_chrm, mate_pos)
-            #     if b_mate_within_rep:
-            #         n_cnt+=1
-
-            #####This version only count the number of discordant pairs whose two reads aligned to different chroms
-
-            #####Or on the same chromosome, but aligned quite far away (by default >1M)
-            #Note, here we use "start" to represent the "map_pos" of each read.
-            if (chrm != mate_chrm) or (chrm == mate_chrm and abs(mate_pos - start) > i_is):
-                if (chrm != mate_chrm) or (chrm == mate_chrm and abs(mate_pos - start) > i_max_is):
-                    if mate_chrm not in m_mate_pos:
-                        m_mate_pos[mate_chrm]=[]
-                    m_mate_pos[mate_chrm].append(mate_pos)
-                    n_raw_cnt+=1
-                #b_mate_within_rep, rep_start_mate = xannotation.is_within_repeat_region(mate_chrm, mate_pos)
-                b_mate_within_rep, rep_start_mate = xannotation.is_within_repeat_region_interval_tree(mate_chrm, mate_pos)
-                if b_mate_within_rep:
-                    n_cnt += 1
+            a_mate_tid.append(algnmt.next_reference_id)
+            a_mate_pos.append(algnmt.next_reference_start)
+        return self._cnt_disc_mates(m_chrm_ids, chrm, start, np.frombuffer(a_mate_tid, dtype=np.int64),
+                                    np.frombuffer(a_mate_pos, dtype=np.int64), i_is, f_dev, xannotation)
+
+    ####mates allowed in the discordant counting, indexed by tid: in "m_chrm_ids" and not decoy or contig sequences
+    ####computed once for the reference ids of the bam
+    def _get_disc_mate_mask(self, m_chrm_ids):
+        if (self.disc_mate_mask is None) or (self.disc_mate_mask[0] is not m_chrm_ids):
+            xregistry = get_chrom_registry(self.sf_bam, self.sf_reference)
+            a_mask = np.zeros(xregistry.get_n_references(), dtype=bool)
+            for tid in m_chrm_ids:
+                if xregistry.is_valid_tid(tid) == True:
+                    a_mask[tid] = True
+            a_mask &= xregistry.get_allowed_mask()
+            self.disc_mate_mask = (m_chrm_ids, a_mask, xregistry)
+        return self.disc_mate_mask[1], self.disc_mate_mask[2]
+
+    ####Reduce the mates (tid, pos) of the qualified anchor reads of one window to the discordant counts.
+    ####Same as the per-read checks of the original version: the mates on decoy or unknown sequences are skipped, and
+    ####"start" (of the window) is used as the "map_pos" of each read.
+    ####This version only count the number of discordant pairs whose two reads aligned to different chroms,
+    ####or on the same chromosome, but aligned quite far away (by default >1M).
+    ####The mates are classified with one annotation query per mate chromosome.
+    def _cnt_disc_mates(self, m_chrm_ids, chrm, start, a_mate_tid, a_mate_pos, i_is, f_dev, xannotation):
+        i_max_is=2500
+        if int(i_is+3*f_dev)>i_max_is:
+            i_max_is=int(i_is+3*f_dev)
+        a_mask, xregistry = self._get_disc_mate_mask(m_chrm_ids)
+        a_mate_tid = np.asarray(a_mate_tid, dtype=np.int64)
+        a_mate_pos = np.asarray(a_mate_pos, dtype=np.int64)
+        a_keep = (a_mate_tid >= 0) & (a_mate_tid < len(a_mask))
+        a_keep[a_keep] = a_mask[a_mate_tid[a_keep]]
+        a_mate_tid = a_mate_tid[a_keep]
+        a_mate_pos = a_mate_pos[a_keep]
+
+        a_same = (a_mate_tid == xregistry.get_tid(chrm))
+        a_dist = np.abs(a_mate_pos - start)
+        a_disc = (~a_same) | (a_dist > i_is)
+        a_raw = a_disc & ((~a_same) | (a_dist > i_max_is))
+        n_raw_cnt = int(np.count_nonzero(a_raw))
+        m_mate_pos = {}
+        for (mate_tid, mate_pos) in zip(a_mate_tid[a_raw].tolist(), a_mate_pos[a_raw].tolist()):
+            mate_chrm = m_chrm_ids[mate_tid]
+            if mate_chrm not in m_mate_pos:
+                m_mate_pos[mate_chrm] = []
+            m_mate_pos[mate_chrm].append(mate_pos)
+
+        n_cnt = 0
+        a_disc_tid = a_mate_tid[a_disc]
+        a_disc_pos = a_mate_pos[a_disc]
+        for mate_tid in np.unique(a_disc_tid).tolist():
+            a_within_rep, a_rep_start = xannotation.is_within_repeat_region_points(m_chrm_ids[mate_tid],
+                                                                                   a_disc_pos[a_disc_tid == mate_tid])
+            n_cnt += int(np.count_nonzero(a_within_rep))
         dc = DiscCluster()
         b_cluster, c_chrm, c_pos=dc.form_one_side_cluster(m_mate_pos, i_is, global_values.MIN_RAW_DISC_CLUSTER_RATIO)
         return n_cnt, n_raw_cnt, (b_cluster, c_chrm, c_pos)
 
+    ####Same as "cnt_discordant_pairs", but count from the evidence store (or the discordant sidecar) saved by the clip step
+    ####Caller should make sure the region is covered by the store (xstore.is_covered, or xsidecar.can_count_disc)
+    def cnt_discordant_pairs_from_evidence(self, xstore, m_chrm_ids, chrm, start, end, i_is, f_dev, xannotation):
+        i_skip_flag = FLAG_DUPLICATE | FLAG_SUPPLEMENTARY | FLAG_UNMAPPED | FLAG_MATE_UNMAPPED | FLAG_SECONDARY
+        a_reads = xstore.fetch(chrm, start, end)
+        a_reads = a_reads[((a_reads["flag"] & i_skip_flag) == 0) & (a_reads["mapq"] >= global_values.MINIMUM_DISC_MAPQ)
+                          & (a_reads["mate_tid"] >= 0)]
+        return self._cnt_disc_mates(m_chrm_ids, chrm, start, a_reads["mate_tid"], a_reads["mate_pos"], i_is, f_dev,
+                                    xannotation)
+
+    ####Same as "cnt_discordant_pairs", but count all the windows (of one chromosome) in one sweep
+    ####l_windows: [(start, end)]. The windows are sorted and merged, the reads of each merged region are fetched once,
+    ####and each qualified read is assigned to every window it overlaps (same overlap rule as "fetch").
+    ####Return the results of the windows, in the same order as "l_windows"
+    def cnt_discordant_pairs_sweep(self, bamfile, m_chrm_ids, chrm, l_windows, i_is, f_dev, xannotation):
+        n_windows = len(l_windows)
+        l_mate_tid = [array("q") for i in range(n_windows)]
+        l_mate_pos = [array("q") for i in range(n_windows)]
+
+        l_order = sorted(range(n_windows), key=lambda idx: l_windows[idx])
+        l_starts = [l_windows[idx][0] for idx in l_order]
+        i_max_len = 0
+        for (start, end) in l_windows:
+            if end - start > i_max_len:
+                i_max_len = end - start
+        #merged regions, in format: [start, end, first window, last window + 1] (index in the sorted windows)
+        l_regions = []
+        for i_sorted, idx in enumerate(l_order):
+            start, end = l_windows[idx]
+            if len(l_regions) > 0 and start <= l_regions[-1][1]:
+                if end > l_regions[-1][1]:
+                    l_regions[-1][1] = end
+                l_regions[-1][3] = i_sorted + 1
+            else:
+                l_regions.append([start, end, i_sorted, i_sorted + 1])
+
+        for (region_start, region_end, i_first, i_last) in l_regions:
+            for algnmt in bamfile.fetch(chrm, region_start, region_end):
+                if algnmt.is_duplicate == True or algnmt.is_supplementary == True:  ##skip duplicate and supplementary ones
+                    continue
+                if algnmt.is_unmapped == True or algnmt.mate_is_unmapped == True:  #### for now, just skip the unmapped reads
+                    continue
+                if algnmt.is_secondary == True:  ##skip secondary alignment
+                    continue
+                if algnmt.mapping_quality < global_values.MINIMUM_DISC_MAPQ:###############anchor mapping quality
+                    continue
+                if algnmt.next_reference_id < 0:
+                    continue
+
+                ####windows overlapping the read: start < map_end and end > map_start
+                map_start = algnmt.reference_start
+                map_end = algnmt.reference_end
+                if map_end is None:
+                    map_end = map_start + 1
+                i_lo = bisect.bisect_right(l_starts, map_start - i_max_len, i_first, i_last)
+                i_hi = bisect.bisect_left(l_starts, map_end, i_first, i_last)
+                for i_sorted in range(i_lo, i_hi):
+                    idx = l_order[i_sorted]
+                    if l_windows[idx][1] <= map_start:
+                        continue
+                    l_mate_tid[idx].append(algnmt.next_reference_id)
+                    l_mate_pos[idx].append(algnmt.next_reference_start)
+        l_results = []
+        for idx in range(n_windows):
+            l_results.append(self._cnt_disc_mates(m_chrm_ids, chrm, l_windows[idx][0],
+                                                  np.frombuffer(l_mate_tid[idx], dtype=np.int64),
+                                                  np.frombuffer(l_mate_pos[idx], dtype=np.int64), i_is, f_dev, xannotation))
+        return l_results
+
 
     ## "self.b_with_chr" is the format gotten from the alignment file
     ## all other format should be changed to consistent with the "self.b_with_chr"
@@ -14,7 +14,7 @@ import sys
 import pysam
 import global_values
 from cmd_runner import *
-from intervaltree import IntervalTree
+from x_interval_index import XIntervalIndex
 
 ####
 class XAnnotation():
@@ -24,7 +24,7 @@ class XAnnotation():
         self.m_rmsk_annotation = {}
         self.m_rmsk_chrm_regions = {}
         self.b_with_chr = True
-        self.m_interval_tree = {}  # by chrm
+        self.interval_index = XIntervalIndex()  # by chrm
 
     # This indicates whether the chromosomes is in format "chr1" or "1"
     def set_with_chr(self, b_with_chr):
@@ -593,43 +593,32 @@ class XAnnotation():
                 hi = mid - 1
         return False, -1
 ####
-    #Index by interval tree
+    #Index by sorted interval arrays (replaced the interval tree, same [start, end) query)
     def index_rmsk_annotation_interval_tree(self):
         for chrm in self.m_rmsk_annotation:
-            interval_tree = IntervalTree()
             for pos in self.m_rmsk_annotation[chrm]:
                 end_pos=self.m_rmsk_annotation[chrm][pos][0][0]
-                interval_tree.addi(pos, end_pos)
-            self.m_interval_tree[chrm] = interval_tree
+                self.interval_index.addi(chrm, pos, end_pos)
+        self.interval_index.build()
 
     def is_within_repeat_region_interval_tree(self, chrm1, pos):
         chrm=self._process_chrm_name(chrm1)
-        if chrm not in self.m_interval_tree:
-            return False, -1
-        tmp_tree = self.m_interval_tree[chrm]
-        set_rslt = tmp_tree[pos]
-        if len(set_rslt)==0:
-            return False, -1
-        for rcd in set_rslt:
-            start_pos=rcd[0]
-            return True, start_pos
-        return False, -1
+        return self.interval_index.query_point(chrm, pos)
 
     #this version will reture all the possible hits
     def is_within_repeat_region_interval_tree2(self, chrm1, pos):
         l_hits=[]
         chrm=self._process_chrm_name(chrm1)
-        if chrm not in self.m_interval_tree:
-            return l_hits
-        tmp_tree = self.m_interval_tree[chrm]
-        set_rslt = tmp_tree[pos]
-        if len(set_rslt)==0:
-            return l_hits
-        for rcd in set_rslt:
-            start_pos=rcd[0]
+        for start_pos in self.interval_index.query_all(chrm, pos):
             l_hits.append((True, start_pos))
         return l_hits
 
+    #batch version for positions on the same chromosome
+    #return two arrays: whether each position is within a repeat, and the start of the hit repeat (-1 if not)
+    def is_within_repeat_region_points(self, chrm1, a_pos):
+        chrm=self._process_chrm_name(chrm1)
+        return self.interval_index.query_points(chrm, a_pos)
+
     ####get divergent rate and subfamily of the given repeat
     def get_div_subfamily(self, chrm1, pos):
         chrm = self._process_chrm_name(chrm1)
@@ -0,0 +1,342 @@
+##10/18/2026
+####Precompiled repeat annotation index.
+####The rmsk annotation files are parsed once (in the main process) and saved as sorted start/end arrays, one block for
+####each (chromosome, family). Pool workers memory-map the compiled file, instead of re-parsing the rmsk file and
+####rebuilding the interval trees for each chromosome task.
+
+import os
+import numpy as np
+import global_values
+
+RMSK_INDEX_DTYPE = [("start", "i8"), ("end", "i8"), ("pmax", "i8")]
+
+####Compiled index of one or more rmsk annotation files, each file is viewed as one "family" (by its order in the list)
+class XAnnotationIndex():
+    def __init__(self, sf_index):
+        self.sf_index = sf_index
+        self.a_rcds = None
+        self.m_blocks = {}  # in format: {(chrm, family): (lo, hi)}
+        self.m_tid_blocks = {}  # in format: {(tid, family): (lo, hi)}, see "bind_registry"
+
+    ####chromosome names are saved without "chr", so the index fits bams of both styles
+    def _process_chrm_name(self, chrm):
+        if len(chrm) > 3 and chrm[:3] == "chr":
+            return chrm[3:]
+        return chrm
+
+    def _get_blocks_file(self):
+        return self.sf_index + global_values.RMSK_INDEX_BLOCKS_SUFFIX
+
+    ####check whether the compiled index is newer than all the annotation files
+    def is_up_to_date(self, l_sf_rmsk):
+        if os.path.isfile(self.sf_index) == False or os.path.isfile(self._get_blocks_file()) == False:
+            return False
+        f_index_time = os.path.getmtime(self._get_blocks_file())
+        for sf_rmsk in l_sf_rmsk:
+            if os.path.getmtime(sf_rmsk) > f_index_time:
+                return False
+        return True
+
+    ####parse the rmsk files and save the index, same parsing as "load_rmsk_annotation_with_extnd_with_lenth_cutoff"
+    ####for one start position, only the first copy is kept (same as the interval tree version)
+    def compile(self, l_sf_rmsk, i_min_len):
+        m_regions = {}  # in format: {(chrm, family): {start: end}}
+        for i_family in range(len(l_sf_rmsk)):
+            with open(l_sf_rmsk[i_family]) as fin_rmsk:
+                for line in fin_rmsk:
+                    fields = line.split()
+                    chrm = self._process_chrm_name(fields[4])
+                    start_pos = int(fields[5])
+                    end_pos = int(fields[6])
+                    if abs(end_pos - start_pos) < i_min_len:
+                        continue
+                    if (chrm, i_family) not in m_regions:
+                        m_regions[(chrm, i_family)] = {}
+                    if start_pos not in m_regions[(chrm, i_family)]:
+                        m_regions[(chrm, i_family)][start_pos] = end_pos
+
+        l_rcds = []
+        l_blocks = []
+        for (chrm, i_family) in sorted(m_regions):
+            m_start_end = m_regions[(chrm, i_family)]
+            i_lo = len(l_rcds)
+            i_pmax = -1  # index of the region with the largest end among all the regions start before
+            for start_pos in sorted(m_start_end):
+                end_pos = m_start_end[start_pos]
+                if i_pmax < 0 or end_pos > l_rcds[i_pmax][1]:
+                    i_pmax = len(l_rcds)
+                l_rcds.append((start_pos, end_pos, i_pmax))
+            l_blocks.append((chrm, i_family, i_lo, len(l_rcds)))
+
+        np.save(self.sf_index, np.array(l_rcds, dtype=RMSK_INDEX_DTYPE))
+        with open(self._get_blocks_file(), "w") as fout_blocks:
+            for (chrm, i_family, i_lo, i_hi) in l_blocks:
+                fout_blocks.write("{0}\t{1}\t{2}\t{3}\n".format(chrm, i_family, i_lo, i_hi))
+
+    def load(self):
+        if self.a_rcds is not None:
+            return
+        self.a_rcds = np.load(self.sf_index, mmap_mode="r")
+        with open(self._get_blocks_file()) as fin_blocks:
+            for line in fin_blocks:
+                fields = line.split()
+                self.m_blocks[(fields[0], int(fields[1]))] = (int(fields[2]), int(fields[3]))
+
+    ####return a view of one family with the given extension, which has the same interface as XAnnotation
+    ####the start is extended by i_lextnd and the end by i_rextnd (same as i_lextnd if not set), e.g. the regions loaded
+    ####by "XAnnotation.load_rmsk_annotation" are the ones with i_lextnd=LOAD_RMSK_LEFT_EXTND and i_rextnd=0
+    def get_family_view(self, i_family, i_lextnd, i_rextnd=None):
+        self.load()
+        if i_rextnd is None:
+            i_rextnd = i_lextnd
+        return XAnnotationIndexView(self, i_family, i_lextnd, i_rextnd)
+
+    ####find one region (start extended by i_lextnd, end by i_rextnd) covers "pos"
+    ####return (True, extended start of the region) or (False, -1)
+    ####b_end_inclusive: whether the end position itself is viewed as within the region
+    def find_region(self, chrm1, pos, i_family, i_lextnd, i_rextnd, b_end_inclusive):
+        chrm = self._process_chrm_name(chrm1)
+        if (chrm, i_family) not in self.m_blocks:
+            return False, -1
+        i_lo, i_hi = self.m_blocks[(chrm, i_family)]
+        return self._find_region_in_block(i_lo, i_hi, pos, i_lextnd, i_rextnd, b_end_inclusive)
+
+    ####map the tids of the bam to the blocks once, so the queries by tid need no chromosome name processing
+    def bind_registry(self, xregistry):
+        self.load()
+        m_key_tids = {}
+        for tid in range(xregistry.get_n_references()):
+            s_key = xregistry.get_key(tid)
+            if s_key not in m_key_tids:
+                m_key_tids[s_key] = []
+            m_key_tids[s_key].append(tid)
+        self.m_tid_blocks = {}
+        for (chrm, i_family) in self.m_blocks:
+            for tid in m_key_tids.get(chrm, []):
+                self.m_tid_blocks[(tid, i_family)] = self.m_blocks[(chrm, i_family)]
+
+    ####same as "find_region", with the chromosome given by tid (bind_registry should be called first)
+    def find_region_tid(self, tid, pos, i_family, i_lextnd, i_rextnd, b_end_inclusive):
+        if (tid, i_family) not in self.m_tid_blocks:
+            return False, -1
+        i_lo, i_hi = self.m_tid_blocks[(tid, i_family)]
+        return self._find_region_in_block(i_lo, i_hi, pos, i_lextnd, i_rextnd, b_end_inclusive)
+
+    def _find_region_in_block(self, i_lo, i_hi, pos, i_lextnd, i_rextnd, b_end_inclusive):
+        if i_lo >= i_hi:
+            return False, -1
+        a_block = self.a_rcds[i_lo:i_hi]
+        idx = int(np.searchsorted(a_block["start"], pos + i_lextnd, side="right")) - 1
+        if idx < 0:
+            return False, -1
+        i_pmax = int(a_block["pmax"][idx]) - i_lo
+        i_end = int(a_block["end"][i_pmax]) + i_rextnd
+        if i_end > pos or (b_end_inclusive == True and i_end == pos):
+            return True, int(a_block["start"][i_pmax]) - i_lextnd
+        return False, -1
+
+    ####batch version of "find_region" ([start, end) only) for positions on the same chromosome
+    ####return two arrays: whether each position is covered, and the extended start of the hit region (-1 if not)
+    def find_regions(self, chrm1, a_pos, i_family, i_lextnd, i_rextnd):
+        a_pos = np.asarray(a_pos, dtype=np.int64)
+        a_hit = np.zeros(len(a_pos), dtype=bool)
+        a_hit_start = np.full(len(a_pos), -1, dtype=np.int64)
+        chrm = self._process_chrm_name(chrm1)
+        if (chrm, i_family) not in self.m_blocks or len(a_pos) == 0:
+            return a_hit, a_hit_start
+        i_lo, i_hi = self.m_blocks[(chrm, i_family)]
+        if i_lo >= i_hi:
+            return a_hit, a_hit_start
+        a_block = self.a_rcds[i_lo:i_hi]
+        a_idx = np.searchsorted(a_block["start"], a_pos + i_lextnd, side="right") - 1
+        a_pmax = np.asarray(a_block["pmax"])[np.maximum(a_idx, 0)] - i_lo
+        a_hit = (a_idx >= 0) & ((np.asarray(a_block["end"])[a_pmax] + i_rextnd) > a_pos)
+        a_hit_start[a_hit] = np.asarray(a_block["start"])[a_pmax[a_hit]] - i_lextnd
+        return a_hit, a_hit_start
+####
+
+####One family of the index, used in place of a loaded and indexed XAnnotation
+class XAnnotationIndexView():
+    def __init__(self, xindex, i_family, i_lextnd, i_rextnd):
+        self.xindex = xindex
+        self.i_family = i_family
+        self.i_lextnd = i_lextnd
+        self.i_rextnd = i_rextnd
+
+    #same as XAnnotation.is_within_repeat_region_interval_tree: [start, end)
+    def is_within_repeat_region_interval_tree(self, chrm, pos):
+        return self.xindex.find_region(chrm, pos, self.i_family, self.i_lextnd, self.i_rextnd, False)
+
+    #same as XAnnotation.is_within_repeat_region: [start, end]
+    def is_within_repeat_region(self, chrm, pos):
+        return self.xindex.find_region(chrm, pos, self.i_family, self.i_lextnd, self.i_rextnd, True)
+
+    #same as XAnnotation.is_within_repeat_region_points
+    def is_within_repeat_region_points(self, chrm, a_pos):
+        return self.xindex.find_regions(chrm, a_pos, self.i_family, self.i_lextnd, self.i_rextnd)
+
+    #same as "is_within_repeat_region_interval_tree", by tid of the bound registry
+    def is_within_repeat_region_interval_tree_tid(self, tid, pos):
+        return self.xindex.find_region_tid(tid, pos, self.i_family, self.i_lextnd, self.i_rextnd, False)
+
+    #same as "is_within_repeat_region", by tid of the bound registry
+    def is_within_repeat_region_tid(self, tid, pos):
+        return self.xindex.find_region_tid(tid, pos, self.i_family, self.i_lextnd, self.i_rextnd, True)
+
+    def bind_registry(self, xregistry):
+        self.xindex.bind_registry(xregistry)
+####
+
+####Combined index of several families: one lookup returns a bitmask of the hit families (bit i for family i) and the
+####start of the hit repeat of each family. The extended regions of all families cut each chromosome into segments,
+####within which the hit families do not change, so the segments (with their hits) are saved and a query is only one
+####binary search. Segments are compiled from the per-family index, with the extension of each family fixed.
+class XMultiFamilyIndex():
+    def __init__(self, sf_index):
+        self.sf_index = sf_index
+        self.a_rcds = None
+        self.m_blocks = {}  # in format: {chrm: (lo, hi)}
+        self.l_tid_blocks = []  # (lo, hi) or None of each tid, see "bind_registry"
+
+    def _get_blocks_file(self):
+        return self.sf_index + global_values.RMSK_INDEX_BLOCKS_SUFFIX
+
+    ####xfamily_index: the compiled (and loaded) per-family XAnnotationIndex; l_extnd: extension of each family
+    def compile(self, xfamily_index, l_extnd):
+        n_family = len(l_extnd)
+        l_chrms = sorted(set([chrm for (chrm, i_family) in xfamily_index.m_blocks]))
+        l_rcd_arrays = []
+        l_blocks = []
+        i_lo = 0
+        for chrm in l_chrms:
+            #all the boundaries of the extended regions
+            l_bounds = []
+            for i_family in range(n_family):
+                if (chrm, i_family) not in xfamily_index.m_blocks:
+                    continue
+                i_flo, i_fhi = xfamily_index.m_blocks[(chrm, i_family)]
+                a_block = xfamily_index.a_rcds[i_flo:i_fhi]
+                l_bounds.append(np.asarray(a_block["start"]) - l_extnd[i_family])
+                l_bounds.append(np.asarray(a_block["end"]) + l_extnd[i_family])
+            if len(l_bounds) == 0:
+                continue
+            a_bounds = np.unique(np.concatenate(l_bounds))
+            a_mask = np.zeros(len(a_bounds), dtype=np.uint32)
+            a_rep_start = np.full((len(a_bounds), n_family), -1, dtype=np.int64)
+            for i_family in range(n_family):
+                a_hit, a_hit_start = xfamily_index.find_regions(chrm, a_bounds, i_family, l_extnd[i_family],
+                                                                l_extnd[i_family])
+                a_mask[a_hit] |= np.uint32(1 << i_family)
+                a_rep_start[:, i_family] = a_hit_start
+            #merge the neighbor segments with the same hits
+            a_keep = np.ones(len(a_bounds), dtype=bool)
+            a_keep[1:] = (a_mask[1:] != a_mask[:-1]) | np.any(a_rep_start[1:] != a_rep_start[:-1], axis=1)
+            a_rcds = np.zeros(int(a_keep.sum()), dtype=self._get_dtype(n_family))
+            a_rcds["start"] = a_bounds[a_keep]
+            a_rcds["mask"] = a_mask[a_keep]
+            a_rcds["rep_start"] = a_rep_start[a_keep]
+            l_rcd_arrays.append(a_rcds)
+            l_blocks.append((chrm, i_lo, i_lo + len(a_rcds)))
+            i_lo += len(a_rcds)
+
+        if len(l_rcd_arrays) > 0:
+            np.save(self.sf_index, np.concatenate(l_rcd_arrays))
+        else:
+            np.save(self.sf_index, np.zeros(0, dtype=self._get_dtype(n_family)))
+        with open(self._get_blocks_file(), "w") as fout_blocks:
+            for (chrm, i_lo, i_hi) in l_blocks:
+                fout_blocks.write("{0}\t{1}\t{2}\n".format(chrm, i_lo, i_hi))
+
+    def _get_dtype(self, n_family):
+        return [("start", "i8"), ("mask", "u4"), ("rep_start", "i8", (n_family,))]
+
+    def load(self):
+        if self.a_rcds is not None:
+            return
+        self.a_rcds = np.load(self.sf_index, mmap_mode="r")
+        with open(self._get_blocks_file()) as fin_blocks:
+            for line in fin_blocks:
+                fields = line.split()
+                self.m_blocks[fields[0]] = (int(fields[1]), int(fields[2]))
+
+    ####chromosome names are saved without "chr", same as XAnnotationIndex
+    def _process_chrm_name(self, chrm):
+        if len(chrm) > 3 and chrm[:3] == "chr":
+            return chrm[3:]
+        return chrm
+
+    ####return (bitmask of the hit families, tuple of the hit repeat start of each family (-1 if not hit))
+    def find_families(self, chrm1, pos):
+        self.load()
+        chrm = self._process_chrm_name(chrm1)
+        if chrm not in self.m_blocks:
+            return 0, None
+        i_lo, i_hi = self.m_blocks[chrm]
+        return self._find_families_in_block(i_lo, i_hi, pos)
+
+    ####map the tids of the bam to the blocks once, so the queries by tid need no chromosome name processing
+    def bind_registry(self, xregistry):
+        self.load()
+        self.l_tid_blocks = [self.m_blocks.get(xregistry.get_key(tid)) for tid in range(xregistry.get_n_references())]
+
+    ####same as "find_families", with the chromosome given by tid (-1 for unmapped), bind_registry should be called first
+    def find_families_tid(self, tid, pos):
+        if tid < 0 or tid >= len(self.l_tid_blocks) or self.l_tid_blocks[tid] is None:
+            return 0, None
+        i_lo, i_hi = self.l_tid_blocks[tid]
+        return self._find_families_in_block(i_lo, i_hi, pos)
+
+    def _find_families_in_block(self, i_lo, i_hi, pos):
+        idx = int(np.searchsorted(self.a_rcds["start"][i_lo:i_hi], pos, side="right")) - 1
+        if idx < 0:
+            return 0, None
+        rcd = self.a_rcds[i_lo + idx]
+        return int(rcd["mask"]), tuple(rcd["rep_start"].tolist())
+
+    ####batch version of "find_families" for positions on the same chromosome
+    ####return (array of bitmask, 2D array of the hit repeat start of each family)
+    def find_families_points(self, chrm1, a_pos):
+        self.load()
+        a_pos = np.asarray(a_pos, dtype=np.int64)
+        n_family = self.a_rcds.dtype["rep_start"].shape[0]
+        a_mask = np.zeros(len(a_pos), dtype=np.uint32)
+        a_rep_start = np.full((len(a_pos), n_family), -1, dtype=np.int64)
+        chrm = self._process_chrm_name(chrm1)
+        if chrm not in self.m_blocks or len(a_pos) == 0:
+            return a_mask, a_rep_start
+        i_lo, i_hi = self.m_blocks[chrm]
+        a_idx = np.searchsorted(self.a_rcds["start"][i_lo:i_hi], a_pos, side="right") - 1
+        a_valid = a_idx >= 0
+        a_rcds = self.a_rcds[i_lo:i_hi][a_idx[a_valid]]
+        a_mask[a_valid] = a_rcds["mask"]
+        a_rep_start[a_valid] = a_rcds["rep_start"]
+        return a_mask, a_rep_start
+####
+
+####Compile the given rmsk files into one index under the working folder (skipped if already up to date).
+####Should be called in the main process before the pool starts. Return the index file.
+def compile_rmsk_index(working_folder, l_sf_rmsk, i_min_len=0):
+    if len(working_folder) > 0 and working_folder[-1] != "/":
+        working_folder += "/"
+    s_name = "_".join([os.path.basename(sf_rmsk) for sf_rmsk in l_sf_rmsk])
+    sf_index = working_folder + s_name + ".min{0}".format(i_min_len) + global_values.RMSK_INDEX_SUFFIX
+    xindex = XAnnotationIndex(sf_index)
+    if xindex.is_up_to_date(l_sf_rmsk) == False:
+        xindex.compile(l_sf_rmsk, i_min_len)
+    return sf_index
+
+####Compile the combined index of the given rmsk files (one family each, extended by l_extnd) under the working folder.
+####Should be called in the main process before the pool starts. Return the index file.
+def compile_multi_family_index(working_folder, l_sf_rmsk, l_extnd, i_min_len=0):
+    sf_family_index = compile_rmsk_index(working_folder, l_sf_rmsk, i_min_len)
+    s_extnd = "_".join([str(i_extnd) for i_extnd in l_extnd])
+    sf_index = sf_family_index[:-1 * len(global_values.RMSK_INDEX_SUFFIX)] + ".ext{0}".format(s_extnd) + \
+               global_values.RMSK_MULTI_INDEX_SUFFIX
+    xmulti_index = XMultiFamilyIndex(sf_index)
+    sf_blocks = xmulti_index._get_blocks_file()
+    if os.path.isfile(sf_index) == False or os.path.isfile(sf_blocks) == False or \
+            os.path.getmtime(sf_blocks) < os.path.getmtime(sf_family_index + global_values.RMSK_INDEX_BLOCKS_SUFFIX):
+        xfamily_index = XAnnotationIndex(sf_family_index)
+        xfamily_index.load()
+        xmulti_index.compile(xfamily_index, l_extnd)
+    return sf_index
@@ -0,0 +1,49 @@
+##10/18/2026
+####Per-worker cache of the opened bam/cram files, keyed by path. Each pool worker opens a bam once, and the handle (and
+####the chromosome registry built from its header, with the tid map and the "chr" style) is reused by all the sites the
+####worker processes, instead of parsing the header and opening the file again for each site. For cram, this also
+####saves re-loading the reference each time.
+####The handles are process local: a forked worker drops the handles inherited from the parent (which share the file
+####offsets with the parent) and opens its own ones.
+
+import os
+import pysam
+from x_chrom_registry import get_chrom_registry
+
+#opened files of this process, in format: {sf_bam: AlignmentFile}
+M_BAM_HANDLES = {}
+#pid of the process owning the handles
+I_CACHE_PID = None
+
+####Pool initializer, e.g. "Pool(n_jobs, initializer=init_bam_handle_cache)"
+def init_bam_handle_cache():
+    global I_CACHE_PID
+    M_BAM_HANDLES.clear()
+    I_CACHE_PID = os.getpid()
+####
+
+####Return the opened AlignmentFile of the bam, opened once in each process.
+####The caller should not close it, the files are closed when the worker exits
+def get_bam_handle(sf_bam, sf_reference=None):
+    if I_CACHE_PID != os.getpid():  #not initialized in this process, or inherited from the parent
+        init_bam_handle_cache()
+    if sf_bam in M_BAM_HANDLES:
+        return M_BAM_HANDLES[sf_bam]
+    samfile = pysam.AlignmentFile(sf_bam, "rb", reference_filename=sf_reference)
+    M_BAM_HANDLES[sf_bam] = samfile
+    get_chrom_registry(sf_bam, sf_reference, samfile)  #the registry is built from the opened header
+    return samfile
+####
+
+####Return the opened AlignmentFile and the chromosome registry (tid map, "chr" style) of the bam
+def get_bam_handle_and_registry(sf_bam, sf_reference=None):
+    samfile = get_bam_handle(sf_bam, sf_reference)
+    return samfile, get_chrom_registry(sf_bam, sf_reference, samfile)
+####
+
+####Close all the cached files of this process
+def close_bam_handles():
+    for sf_bam in M_BAM_HANDLES:
+        M_BAM_HANDLES[sf_bam].close()
+    M_BAM_HANDLES.clear()
+####
@@ -0,0 +1,32 @@
+##10/18/2026
+####Key and stamp of a bam for the data saved from it by the clip step (evidence store, discordant read sidecar and
+####clip record table). The key is the file name plus a hash of the real path, so bams with the same file name in
+####different folders (e.g. per lane or per sample) are saved separately. The stamp (real path, size and modification
+####time) is saved with the data, and the data is only used if the stamp still matches the bam.
+
+import os
+import hashlib
+
+####return the key of the bam used in the names of the saved files/folders
+def get_bam_key(sf_bam):
+    s_path = os.path.realpath(sf_bam)
+    return os.path.basename(sf_bam) + "." + hashlib.md5(s_path.encode()).hexdigest()[:12]
+
+####return the stamp of the bam: "real_path size mtime_ns"
+def get_bam_stamp(sf_bam):
+    s_path = os.path.realpath(sf_bam)
+    stat_bam = os.stat(s_path)
+    return "{0}\t{1}\t{2}".format(s_path, stat_bam.st_size, stat_bam.st_mtime_ns)
+
+def save_bam_stamp(sf_stamp, sf_bam):
+    with open(sf_stamp, "w") as fout_stamp:
+        fout_stamp.write(get_bam_stamp(sf_bam) + "\n")
+
+####whether the stamp file exists and was saved from the current version of the bam
+def is_bam_stamp_matched(sf_stamp, sf_bam):
+    if os.path.isfile(sf_stamp) == False:
+        return False
+    with open(sf_stamp) as fin_stamp:
+        s_stamp = fin_stamp.readline().rstrip("\n")
+    return s_stamp == get_bam_stamp(sf_bam)
+####
@@ -3,13 +3,13 @@
 ##@@contact: chong_chu@hms.harvard.edu
 ##
 import os
-from intervaltree import IntervalTree
+from x_interval_index import XIntervalIndex
 
 class XBlackList():
     def __init__(self):
         self.m_regions={}
         self.b_with_chr = True #the bed file has "chr"
-        self.m_interval_tree = {}  # by chrm
+        self.interval_index = XIntervalIndex()  # by chrm
 
     # This indicates whether the chromosomes is in format "chr1" or "1"
     def set_with_chr(self, b_with_chr):
@@ -31,7 +31,7 @@ class XBlackList():
         else:
             return chrm
 
-    ####load and index bed files with interval tree
+    ####load and index bed files with sorted interval arrays
     def load_index_regions(self, sf_bed):
         if os.path.isfile(sf_bed)==False:
             return
@@ -42,23 +42,17 @@ class XBlackList():
                 istart=int(fields[1])
                 iend=int(fields[2])
 
-                if chrm not in self.m_interval_tree:
-                    interval_tree = IntervalTree()
-                    self.m_interval_tree[chrm]=interval_tree
-                self.m_interval_tree[chrm].addi(istart, iend)
+                self.interval_index.addi(chrm, istart, iend)
+        self.interval_index.build()
 
 ####
     #here only check hit or not, doesn't matter how many records in all
     def fall_in_region(self, ins_chrm1, ins_pos):
         chrm = self._process_chrm_name(ins_chrm1)
-        if chrm not in self.m_interval_tree:
-            return False, -1
-        tmp_tree = self.m_interval_tree[chrm]
-        set_rslt = tmp_tree[ins_pos]
-        if len(set_rslt) == 0:
-            return False, -1
-        for rcd in set_rslt:
-            start_pos = rcd[0]
-            return True, start_pos
-        return False, -1
+        return self.interval_index.query_point(chrm, ins_pos)
+
+    #batch version for positions on the same chromosome, return (array of hit or not, array of hit region start)
+    def fall_in_region_points(self, ins_chrm1, a_pos):
+        chrm = self._process_chrm_name(ins_chrm1)
+        return self.interval_index.query_points(chrm, a_pos)
 ####
\ No newline at end of file
@@ -0,0 +1,87 @@
+##10/18/2026
+####Chromosome registry of one bam: the reference names are mapped to the integer ids (tid) of the bam once per run.
+####Names of the candidate list, the reference and the annotations (with or without "chr") are all resolved to the same
+####tid, and the per-read checks in the hot loops (decoy/contig mates, mate in repeat) are done by tid with arrays,
+####instead of string processing of the mate chromosome of each read.
+
+import numpy as np
+import pysam
+from x_reference import XChromosome
+
+#registries already built in this process, in format: {sf_bam: XChromRegistry}
+M_CHROM_REGISTRY = {}
+
+class XChromRegistry():
+    def __init__(self, l_references):
+        self.l_names = list(l_references)  # tid to the name in the bam
+        self.l_keys = []  # tid to the name without "chr", which is the key of the compiled annotation indexes
+        self.m_tid = {}  # name (in the bam, or in the other style) to tid
+        self.a_decoy = np.zeros(len(self.l_names), dtype=bool)  # decoy and contig sequences, indexed by tid
+        xchrom = XChromosome()
+        for tid, chrm in enumerate(self.l_names):
+            self.m_tid[chrm] = tid
+            self.l_keys.append(self._remove_chr(chrm))
+            self.a_decoy[tid] = xchrom.is_decoy_contig_chrms(chrm)
+        #names in the other style are only added if not conflict with the bam names
+        for tid, chrm in enumerate(self.l_names):
+            s_other = self._remove_chr(chrm)
+            if s_other == chrm:
+                s_other = "chr" + chrm
+            if s_other not in self.m_tid:
+                self.m_tid[s_other] = tid
+        self.b_with_chr = ("chr1" in self.l_names)
+
+    def _remove_chr(self, chrm):
+        if len(chrm) > 3 and chrm[:3] == "chr":
+            return chrm[3:]
+        return chrm
+
+    ####whether the bam chromosome names are in format "chr1", same as BamInfo.is_chrm_contain_chr
+    def is_chrm_contain_chr(self):
+        return self.b_with_chr
+
+    ####return the tid of the chromosome (in either style), or -1 if not in the bam
+    def get_tid(self, chrm):
+        return self.m_tid.get(chrm, -1)
+
+    ####return the name in the bam of the tid, "*" for -1 (unmapped mate), same as "_get_chrm_id_name"
+    def get_name(self, tid):
+        if tid < 0 or tid >= len(self.l_names):
+            return "*"
+        return self.l_names[tid]
+
+    ####return the annotation index key (name without "chr") of the tid
+    def get_key(self, tid):
+        return self.l_keys[tid]
+
+    def get_n_references(self):
+        return len(self.l_names)
+
+    ####whether the tid is one of the bam references
+    def is_valid_tid(self, tid):
+        return tid >= 0 and tid < len(self.l_names)
+
+    ####whether the tid is a decoy or contig sequence, see XChromosome.is_decoy_contig_chrms
+    def is_decoy_tid(self, tid):
+        return self.is_valid_tid(tid) == True and self.a_decoy[tid] == True
+
+    ####mask of the tids allowed as mates (not decoy or contig sequences), indexed by tid
+    def get_allowed_mask(self):
+        return ~self.a_decoy
+####
+
+####Return the registry of the bam, built once in each process (the main process and each pool worker)
+####samfile: an opened AlignmentFile of the bam, to save re-opening it
+def get_chrom_registry(sf_bam, sf_reference=None, samfile=None):
+    if sf_bam in M_CHROM_REGISTRY:
+        return M_CHROM_REGISTRY[sf_bam]
+    if samfile is None:
+        bamfile = pysam.AlignmentFile(sf_bam, "rb", reference_filename=sf_reference)
+        l_references = bamfile.references
+        bamfile.close()
+    else:
+        l_references = samfile.references
+    xregistry = XChromRegistry(l_references)
+    M_CHROM_REGISTRY[sf_bam] = xregistry
+    return xregistry
+####
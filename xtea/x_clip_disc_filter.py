@@ -24,6 +24,7 @@
 
 ####
 import os
+import re
 import sys
 import pysam
 from subprocess import *
@@ -38,6 +39,7 @@ from x_polyA import *
 import global_values
 from x_log import *
 from x_genotype_feature import *
+from x_bam_handle_cache import init_bam_handle_cache, get_bam_handle_and_registry
 
 def unwrap_self_collect_clip_disc_reads(arg, **kwarg):
     return XClipDisc.collect_clipped_disc_reads_by_region(*arg, **kwarg)
@@ -45,6 +47,9 @@ def unwrap_self_collect_clip_disc_reads(arg, **kwarg):
 def unwrap_self_calc_AF_by_clip_reads(arg, **kwarg):
     return XClipDisc.calc_AF_of_site(*arg, **kwarg)
 
+def unwrap_self_parse_clip_realignment_consensus_chunk(arg, **kwarg):
+    return XClipDiscFilter.parse_clip_realignment_consensus_chunk(*arg, **kwarg)
+
 class XClipDisc():####
     def __init__(self, sf_bam, working_folder, n_jobs, sf_ref):
         self.sf_bam = sf_bam
@@ -89,8 +94,8 @@ class XClipDisc():####
         sf_bam = record[1]
         working_folder = record[2]
 
-        bam_info = BamInfo(sf_bam, self.sf_reference)
-        b_with_chr = bam_info.is_chrm_contain_chr()
+        samfile, xregistry = get_bam_handle_and_registry(sf_bam, self.sf_reference) #mates are checked by tid
+        b_with_chr = xregistry.is_chrm_contain_chr()
         chrm_in_bam = self._process_chrm_name(b_with_chr, chrm)
 
         # load the reads, and write the related clipped part into file
@@ -101,11 +106,9 @@ class XClipDisc():####
         sf_disc_pos = working_folder + s_pos_info + global_values.DISC_POS_SUFFIX  # this is to save the discordant positions
         f_disc_pos = open(sf_disc_pos, "w")
 
-        samfile = pysam.AlignmentFile(sf_bam, "rb", reference_filename=self.sf_reference)
         n_cnt_clip = 0  # as a index to set a different read id for collected reads clip at the same position
         n_cnt_low_mapq_clip=0 #this is to count the low mapping quality clip reads
         xpolyA = PolyA()#
-        m_chrm_id=self._get_chrm_id_name(samfile)
         for algnmt in samfile.fetch(chrm_in_bam, start_pos, end_pos):  ##fetch reads mapped to "chrm:start_pos-end_pos"
             ##here need to skip the secondary and supplementary alignments?
             # if algnmt.is_secondary or algnmt.is_supplementary:
@@ -128,14 +131,15 @@ class XClipDisc():####
             # anchor_map_pos=algnmt.reference_start##original mapping position
             map_pos = algnmt.reference_start
             mate_chrm = '*'
+            mate_tid = -1
             mate_pos = 0
             is_rc = 0
             if algnmt.is_reverse == True:  # is reverse complementary
                 is_rc = 1
 
-            if (algnmt.next_reference_id in m_chrm_id) and (algnmt.mate_is_unmapped == False) \
-                    and (algnmt.next_reference_id >= 0):
-                mate_chrm = algnmt.next_reference_name
+            if xregistry.is_valid_tid(algnmt.next_reference_id) == True and (algnmt.mate_is_unmapped == False):
+                mate_tid = algnmt.next_reference_id
+                mate_chrm = xregistry.get_name(mate_tid)
                 mate_pos = algnmt.next_reference_start
 
             b_fully_mapped = False
@@ -234,8 +238,7 @@ class XClipDisc():####
 
             if mate_chrm == "*":  ##unmapped reads are not interested!
                 continue
-            xchrom = XChromosome()  ###decoy seuqence and contigs are not interested
-            if xchrom.is_decoy_contig_chrms(mate_chrm) == True:
+            if xregistry.is_decoy_tid(mate_tid) == True:  ###decoy seuqence and contigs are not interested
                 continue
 
             if algnmt.mapping_quality < global_values.MINIMUM_DISC_MAPQ:
@@ -262,7 +265,6 @@ class XClipDisc():####
                                                          b_left_clip, b_right_clip)
                 f_disc_pos.write(s_mate_pos_info)
 
-        samfile.close()
         f_clip_fq.close()
         f_disc_pos.close()
         return (chrm, insertion_pos, n_cnt_low_mapq_clip)
@@ -299,7 +301,7 @@ class XClipDisc():####
                 chrm = fields[0]
                 pos = int(fields[1])  # candidate insertion site
                 l_chrm_records.append(((chrm, pos, extnd), self.sf_bam, self.working_folder))
-        pool = Pool(self.n_jobs)
+        pool = Pool(self.n_jobs, initializer=init_bam_handle_cache)
         l_low_mapq=pool.map(unwrap_self_collect_clip_disc_reads, list(zip([self] * len(l_chrm_records), l_chrm_records)), 1)
         pool.close()
         pool.join()
@@ -365,7 +367,7 @@ class XClipDisc():####
                 l_chrm_records = []
                 for pos in m_chrm_pos[chrm]:
                     l_chrm_records.append(((chrm, pos, extnd), self.sf_bam, self.working_folder))
-                pool = Pool(self.n_jobs)
+                pool = Pool(self.n_jobs, initializer=init_bam_handle_cache)
                 pool.map(unwrap_self_collect_clip_disc_reads, list(zip([self] * len(l_chrm_records), l_chrm_records)), 1)
                 pool.close()
                 pool.join()
@@ -457,6 +459,7 @@ class XClipDisc():####
     # by default: cnt # of clipped reads within [-30, 30] of the insertion site
     ##calculate the average # of reads cover a site
     # then calculate the AF
+    #return: (i_task, (chrm, {ins_pos: [counts of each bam]})), the counts are written by "_write_AF_of_sites"
     def calc_AF_of_site(self, record):
         chrm = record[0]  ##this is the chrm style in candidate list
         sf_bam_list = record[1]
@@ -465,6 +468,7 @@ class XClipDisc():####
         clip_extnd = int(record[4])
         af_cutoff = float(record[5])
         working_folder = record[6]
+        i_task = record[7]
         if working_folder[-1] != "/":
             working_folder += "/"
 
@@ -486,127 +490,137 @@ class XClipDisc():####
 
         m_rslts = {}
         for sf_bam in l_bams:
-            bam_info = BamInfo(sf_bam, self.sf_reference)
-            b_with_chr = bam_info.is_chrm_contain_chr()
+            samfile, xregistry = get_bam_handle_and_registry(sf_bam, self.sf_reference)
+            b_with_chr = xregistry.is_chrm_contain_chr()
             chrm_in_bam = self._process_chrm_name(b_with_chr, chrm)
-            samfile = pysam.AlignmentFile(sf_bam, "rb", reference_filename=self.sf_reference)
-            m_chrm_id=self._get_chrm_id_name(samfile)
             for insertion_pos in m_candidate_sites[chrm]:
                 start_pos = insertion_pos - extend
                 if start_pos <= 0:
                     start_pos = 1
                 end_pos = insertion_pos + extend
-                cnt_all_reads = 0
-                cnt_clip = 0
-                cnt_disc = 0
-                cnt_all_2 = 0
-                lmost_region = -1
-                rmost_region = -1
-                for algnmt in samfile.fetch(chrm_in_bam, start_pos, end_pos):  ##fetch reads mapped to "chrm:start_pos-end_pos"
-                    if algnmt.is_duplicate == True:  ##duplciate
-                        continue
-                    if algnmt.is_unmapped == True:  # unmapped
-                        continue
-                    l_cigar = algnmt.cigar
-                    if len(l_cigar) < 1:  # wrong alignment
-                        continue
-                    if algnmt.mapping_quality < global_values.MINIMUM_DISC_MAPQ:
-                        continue
-                    if algnmt.is_supplementary or algnmt.is_secondary:
-                        continue
+                ##fetch reads mapped to "chrm:start_pos-end_pos"
+                rcd_af = self._cnt_AF_reads(samfile.fetch(chrm_in_bam, start_pos, end_pos), chrm_in_bam, xregistry,
+                                            insertion_pos, extend, clip_extnd)
+                if insertion_pos not in m_rslts:
+                    m_rslts[insertion_pos] = []
+                m_rslts[insertion_pos].append(rcd_af)
+        if global_values.KEEP_SITE_FEATURE_FILES == True:#debug only, save the AF of the chrm
+            sf_tmp_out = working_folder + chrm + global_values.ALLELE_FREQUENCY_SUFFIX
+            with open(sf_tmp_out, "w") as fout_tmp:
+                self._write_AF_of_sites(chrm, m_rslts, af_cutoff, fout_tmp)
+        return (i_task, (chrm, m_rslts))
+
+    ####count the reads (fetched around the site) for calculating the AF of one site in one bam
+    ####return: (cnt_clip, clip_range, cnt_all_reads, all_range, cnt_disc, cnt_all_2)
+    def _cnt_AF_reads(self, iter_reads, chrm_in_bam, xregistry, insertion_pos, extend, clip_extnd):
+        cnt_all_reads = 0
+        cnt_clip = 0
+        cnt_disc = 0
+        cnt_all_2 = 0
+        lmost_region = -1
+        rmost_region = -1
+        for algnmt in iter_reads:
+            if algnmt.is_duplicate == True:  ##duplciate
+                continue
+            if algnmt.is_unmapped == True:  # unmapped
+                continue
+            l_cigar = algnmt.cigar
+            if len(l_cigar) < 1:  # wrong alignment
+                continue
+            if algnmt.mapping_quality < global_values.MINIMUM_DISC_MAPQ:
+                continue
+            if algnmt.is_supplementary or algnmt.is_secondary:
+                continue
 
 
-                    map_pos = algnmt.reference_start
-                    if lmost_region == -1:
-                        lmost_region = map_pos
-                    if rmost_region == -1:
-                        rmost_region = map_pos
-
-                    if map_pos < lmost_region:
-                        lmost_region = map_pos
-                    if map_pos > rmost_region:
-                        rmost_region = map_pos
-
-                    cnt_all_reads += 1
-                    if abs(insertion_pos - map_pos) < extend:
-                        cnt_all_2 += 1
-
-                    mate_chrm = '*'
-                    mate_pos = 0
-                    if (algnmt.next_reference_id in m_chrm_id) and (algnmt.mate_is_unmapped == False) \
-                            and (algnmt.next_reference_id >= 0):
-                        mate_chrm = algnmt.next_reference_name
-                        mate_pos = algnmt.next_reference_start
-
-                    ##check disc information
-                    if mate_chrm != "*":
-                        if self.is_discordant(chrm_in_bam, map_pos, mate_chrm, mate_pos, global_values.DISC_THRESHOLD) == True:
-                            cnt_disc += 1
-                    ##check clip information
-                    clip_pos = map_pos
-                    if l_cigar[0][0] == 4:
-                        if abs(insertion_pos - clip_pos) <= clip_extnd:
-                            cnt_clip += 1
-                    elif l_cigar[-1][0] == 4:
-                        for (type, lenth) in l_cigar[:-1]:
-                            if type == 4 or type == 5 or type == 1:  # (1 for insertion)
-                                continue
-                            else:
-                                clip_pos += lenth
-                        if abs(insertion_pos - clip_pos) <= clip_extnd:
-                            cnt_clip += 1
+            map_pos = algnmt.reference_start
+            if lmost_region == -1:
+                lmost_region = map_pos
+            if rmost_region == -1:
+                rmost_region = map_pos
 
-                if insertion_pos not in m_rslts:
-                    m_rslts[insertion_pos] = []
-                irange = abs(rmost_region - lmost_region)
-                m_rslts[insertion_pos].append((cnt_clip, 2 * clip_extnd, cnt_all_reads, irange, cnt_disc, cnt_all_2))
-            samfile.close()
-        sf_tmp_out = working_folder + chrm + global_values.ALLELE_FREQUENCY_SUFFIX
-        with open(sf_tmp_out, "w") as fout_tmp:
-            for ins_pos in m_rslts:
-                cnt_clip = 0
-                cnt_all = 0
-                l_af = []
-                l_af_disc = []
-                for tmp_rcd in m_rslts[ins_pos]:
-                    cnt_clip = tmp_rcd[0]
-                    clip_range = tmp_rcd[1]
-                    cnt_all = tmp_rcd[2]
-                    all_range = tmp_rcd[3]
-                    cnt_disc = tmp_rcd[4]
-                    cnt_disc_all = tmp_rcd[5]
-
-                    if cnt_all <= 0:
-                        l_af.append(str(0.0))
-                        l_af_disc.append(str(0.0))
+            if map_pos < lmost_region:
+                lmost_region = map_pos
+            if map_pos > rmost_region:
+                rmost_region = map_pos
+
+            cnt_all_reads += 1
+            if abs(insertion_pos - map_pos) < extend:
+                cnt_all_2 += 1
+
+            mate_chrm = '*'
+            mate_pos = 0
+            if xregistry.is_valid_tid(algnmt.next_reference_id) == True and (algnmt.mate_is_unmapped == False):
+                mate_chrm = xregistry.get_name(algnmt.next_reference_id)
+                mate_pos = algnmt.next_reference_start
+
+            ##check disc information
+            if mate_chrm != "*":
+                if self.is_discordant(chrm_in_bam, map_pos, mate_chrm, mate_pos, global_values.DISC_THRESHOLD) == True:
+                    cnt_disc += 1
+            ##check clip information
+            clip_pos = map_pos
+            if l_cigar[0][0] == 4:
+                if abs(insertion_pos - clip_pos) <= clip_extnd:
+                    cnt_clip += 1
+            elif l_cigar[-1][0] == 4:
+                for (type, lenth) in l_cigar[:-1]:
+                    if type == 4 or type == 5 or type == 1:  # (1 for insertion)
+                        continue
                     else:
-                        af = float(cnt_clip * all_range) / float(cnt_all * clip_range)
-                        if af > 1.0:
-                            af = 1.0
-                        l_af.append(str(af))
-
-                        af_disc = float(cnt_disc) / float(cnt_disc_all)
-                        if af_disc > 1.0:
-                            af_disc = 1.0
-                        l_af_disc.append(str(af_disc))#
-
-                s_af = "\t".join(l_af)
-                s_af_disc = "\t".join(l_af_disc)
-
-                b_clip_satisfield = False
-                for clip_af in l_af:
-                    if float(clip_af) <= af_cutoff:
-                        b_clip_satisfield = True
-                        break
-                b_disc_satisfield = False
-                for disc_af in l_af_disc:
-                    if float(disc_af) <= af_cutoff:
-                        b_disc_satisfield = True
-                        break
-                if b_clip_satisfield == True and b_disc_satisfield == True:
-                    s_info = "{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n".format(chrm, ins_pos, cnt_clip, cnt_all, s_af, s_af_disc)
-                    fout_tmp.write(s_info)
-                    ####
+                        clip_pos += lenth
+                if abs(insertion_pos - clip_pos) <= clip_extnd:
+                    cnt_clip += 1
+        irange = abs(rmost_region - lmost_region)
+        return (cnt_clip, 2 * clip_extnd, cnt_all_reads, irange, cnt_disc, cnt_all_2)
+
+    ####write the AF of the sites of one chromosome, m_rslts in format: {ins_pos: [counts of each bam]}
+    ####only the sites with both clip and disc AF no larger than "af_cutoff" (in at least one bam) are written
+    def _write_AF_of_sites(self, chrm, m_rslts, af_cutoff, fout_tmp):
+        for ins_pos in m_rslts:
+            cnt_clip = 0
+            cnt_all = 0
+            l_af = []
+            l_af_disc = []
+            for tmp_rcd in m_rslts[ins_pos]:
+                cnt_clip = tmp_rcd[0]
+                clip_range = tmp_rcd[1]
+                cnt_all = tmp_rcd[2]
+                all_range = tmp_rcd[3]
+                cnt_disc = tmp_rcd[4]
+                cnt_disc_all = tmp_rcd[5]
+
+                if cnt_all <= 0:
+                    l_af.append(str(0.0))
+                    l_af_disc.append(str(0.0))
+                else:
+                    af = float(cnt_clip * all_range) / float(cnt_all * clip_range)
+                    if af > 1.0:
+                        af = 1.0
+                    l_af.append(str(af))
+
+                    af_disc = float(cnt_disc) / float(cnt_disc_all)
+                    if af_disc > 1.0:
+                        af_disc = 1.0
+                    l_af_disc.append(str(af_disc))#
+
+            s_af = "\t".join(l_af)
+            s_af_disc = "\t".join(l_af_disc)
+
+            b_clip_satisfield = False
+            for clip_af in l_af:
+                if float(clip_af) <= af_cutoff:
+                    b_clip_satisfield = True
+                    break
+            b_disc_satisfield = False
+            for disc_af in l_af_disc:
+                if float(disc_af) <= af_cutoff:
+                    b_disc_satisfield = True
+                    break
+            if b_clip_satisfield == True and b_disc_satisfield == True:
+                s_info = "{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n".format(chrm, ins_pos, cnt_clip, cnt_all, s_af, s_af_disc)
+                fout_tmp.write(s_info)
+                ####
 #
     # Given:
     #   sf_bam_list: bam files
@@ -622,23 +636,19 @@ class XClipDisc():####
 
         l_chrm_records = []
         for chrm in m_chrm:
-            l_chrm_records.append((chrm, sf_bam_list, sf_candidate_list, extnd, clip_slack, af, self.working_folder))
+            l_chrm_records.append((chrm, sf_bam_list, sf_candidate_list, extnd, clip_slack, af, self.working_folder,
+                                   len(l_chrm_records)))
 
-        pool = Pool(self.n_jobs)
-        pool.map(unwrap_self_calc_AF_by_clip_reads, list(zip([self] * len(l_chrm_records), l_chrm_records)), 1)
+        #the counts are returned by the workers, and written here in the order of the chrms
+        pool = Pool(self.n_jobs, initializer=init_bam_handle_cache)
+        it_rslts = pool.imap_unordered(unwrap_self_calc_AF_by_clip_reads,
+                                       list(zip([self] * len(l_chrm_records), l_chrm_records)), 1)
+        with open(sf_out, "w") as fout_rslt:
+            for (chrm, m_rslts) in iter_results_in_order(it_rslts):
+                self._write_AF_of_sites(chrm, m_rslts, float(af), fout_rslt)
         pool.close()
         pool.join()
 
-        ####
-        with open(sf_out, "w") as fout_rslt:
-            for chrm in m_chrm:
-                sf_tmp_out = self.working_folder + chrm + global_values.ALLELE_FREQUENCY_SUFFIX
-                if os.path.isfile(sf_tmp_out) == False:
-                    continue
-                with open(sf_tmp_out) as fin_tmp:
-                    for line in fin_tmp:
-                        fout_rslt.write(line)
-
     def collect_clip_disc_features_of_given_list(self, sf_bam_list, sf_candidate_list, extnd, clip_slack, sf_out):
         m_chrm = {}
         with open(sf_candidate_list) as fin_list:
@@ -1436,6 +1446,9 @@ class XClipDiscFilter():
         self.collect_clipped_disc_reads(sf_candidate_list, extnd, bin_size, sf_clip_fq, sf_disc_fa)
         # # ##re-align the clipped reads
         bwa_align = BWAlign(global_values.BWA_PATH, global_values.BWA_REALIGN_CUTOFF, self.n_jobs)
+        bwa_align.set_realign_cache_folder(working_folder + global_values.REALIGN_CACHE_FOLDER)
+        xbwa_session = XBwaIndexSession()
+        xbwa_session.preload([sf_rep_cns])
         sf_clip_algnmt = working_folder + "temp_clip.sam"
 
         bwa_align.realign_clipped_read_with_polyA(sf_rep_cns, sf_clip_fq, sf_clip_algnmt)
@@ -1445,6 +1458,7 @@ class XClipDiscFilter():
         sf_disc_algnmt = working_folder + "temp_disc.sam"
         bwa_align.realign_disc_reads(sf_rep_cns, sf_disc_fa, sf_disc_algnmt)
         self.clean_file_by_path(sf_disc_fa)
+        xbwa_session.close()
 
         m_ins_lpos, m_ins_rpos, m_cns_lpos, m_cns_rpos, m_clip_sample, m_polyA = \
             self.parse_clip_realignment_consensus(sf_clip_algnmt, bmapped_cutoff)
@@ -1550,6 +1564,10 @@ class XClipDiscFilter():
 
         # # ##re-align the clipped reads
         bwa_align = BWAlign(global_values.BWA_PATH, global_values.BWA_REALIGN_CUTOFF, self.n_jobs)
+        bwa_align.set_realign_cache_folder(self.working_folder + global_values.REALIGN_CACHE_FOLDER)
+        ####the clipped (polyA and non-polyA) and discordant reads are all aligned to the consensus
+        xbwa_session = XBwaIndexSession()
+        xbwa_session.preload([sf_rep_cns])
         sf_clip_algnmt = self.working_folder + "temp_clip.sam"
         xlog.append_to_file(f_log, "[Filtering:realign_clipped_read_with_polyA:Starts...]\n")
         bwa_align.realign_clipped_read_with_polyA(sf_rep_cns, sf_clip_fq, sf_clip_algnmt)
@@ -1561,6 +1579,7 @@ class XClipDiscFilter():
         xlog.append_to_file(f_log, "[Filtering:realign_disc_reads:Starts...]\n")
         bwa_align.realign_disc_reads(sf_rep_cns, sf_disc_fa, sf_disc_algnmt)
         self.clean_file_by_path(sf_disc_fa)
+        xbwa_session.close()
         xlog.append_to_file(f_log, "[Filtering:realign_disc_reads:Finished...]\n")
 
         ####analysis the re-aligned clipped reads, called out:
@@ -2943,8 +2962,98 @@ class XClipDiscFilter():
 ####
 ####
     # for this version, the clipped parts are realigned to the consensus, not all the repeat copies
+    # the sam is split into chunks (of records) parsed in parallel, and the counts of the chunks are merged in order,
+    # so the memory only depends on the chunk size and the number of sites
     def parse_clip_realignment_consensus(self, sf_clip_alignmt, bmapped_cutoff):
-        samfile = pysam.AlignmentFile(sf_clip_alignmt, "r", reference_filename=self.sf_reference)
+        l_records = []
+        for (i_start, i_end) in self._split_sam_into_chunks(sf_clip_alignmt, global_values.SAM_PARSE_CHUNK_SIZE):
+            l_records.append((sf_clip_alignmt, i_start, i_end, bmapped_cutoff))
+        m_ins_pos_left = {}
+        m_ins_pos_right = {}
+        m_rep_pos_left = {}
+        m_rep_pos_right = {}
+        m_ins_pos_sample = {}
+        m_polyA = {}
+        pool = Pool(self.n_jobs)
+        for t_chunk in pool.imap(unwrap_self_parse_clip_realignment_consensus_chunk,
+                                 list(zip([self] * len(l_records), l_records)), 1):
+            self._merge_nested_lists(m_ins_pos_left, t_chunk[0], 3)
+            self._merge_nested_lists(m_ins_pos_right, t_chunk[1], 3)
+            self._merge_nested_counts(m_rep_pos_left, t_chunk[2], 3)
+            self._merge_nested_counts(m_rep_pos_right, t_chunk[3], 3)
+            self._merge_nested_counts(m_ins_pos_sample, t_chunk[4], 3)
+            self._merge_nested_counts(m_polyA, t_chunk[5], 2)
+        pool.close()
+        pool.join()
+        return m_ins_pos_left, m_ins_pos_right, m_rep_pos_left, m_rep_pos_right, m_ins_pos_sample, m_polyA
+
+    ####split the records of the sam into chunks of about "i_chunk_size" bytes, return [(start_offset, end_offset)]
+    def _split_sam_into_chunks(self, sf_sam, i_chunk_size):
+        l_chunks = []
+        i_file_size = os.path.getsize(sf_sam)
+        with open(sf_sam, "rb") as fin_sam:
+            i_start = 0
+            line = fin_sam.readline()
+            while len(line) > 0 and line[:1] == b"@":#skip the header
+                i_start += len(line)
+                line = fin_sam.readline()
+            while i_start < i_file_size:
+                i_end = i_start + i_chunk_size
+                if i_end >= i_file_size:
+                    i_end = i_file_size
+                else:#end at the line end
+                    fin_sam.seek(i_end)
+                    i_end += len(fin_sam.readline())
+                l_chunks.append((i_start, i_end))
+                i_start = i_end
+        return l_chunks
+
+    ####yield the fields of the sam records in the chunk
+    def _iter_sam_chunk_fields(self, sf_sam, i_start, i_end):
+        with open(sf_sam, "rb") as fin_sam:
+            fin_sam.seek(i_start)
+            i_pos = i_start
+            while i_pos < i_end:
+                line = fin_sam.readline()
+                if len(line) == 0:
+                    break
+                i_pos += len(line)
+                fields = line.decode().rstrip("\n").split("\t")
+                if len(fields) < 11:
+                    continue
+                yield fields
+
+    ####merge {k1: {k2: ... [values]}} of "n_levels" levels of keys, the lists are concatenated
+    def _merge_nested_lists(self, m_to, m_from, n_levels):
+        for key in m_from:
+            if key not in m_to:
+                m_to[key] = m_from[key]
+            elif n_levels == 1:
+                m_to[key].extend(m_from[key])
+            else:
+                self._merge_nested_lists(m_to[key], m_from[key], n_levels - 1)
+
+    ####merge {k1: {k2: ... count or [counts]}} of "n_levels" levels of keys, the counts are added up
+    def _merge_nested_counts(self, m_to, m_from, n_levels):
+        for key in m_from:
+            if key not in m_to:
+                m_to[key] = m_from[key]
+            elif n_levels == 1:
+                if isinstance(m_to[key], list) == True:
+                    for i in range(len(m_from[key])):
+                        m_to[key][i] += m_from[key][i]
+                else:
+                    m_to[key] += m_from[key]
+            else:
+                self._merge_nested_counts(m_to[key], m_from[key], n_levels - 1)
+
+    ####parse one chunk of the realigned clipped parts, same as the original whole sam version
+    def parse_clip_realignment_consensus_chunk(self, record):
+        sf_clip_alignmt = record[0]
+        i_start = record[1]
+        i_end = record[2]
+        bmapped_cutoff = record[3]
+        re_cigar = re.compile(r"(\d+)([MIDNSHP=X])")
         m_ins_pos_left = {}  ##this is to statistic the insertion positions for left-clip on the reference
         m_ins_pos_right = {}  # for the right clipped positions
         m_rep_pos_left = {}  # this is to save the posiion on the repeat consensus of the left clipped reads
@@ -2954,14 +3063,15 @@ class XClipDiscFilter():
         m_ins_pos_sample = {}  # sample information of the clip position
         m_polyA = {}
         xpolyA=PolyA()
-        for algnmt in samfile.fetch():
+        for fields in self._iter_sam_chunk_fields(sf_clip_alignmt, i_start, i_end):
+            i_flag = int(fields[1])
             # also check the mapping quality
             # mapq = algnmt.mapping_quality
             # if mapq<global_values.MINIMUM_DISC_MAPQ:##############Here should be very careful for SVA and Alu!!!!!!!!!!!!!!!!!!!!!!!
             #     continue
 
             # In format:chrm~map_pos~FLAG_RIGHT(LEFT)_CLIP~is_reverse_complementary~insertion_position~rid~sample_id
-            read_info = algnmt.query_name
+            read_info = fields[0]
             read_info_fields = read_info.split(global_values.SEPARATOR)
 
             ori_chrm = read_info_fields[0]
@@ -2980,17 +3090,17 @@ class XClipDiscFilter():
                 b_left = False  # right clip
 
 
-            if algnmt.is_unmapped == True:  ####skip the unmapped reads
+            if i_flag & 0x4:  ####skip the unmapped reads
                 continue
             # first check whether the clipped part is qualified aligned
-            l_cigar = algnmt.cigar
+            l_cigar = [(CIGAR_OPS.index(s_op), int(s_len)) for (s_len, s_op) in re_cigar.findall(fields[5])]
             b_clip_qualified_algned, n_map_bases = self.is_clipped_part_qualified_algnmt(l_cigar, bmapped_cutoff)
 
             if b_clip_qualified_algned == False:  # skip the unqualified re-aligned parts
                 continue
 
-            clipped_seq = algnmt.query_sequence
-            b_clip_part_rc = algnmt.is_reverse #whether the aligned clip part is reverse complementary
+            clipped_seq = fields[9]
+            b_clip_part_rc = (i_flag & 0x10) != 0 #whether the aligned clip part is reverse complementary
 ####06-11-2019: bug here, didn't conosider whether the alignment is reverse-complementary or not
 ####Now add module to check whether the aligmnment is reverse complementary or not
             s_clip_seq_ck = ""
@@ -3049,7 +3159,7 @@ class XClipDiscFilter():
                         m_polyA[ori_chrm][ori_insertion_pos][3] += 1
 
             # calculate the position in consensus
-            pos_in_consensus = algnmt.reference_start  # map position on which repeat copy
+            pos_in_consensus = int(fields[3]) - 1  # map position on which repeat copy
 
             # first, get the clip position on the copy
             if (b_clip_part_rc and b_left) or (b_clip_part_rc == False and b_left == False):
@@ -3110,7 +3220,6 @@ class XClipDiscFilter():
             else:
                 m_ins_pos_sample[ori_chrm][ori_insertion_pos][sample_id][1] += 1
 
-        samfile.close()
         return m_ins_pos_left, m_ins_pos_right, m_rep_pos_left, m_rep_pos_right, m_ins_pos_sample, m_polyA
 
     ####
@@ -0,0 +1,113 @@
+##10/18/2026
+####Clip position counters backed by numpy arrays, used in place of the dict of lists {pos: [cnt1, cnt2, ...]}.
+####Each clip (or mate-in-repeat hit) is buffered as one (position, column) event. When the buffer is full, the
+####events are folded into sorted unique positions with one count per column, so the memory is bounded by the
+####number of distinct clip positions instead of one python list per position.
+####The counts are saved as a structured ".npy" array (one row per position, sorted by position), and loaded by
+####the merge step without text parsing.
+
+import os
+from array import array
+import numpy as np
+import global_values
+
+#columns of the locus pipeline: left clip, right clip, and # of clipped reads with mate in Alu/L1/SVA
+CLIP_POS_FIELDS_LOCUS = ["lclip", "rclip", "Alu", "L1", "SVA"]
+#columns of the whole genome pipeline: left clip, right clip, # of clipped reads with mate in repeat
+CLIP_POS_FIELDS = ["lclip", "rclip", "mate_in_rep"]
+#columns of the clips resolved by the "SA" tag, in the same order as the realignment counts of the locus pipeline
+CLIP_SA_FIELDS = ["Alu_lclip", "Alu_rclip", "L1_lclip", "L1_rclip", "SVA_lclip", "SVA_rclip"]
+
+def get_clip_pos_dtype(l_fields):
+    return [("pos", "i8")] + [(s_field, "i4") for s_field in l_fields]
+
+class XClipPosCounter():
+    def __init__(self, l_fields, i_buffer=None):
+        self.l_fields = l_fields
+        self.i_buffer = i_buffer
+        if i_buffer is None:
+            self.i_buffer = global_values.CLIP_POS_COUNTER_BUFFER
+        self.a_event_pos = array("q")
+        self.a_event_field = array("q")
+        self.a_pos = np.zeros(0, dtype=np.int64)  # sorted unique positions folded so far
+        self.a_cnt = np.zeros((0, len(l_fields)), dtype=np.int32)  # counts of each position, one column per field
+
+    ####add one count of column "i_field" at "pos"
+    def add(self, pos, i_field):
+        self.a_event_pos.append(pos)
+        self.a_event_field.append(i_field)
+        if len(self.a_event_pos) >= self.i_buffer:
+            self._fold()
+
+    ####fold the buffered events into the position counts
+    def _fold(self):
+        if len(self.a_event_pos) == 0:
+            return
+        n_fields = len(self.l_fields)
+        n_old = len(self.a_pos)
+        a_new_pos = np.frombuffer(self.a_event_pos, dtype=np.int64)
+        a_new_field = np.frombuffer(self.a_event_field, dtype=np.int64)
+        a_uniq, a_inv = np.unique(np.concatenate((self.a_pos, a_new_pos)), return_inverse=True)
+        a_inv = a_inv.reshape(-1)
+        a_cnt = np.bincount(a_inv[n_old:] * n_fields + a_new_field, minlength=len(a_uniq) * n_fields)
+        a_cnt = a_cnt.reshape(-1, n_fields).astype(np.int32)
+        a_cnt[a_inv[:n_old]] += self.a_cnt  # folded positions are unique, so no repeated index here
+        self.a_pos = a_uniq
+        self.a_cnt = a_cnt
+        self.a_event_pos = array("q")
+        self.a_event_field = array("q")
+
+    ####return the counts as a structured array sorted by position, fields: "pos" and the columns
+    def get_counts(self):
+        self._fold()
+        a_counts = np.zeros(len(self.a_pos), dtype=get_clip_pos_dtype(self.l_fields))
+        a_counts["pos"] = self.a_pos
+        for i_field, s_field in enumerate(self.l_fields):
+            a_counts[s_field] = self.a_cnt[:, i_field]
+        return a_counts
+####
+
+def save_clip_pos(sf_clip_pos, a_counts):
+    with open(sf_clip_pos, "wb") as fout_clip_pos:  # keep the file name as it is (np.save may append ".npy")
+        np.save(fout_clip_pos, a_counts)
+
+####load the counts of one chromosome saved in "sf_prefix + CLIP_POS_NPY_SUFFIX" (or "sf_prefix + sf_npy_suffix")
+####clip position text files ("sf_prefix + CLIP_POS_SUFFIX") generated by earlier runs are also supported
+####return (structured array, loaded file), or (None, "") if neither exists
+def load_clip_pos(sf_prefix, l_fields, sf_npy_suffix=None):
+    if sf_npy_suffix is not None:
+        sf_clip_pos = sf_prefix + sf_npy_suffix
+        if os.path.isfile(sf_clip_pos) == True:
+            return np.load(sf_clip_pos), sf_clip_pos
+        return None, ""
+    sf_clip_pos = sf_prefix + global_values.CLIP_POS_NPY_SUFFIX
+    if os.path.isfile(sf_clip_pos) == True:
+        return np.load(sf_clip_pos), sf_clip_pos
+    sf_clip_pos = sf_prefix + global_values.CLIP_POS_SUFFIX
+    if os.path.isfile(sf_clip_pos) == False:
+        return None, ""
+    a_counts = np.zeros(0, dtype=get_clip_pos_dtype(l_fields))
+    if os.path.getsize(sf_clip_pos) > 0:
+        a_values = np.loadtxt(sf_clip_pos, dtype=np.int64, ndmin=2)
+        a_counts = np.zeros(len(a_values), dtype=get_clip_pos_dtype(l_fields))
+        a_counts["pos"] = a_values[:, 0]
+        for i_field, s_field in enumerate(l_fields):
+            a_counts[s_field] = a_values[:, i_field + 1]
+        a_counts = np.sort(a_counts, order="pos")
+    return a_counts, sf_clip_pos
+
+####sum the counts of the same position from several parts (e.g. the scan units of one chromosome)
+def merge_clip_pos(l_counts, l_fields):
+    if len(l_counts) == 0:
+        return np.zeros(0, dtype=get_clip_pos_dtype(l_fields))
+    a_all = np.concatenate(l_counts)
+    if len(a_all) == 0:
+        return a_all
+    a_all = a_all[np.argsort(a_all["pos"], kind="stable")]
+    a_uniq, a_first = np.unique(a_all["pos"], return_index=True)
+    a_counts = np.zeros(len(a_uniq), dtype=get_clip_pos_dtype(l_fields))
+    a_counts["pos"] = a_uniq
+    for s_field in l_fields:
+        a_counts[s_field] = np.add.reduceat(a_all[s_field], a_first)
+    return a_counts
+####
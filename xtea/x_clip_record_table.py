@@ -0,0 +1,106 @@
+##10/18/2026
+####Compact names of the clipped parts sent to the realignment (locus pipeline).
+####Each clipped part is named by an integer record id instead of the SEPARATOR joined provenance fields. The
+####provenance (chromosome, clip position, clip side, read number, mate position and original read name) is saved
+####in a side table (structured array, sorted by record id) of the run, and looked up by id when the realignments
+####are counted.
+####The id of a part is (scan unit index << CLIP_RECORD_UNIT_SHIFT) + (index of the part in the unit), so the scan
+####units name their parts independently, and the tables of the units are stitched by the main process.
+
+import os
+import numpy as np
+import global_values
+from x_bam_stamp import is_bam_stamp_matched
+
+#tid and mate_tid are the reference ids in the bam (mate_tid is -1 if the mate is unmapped)
+CLIP_RECORD_DTYPE = [("rid", "i8"), ("tid", "i4"), ("map_pos", "i8"), ("mate_tid", "i4"), ("mate_pos", "i8"),
+                     ("b_left", "?"), ("b_first", "?"), ("qname", "S")]
+
+#query names are saved as fixed length bytes, so the table can be saved/loaded without pickle
+def get_clip_record_dtype(i_max_name):
+    l_dtype = []
+    for (s_field, s_type) in CLIP_RECORD_DTYPE:
+        if s_field == "qname":
+            s_type = "S{0}".format(i_max_name)
+        l_dtype.append((s_field, s_type))
+    return l_dtype
+
+####Records of the clipped parts written by one scan unit
+class XClipRecordWriter():
+    def __init__(self, i_unit):
+        self.i_base = i_unit << global_values.CLIP_RECORD_UNIT_SHIFT
+        self.l_records = []
+
+    ####return the name of the new clipped part
+    def add(self, tid, map_pos, mate_tid, mate_pos, b_left, b_first, query_name):
+        rid = self.i_base + len(self.l_records)
+        self.l_records.append((rid, tid, map_pos, mate_tid, mate_pos, b_left, b_first, query_name.encode()))
+        return str(rid)
+
+    def save(self, sf_table):
+        i_max_name = 1
+        for rcd in self.l_records:
+            if len(rcd[-1]) > i_max_name:
+                i_max_name = len(rcd[-1])
+        save_clip_records(sf_table, np.array(self.l_records, dtype=get_clip_record_dtype(i_max_name)))
+####
+
+def save_clip_records(sf_table, a_records):
+    with open(sf_table, "wb") as fout_table:  # keep the file name as it is (np.save may append ".npy")
+        np.save(fout_table, a_records)
+
+####stitch the tables of the scan units into the table of the run, and remove the unit tables
+def merge_clip_records(l_sf_tables, sf_table):
+    l_records = []
+    i_max_name = 1
+    for sf_part in l_sf_tables:
+        if os.path.isfile(sf_part) == False:
+            continue
+        a_records = np.load(sf_part)
+        if a_records.dtype["qname"].itemsize > i_max_name:
+            i_max_name = a_records.dtype["qname"].itemsize
+        l_records.append(a_records)
+    l_records = [a_records.astype(get_clip_record_dtype(i_max_name)) for a_records in l_records]
+    a_all = np.zeros(0, dtype=get_clip_record_dtype(i_max_name))
+    if len(l_records) > 0:
+        a_all = np.concatenate(l_records)
+        a_all = a_all[np.argsort(a_all["rid"], kind="stable")]
+    save_clip_records(sf_table, a_all)
+    for sf_part in l_sf_tables:
+        if os.path.isfile(sf_part) == True:
+            os.remove(sf_part)
+
+####Lookup of the provenance of the realigned clipped parts by name
+####sf_bam: if set, the table is only loaded if it was saved from the same bam (see "x_bam_stamp")
+class XClipRecordTable():
+    def __init__(self, sf_table, sf_bam=None):
+        self.a_records = None
+        if os.path.isfile(sf_table) == False:
+            return
+        if sf_bam is not None and is_bam_stamp_matched(sf_table + global_values.BAM_STAMP_SUFFIX, sf_bam) == False:
+            print("Error: clip record table {0} is not saved from {1}, skipped!!!".format(sf_table, sf_bam))
+            return
+        self.a_records = np.load(sf_table, mmap_mode="r")
+
+    def is_available(self):
+        return self.a_records is not None
+
+    ####whether the name is a record id (names of earlier runs are SEPARATOR joined fields)
+    def is_record_name(self, s_name):
+        return s_name.isdigit()
+
+    ####return the rows (in the same order) of the record ids, and whether each id is found
+    def lookup(self, l_rids):
+        a_rids = np.array(l_rids, dtype=np.int64)
+        if self.a_records is None or len(self.a_records) == 0:
+            return np.zeros(len(a_rids), dtype=self._get_dtype()), np.zeros(len(a_rids), dtype=bool)
+        a_idx = np.searchsorted(self.a_records["rid"], a_rids)
+        a_idx[a_idx >= len(self.a_records)] = 0
+        a_rows = self.a_records[a_idx]
+        return a_rows, a_rows["rid"] == a_rids
+
+    def _get_dtype(self):
+        if self.a_records is None:
+            return get_clip_record_dtype(1)
+        return self.a_records.dtype
+####
@@ -7,10 +7,23 @@
 import os
 import pysam
 import random
+from array import array
+import numpy as np
 from x_alignments import *
 from multiprocessing import Pool
 from x_reference import *
 from x_basic_info import *
+from x_bam_handle_cache import init_bam_handle_cache, get_bam_handle_and_registry
+
+####per-base depth of [win_start, win_end] (both inclusive) from the mapped blocks [start, end) of the reads,
+####accumulated in a difference array and then cumsum
+def calc_block_depth(a_starts, a_ends, win_start, win_end):
+    n_win = win_end - win_start + 1
+    a_starts = np.clip(np.asarray(a_starts, dtype=np.int64) - win_start, 0, n_win)
+    a_ends = np.clip(np.asarray(a_ends, dtype=np.int64) - win_start, 0, n_win)
+    a_keep = a_starts < a_ends
+    a_diff = np.bincount(a_starts[a_keep], minlength=n_win + 1) - np.bincount(a_ends[a_keep], minlength=n_win + 1)
+    return np.cumsum(a_diff[:n_win])
 
 def unwrap_self_calc_depth_for_site(arg, **kwarg):
     return ReadDepth._calc_depth_one_site(*arg, **kwarg)
@@ -28,9 +41,6 @@ class ReadDepth(X_BasicInfo):
         search_win=record[0][2]
         focal_win=record[0][3]
 
-        mlcov={}#save the coverage of left bases
-        mrcov={}#save the coverage of right bases
-
         start_pos = insertion_pos - search_win
         if start_pos <= 0:
             start_pos = 1
@@ -39,43 +49,19 @@ class ReadDepth(X_BasicInfo):
         sf_bam=record[1]
         working_folder = record[2]
 
-        bam_info = BamInfo(sf_bam, self.sf_reference)
-        b_with_chr = bam_info.is_chrm_contain_chr()
+        samfile, xregistry = get_bam_handle_and_registry(sf_bam, self.sf_reference)
+        b_with_chr = xregistry.is_chrm_contain_chr()
         chrm_in_bam = self._process_chrm_name(b_with_chr, chrm)
-        samfile = pysam.AlignmentFile(sf_bam, "rb", reference_filename=self.sf_reference)
-        for algnmt in samfile.fetch(chrm_in_bam, start_pos, end_pos):  ##fetch reads mapped to "chrm:start_pos-end_pos"
-            ##here need to skip the secondary and supplementary alignments
-            # if algnmt.is_secondary or algnmt.is_supplementary:
-            #     continue
-            if algnmt.is_duplicate == True:  ##duplciate
-                continue
-            if algnmt.is_unmapped == True:  ##unmapped
-                continue
-            map_pos = algnmt.reference_start #mapping position
-            l_cigar = algnmt.cigar
-            tmp_end_pos=self._get_map_end_pos(l_cigar, map_pos)
-            lfocal_start=insertion_pos-focal_win
-            lfocal_end=insertion_pos
-            rfocal_start=insertion_pos+1
-            rfocal_end=insertion_pos+focal_win
-            #print map_pos, tmp_end_pos, insertion_pos
-            for i in range(map_pos, tmp_end_pos):
-                if i>=lfocal_start and i<=lfocal_end:
-                    if i not in mlcov:
-                        mlcov[i]=1
-                    else:
-                        mlcov[i]+=1
-                if i>=rfocal_start and i<=rfocal_end:
-                    if i not in mrcov:
-                        mrcov[i]=1
-                    else:
-                        mrcov[i]+=1
-        samfile.close()
-
-        #calc the coverage
-        flcov=self.__calc_coverage(mlcov, focal_win)
-        frcov=self.__calc_coverage(mrcov, focal_win)
-
+        #the reads around the site are already saved by the clip step, then no need to decode the bam again
+        xstore = get_evidence_store(working_folder, sf_bam)
+        if (xstore is not None) and xstore.is_covered(chrm_in_bam, start_pos, end_pos) == True:
+            a_reads = xstore.fetch(chrm_in_bam, start_pos, end_pos)
+            flcov, frcov = self._calc_depth_from_evidence(a_reads, insertion_pos, [focal_win])
+            return (chrm, insertion_pos, flcov, frcov)
+
+        ##fetch reads mapped to "chrm:start_pos-end_pos"
+        flcov, frcov = self._calc_depth_of_reads(samfile.fetch(chrm_in_bam, start_pos, end_pos), insertion_pos,
+                                                 [focal_win])
         return (chrm, insertion_pos, flcov, frcov)
 
 ####
@@ -97,7 +83,7 @@ class ReadDepth(X_BasicInfo):
                         pos = int(fields[1])#candidate insertion site
                         l_records.append(((chrm, pos, search_win, focal_win), sf_bam, self.working_folder))
 
-                pool = Pool(self.n_jobs)
+                pool = Pool(self.n_jobs, initializer=init_bam_handle_cache)
                 l_sites_cov=pool.map(unwrap_self_calc_depth_for_site, list(zip([self] * len(l_records), l_records)), 1)
                 pool.close()
                 pool.join()
@@ -129,10 +115,6 @@ class ReadDepth(X_BasicInfo):
         focal_win = record[0][3]
         focal_win2=record[0][4]
 
-        mlcov = {}  # save the coverage of left bases
-        mrcov = {}  # save the coverage of right bases
-        mlcov2 = {}  # save the coverage of left bases
-        mrcov2 = {} # save the coverage of right bases
         start_pos = insertion_pos - search_win
         if start_pos <= 0:
             start_pos = 1
@@ -142,62 +124,19 @@ class ReadDepth(X_BasicInfo):
         sf_bam = record[1]
         working_folder = record[2]
 
-        bam_info = BamInfo(sf_bam, self.sf_reference)
-        b_with_chr = bam_info.is_chrm_contain_chr()
+        samfile, xregistry = get_bam_handle_and_registry(sf_bam, self.sf_reference)
+        b_with_chr = xregistry.is_chrm_contain_chr()
         chrm_in_bam = self._process_chrm_name(b_with_chr, chrm)
-        samfile = pysam.AlignmentFile(sf_bam, "rb", reference_filename=self.sf_reference)
-        for algnmt in samfile.fetch(chrm_in_bam, start_pos, end_pos):  ##fetch reads mapped to "chrm:start_pos-end_pos"
-            ##here need to skip the secondary and supplementary alignments
-            # if algnmt.is_secondary or algnmt.is_supplementary:
-            #     continue
-            if algnmt.is_duplicate == True:  ##duplciate
-                continue
-            if algnmt.is_unmapped == True:  ##unmapped
-                continue
-            map_pos = algnmt.reference_start  ##mapping position
-            l_cigar = algnmt.cigar
-            tmp_end_pos = self._get_map_end_pos(l_cigar, map_pos)
-            lfocal_start = insertion_pos - focal_win
-            lfocal_end = insertion_pos
-            rfocal_start = insertion_pos + 1
-            rfocal_end = insertion_pos + focal_win
-
-            lfocal_start2 = insertion_pos - focal_win2
-            lfocal_end2 = insertion_pos
-            rfocal_start2 = insertion_pos + 1
-            rfocal_end2 = insertion_pos + focal_win2
-            # print map_pos, tmp_end_pos, insertion_pos
-            for i in range(map_pos, tmp_end_pos):
-                if i >= lfocal_start and i <= lfocal_end:
-                    if i not in mlcov:
-                        mlcov[i] = 1
-                    else:
-                        mlcov[i] += 1
-                if i >= rfocal_start and i <= rfocal_end:
-                    if i not in mrcov:
-                        mrcov[i] = 1
-                    else:
-                        mrcov[i] += 1
-
-                if i >= lfocal_start2 and i <= lfocal_end2:
-                    if i not in mlcov2:
-                        mlcov2[i] = 1
-                    else:
-                        mlcov2[i] += 1
-                if i >= rfocal_start2 and i <= rfocal_end2:
-                    if i not in mrcov2:
-                        mrcov2[i] = 1
-                    else:
-                        mrcov2[i] += 1
-        samfile.close()
-
-        # calc the coverage
-        flcov = self.__calc_coverage(mlcov, focal_win)
-        frcov = self.__calc_coverage(mrcov, focal_win)
-
-        flcov2 = self.__calc_coverage(mlcov2, focal_win2)
-        frcov2 = self.__calc_coverage(mrcov2, focal_win2)
-
+        #the reads around the site are already saved by the clip step, then no need to decode the bam again
+        xstore = get_evidence_store(working_folder, sf_bam)
+        if (xstore is not None) and xstore.is_covered(chrm_in_bam, start_pos, end_pos) == True:
+            a_reads = xstore.fetch(chrm_in_bam, start_pos, end_pos)
+            flcov, frcov, flcov2, frcov2 = self._calc_depth_from_evidence(a_reads, insertion_pos, [focal_win, focal_win2])
+            return (chrm, insertion_pos, flcov, frcov, flcov2, frcov2)
+
+        ##fetch reads mapped to "chrm:start_pos-end_pos"
+        flcov, frcov, flcov2, frcov2 = self._calc_depth_of_reads(samfile.fetch(chrm_in_bam, start_pos, end_pos),
+                                                                 insertion_pos, [focal_win, focal_win2])
         return (chrm, insertion_pos, flcov, frcov, flcov2, frcov2)
 
     ####
@@ -218,7 +157,7 @@ class ReadDepth(X_BasicInfo):
                     for pos in m_sites[chrm]:
                         l_records.append(((chrm, pos, search_win, focal_win, focal_win2), sf_bam, self.working_folder))
 
-                pool = Pool(self.n_jobs)
+                pool = Pool(self.n_jobs, initializer=init_bam_handle_cache)
                 l_sites_cov=pool.map(unwrap_self_calc_depth_for_site2, list(zip([self] * len(l_records), l_records)), 1)
                 pool.close()
                 pool.join()
@@ -268,7 +207,7 @@ class ReadDepth(X_BasicInfo):
         for (chrm, pos) in l_sites:
             l_records.append(((chrm, pos, search_win, focal_win), sf_bam, self.working_folder))
 
-        pool = Pool(self.n_jobs)
+        pool = Pool(self.n_jobs, initializer=init_bam_handle_cache)
         l_tmp_cov=pool.map(unwrap_self_calc_depth_for_site, list(zip([self] * len(l_records), l_records)), 1)
         pool.close()
         pool.join()
@@ -329,9 +268,51 @@ class ReadDepth(X_BasicInfo):
                 end_pos += lenth
         return end_pos
 
-    def __calc_coverage(self, mcov, win_size):
-        isum=0
-        for tmp_pos in mcov:
-            isum+=mcov[tmp_pos]
-        fcov=float(isum)/float(win_size)
-        return fcov
\ No newline at end of file
+    ####calc the left and right focal depth of the site from the reads, for each of the focal windows
+    ####the mapped span of each read is added to a difference array over the focal windows, and the per-base depth is
+    ####the cumsum of the array, so the cost is one update per read instead of one per covered base
+    ####return: [left depth of win1, right depth of win1, left depth of win2, ...]
+    def _calc_depth_of_reads(self, iter_reads, insertion_pos, l_focal_wins):
+        a_starts = array("q")
+        a_ends = array("q")
+        for algnmt in iter_reads:
+            ##here need to skip the secondary and supplementary alignments
+            # if algnmt.is_secondary or algnmt.is_supplementary:
+            #     continue
+            if algnmt.is_duplicate == True:  ##duplciate
+                continue
+            if algnmt.is_unmapped == True:  ##unmapped
+                continue
+            map_pos = algnmt.reference_start #mapping position
+            a_starts.append(map_pos)
+            a_ends.append(self._get_map_end_pos(algnmt.cigar, map_pos))
+
+        i_max_win = max(l_focal_wins)
+        win_start = insertion_pos - i_max_win
+        a_depth = calc_block_depth(np.frombuffer(a_starts, dtype=np.int64), np.frombuffer(a_ends, dtype=np.int64),
+                                   win_start, insertion_pos + i_max_win)
+        a_cum = np.concatenate(([0], np.cumsum(a_depth)))  # sum of depth of [win_start, pos) is a_cum[pos-win_start]
+        l_depth = []
+        for focal_win in l_focal_wins:
+            #left: [insertion_pos-focal_win, insertion_pos], right: [insertion_pos+1, insertion_pos+focal_win]
+            i_lsum = a_cum[i_max_win + 1] - a_cum[i_max_win - focal_win]
+            i_rsum = a_cum[i_max_win + focal_win + 1] - a_cum[i_max_win + 1]
+            l_depth.append(float(i_lsum) / float(focal_win))
+            l_depth.append(float(i_rsum) / float(focal_win))
+        return l_depth
+
+    ####same as "_calc_depth_of_reads", with the reads from the evidence store
+    def _calc_depth_from_evidence(self, a_reads, insertion_pos, l_focal_wins):
+        l_depth = []
+        for focal_win in l_focal_wins:
+            l_depth.append(float(self._sum_depth_from_evidence(a_reads, insertion_pos - focal_win, insertion_pos))
+                           / float(focal_win))
+            l_depth.append(float(self._sum_depth_from_evidence(a_reads, insertion_pos + 1, insertion_pos + focal_win))
+                           / float(focal_win))
+        return l_depth
+
+    #sum of the covered bases within [focal_start, focal_end] (both inclusive), same as summing up "mcov"
+    def _sum_depth_from_evidence(self, a_reads, focal_start, focal_end):
+        a_start = np.maximum(a_reads["start"], focal_start)
+        a_end = np.minimum(a_reads["map_end"], focal_end + 1)
+        return int(np.maximum(a_end - a_start, 0).sum())
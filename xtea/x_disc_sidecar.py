@@ -0,0 +1,176 @@
+##10/18/2026
+####Discordant read sidecar of one bam, written once by the first scan (clip step) and queried by the later steps.
+####Only the anchor reads that may be counted as discordant are kept: mapped, mate mapped, not duplicate, secondary or
+####supplementary, mapq >= MINIMUM_DISC_MAPQ, and mate on another chromosome or more than DISC_SIDECAR_MIN_MATE_DIST
+####away. One columnar array (sorted by anchor position) and the scanned windows are saved for each chromosome.
+####The whole genome clip step scans whole chromosomes, the locus clip step derives the sidecar from the evidence store
+####(so only the scanned windows are covered). Regions not covered are counted from the bam as before.
+
+import os
+import numpy as np
+import global_values
+from x_evidence_scanner import FLAG_UNMAPPED, FLAG_MATE_UNMAPPED, FLAG_SECONDARY, FLAG_DUPLICATE, FLAG_SUPPLEMENTARY
+from x_bam_stamp import get_bam_key, save_bam_stamp, is_bam_stamp_matched
+
+DISC_SIDECAR_DTYPE = [("pos", "i8"), ("end", "i8"), ("mate_tid", "i4"), ("mate_pos", "i8"), ("flag", "u2"),
+                      ("mapq", "u1")]
+DISC_SKIP_FLAG = FLAG_DUPLICATE | FLAG_SUPPLEMENTARY | FLAG_UNMAPPED | FLAG_MATE_UNMAPPED | FLAG_SECONDARY
+
+####Collect the discordant reads of one chromosome while scanning it
+class XDiscSidecarWriter():
+    def __init__(self, tid, i_min_mate_dist=None):
+        self.tid = tid
+        self.i_min_mate_dist = i_min_mate_dist
+        if i_min_mate_dist is None:
+            self.i_min_mate_dist = global_values.DISC_SIDECAR_MIN_MATE_DIST
+        self.l_reads = []
+        self.i_max_span = 0
+
+    def add(self, algnmt):
+        if (algnmt.flag & DISC_SKIP_FLAG) != 0:
+            return
+        if algnmt.mapping_quality < global_values.MINIMUM_DISC_MAPQ or algnmt.next_reference_id < 0:
+            return
+        map_pos = algnmt.reference_start
+        mate_pos = algnmt.next_reference_start
+        if algnmt.next_reference_id == self.tid and abs(mate_pos - map_pos) <= self.i_min_mate_dist:
+            return
+        map_end = algnmt.reference_end
+        if map_end is None:
+            map_end = map_pos + 1
+        if map_end - map_pos > self.i_max_span:
+            self.i_max_span = map_end - map_pos
+        self.l_reads.append((map_pos, map_end, algnmt.next_reference_id, mate_pos, algnmt.flag,
+                             algnmt.mapping_quality))
+
+    def get_reads(self):
+        a_reads = np.array(self.l_reads, dtype=DISC_SIDECAR_DTYPE)
+        return a_reads[np.argsort(a_reads["pos"], kind="stable")]
+
+    def get_max_span(self):
+        return self.i_max_span
+####
+
+####select the discordant reads from the evidence reads (EVIDENCE_READ_DTYPE) of one chromosome
+def select_disc_reads(a_reads, tid, i_min_mate_dist=None):
+    if i_min_mate_dist is None:
+        i_min_mate_dist = global_values.DISC_SIDECAR_MIN_MATE_DIST
+    a_keep = ((a_reads["flag"] & DISC_SKIP_FLAG) == 0) & (a_reads["mapq"] >= global_values.MINIMUM_DISC_MAPQ) \
+             & (a_reads["mate_tid"] >= 0)
+    a_keep &= (a_reads["mate_tid"] != tid) | (np.abs(a_reads["mate_pos"] - a_reads["start"]) > i_min_mate_dist)
+    a_sel = a_reads[a_keep]
+    a_disc = np.zeros(len(a_sel), dtype=DISC_SIDECAR_DTYPE)
+    a_disc["pos"] = a_sel["start"]
+    for s_field in ["end", "mate_tid", "mate_pos", "flag", "mapq"]:
+        a_disc[s_field] = a_sel[s_field]
+    return a_disc
+####
+
+####Sidecar of one bam: one "reads" and one "windows" array per chromosome, and an info file
+class XDiscSidecar():
+    def __init__(self, working_folder, sf_bam):
+        if len(working_folder) > 0 and working_folder[-1] != "/":
+            working_folder += "/"
+        self.sf_bam = sf_bam
+        self.sf_folder = working_folder + global_values.DISC_SIDECAR_FOLDER + "/" + get_bam_key(sf_bam) + "/"
+        self.m_reads = {}
+        self.m_windows = {}
+        self.i_min_mate_dist = None
+
+    def _get_reads_file(self, chrm):
+        return self.sf_folder + chrm + global_values.DISC_SIDECAR_SUFFIX
+
+    def _get_windows_file(self, chrm):
+        return self.sf_folder + chrm + global_values.DISC_SIDECAR_WINDOWS_SUFFIX
+
+    def _get_info_file(self):
+        return self.sf_folder + global_values.DISC_SIDECAR_INFO
+
+    ####the sidecar is complete, and saved from the current version of the bam
+    def is_available(self):
+        if os.path.isfile(self._get_info_file()) == False:
+            return False
+        return is_bam_stamp_matched(self.sf_folder + global_values.BAM_STAMP_FILE, self.sf_bam)
+
+    ####l_windows: [(fetch_start, fetch_end, max_read_span)]
+    def save_chrm(self, chrm, a_reads, l_windows):
+        if os.path.exists(self.sf_folder) == False:
+            os.makedirs(self.sf_folder, exist_ok=True)
+        np.save(self._get_reads_file(chrm), a_reads)
+        np.save(self._get_windows_file(chrm), np.array(l_windows, dtype=np.int64).reshape(-1, 3))
+
+    ####called once all the chromosomes are saved, this marks the sidecar as available
+    def save_info(self, i_min_mate_dist=None):
+        if i_min_mate_dist is None:
+            i_min_mate_dist = global_values.DISC_SIDECAR_MIN_MATE_DIST
+        if os.path.exists(self.sf_folder) == False:
+            os.makedirs(self.sf_folder, exist_ok=True)
+        save_bam_stamp(self.sf_folder + global_values.BAM_STAMP_FILE, self.sf_bam)
+        with open(self._get_info_file(), "w") as fout_info:
+            fout_info.write("{0}\n".format(i_min_mate_dist))
+
+    ####remove the outputs of an earlier run, before the chromosomes are saved again
+    def clean(self):
+        if os.path.isfile(self._get_info_file()) == True:
+            os.remove(self._get_info_file())
+
+    def _get_min_mate_dist(self):
+        if self.i_min_mate_dist is None:
+            with open(self._get_info_file()) as fin_info:
+                self.i_min_mate_dist = int(fin_info.readline().rstrip())
+        return self.i_min_mate_dist
+
+    def _load_chrm(self, chrm):
+        if chrm in self.m_windows:
+            return True
+        sf_windows = self._get_windows_file(chrm)
+        if os.path.isfile(sf_windows) == False:
+            return False
+        self.m_windows[chrm] = np.load(sf_windows)
+        self.m_reads[chrm] = np.load(self._get_reads_file(chrm), mmap_mode="r")
+        return True
+
+    def _get_max_span(self, chrm):
+        a_windows = self.m_windows[chrm]
+        if len(a_windows) == 0:
+            return 0
+        return int(a_windows[:, 2].max())
+
+    ####check whether the discordant pairs of [start, end) can be counted from the sidecar:
+    ####the region was scanned, and all the same chromosome pairs counted with insert size "i_is" were kept.
+    ####Such pairs are more than (i_is - distance of the read to "start") away, see "cnt_discordant_pairs"
+    def can_count_disc(self, chrm, start, end, i_is):
+        if self._load_chrm(chrm) == False:
+            return False
+        a_windows = self.m_windows[chrm]
+        idx = int(np.searchsorted(a_windows[:, 0], start, side="right")) - 1
+        if idx < 0 or end > a_windows[idx][1]:
+            return False
+        return i_is - max(end - start, self._get_max_span(chrm)) >= self._get_min_mate_dist()
+
+    ####return the discordant reads overlapping [start, end), in format of DISC_SIDECAR_DTYPE
+    ####the array has the fields used by "BamInfo.cnt_discordant_pairs_from_evidence"
+    def fetch(self, chrm, start, end):
+        if self._load_chrm(chrm) == False:
+            return np.zeros(0, dtype=DISC_SIDECAR_DTYPE)
+        a_reads = self.m_reads[chrm]
+        i_lo = int(np.searchsorted(a_reads["pos"], start - self._get_max_span(chrm), side="left"))
+        i_hi = int(np.searchsorted(a_reads["pos"], end, side="left"))
+        a_hits = a_reads[i_lo:i_hi]
+        return a_hits[a_hits["end"] > start]
+####
+
+####Return the sidecar of the bam if it was saved by the clip step, otherwise None.
+####Same as the evidence store, the parent of the working folder is also checked, and the sidecar is only used if it
+####was saved from the same bam
+def get_disc_sidecar(working_folder, sf_bam):
+    l_folders = [working_folder]
+    s_parent = os.path.dirname(working_folder.rstrip("/"))
+    if len(s_parent) > 0:
+        l_folders.append(s_parent)
+    for s_tmp_folder in l_folders:
+        xsidecar = XDiscSidecar(s_tmp_folder, sf_bam)
+        if xsidecar.is_available() == True:
+            return xsidecar
+    return None
+####
@@ -0,0 +1,293 @@
+##10/18/2026
+####Single pass evidence scanner for the locus pipeline.
+####For each bam and chromosome, the windows around the predefined loci are decoded only once. Every read is:
+####1. summarized into the evidence store (position, flag, clip, mate and polyA information);
+####2. passed back to the caller (clip collection) if it overlaps the focal (+/-NEARBY_REGION) window of a locus.
+####The later steps (discordant pairs, depth and genotype features) then query the store instead of the bam, if the
+####queried region is fully covered by the scanned windows.
+
+import os
+import numpy as np
+import global_values
+from x_polyA import PolyA
+from x_region_planner import XRegionPlanner
+from x_bam_stamp import get_bam_key, save_bam_stamp, is_bam_stamp_matched
+
+#sam flags checked by the evidence consumers
+FLAG_UNMAPPED = 0x4
+FLAG_MATE_UNMAPPED = 0x8
+FLAG_REVERSE = 0x10
+FLAG_READ2 = 0x80
+FLAG_SECONDARY = 0x100
+FLAG_DUPLICATE = 0x400
+FLAG_SUPPLEMENTARY = 0x800
+
+#one record for each mapped, non-duplicate read with cigar
+#end is the "reference_end" used for fetching, map_end also counts the padding (same as ReadDepth)
+#rclip_pos is the map position of the right clip (map_pos plus the length of the cigar without the last operation)
+EVIDENCE_READ_DTYPE = [("start", "i8"), ("end", "i8"), ("map_end", "i8"), ("flag", "u2"), ("mapq", "u1"),
+                       ("mate_tid", "i4"), ("mate_pos", "i8"),
+                       ("lclip_type", "i1"), ("lclip_len", "i4"), ("rclip_type", "i1"), ("rclip_len", "i4"),
+                       ("rclip_pos", "i8"), ("full_map_len", "i4"), ("large_indel", "?"),
+                       ("lpolyA", "?"), ("rpolyA", "?"), ("qname", "S")]
+
+####Evidence saved for one bam: one "reads" and one "windows" array per chromosome
+class XEvidenceStore():
+    def __init__(self, working_folder, sf_bam):
+        if len(working_folder) > 0 and working_folder[-1] != "/":
+            working_folder += "/"
+        self.sf_bam = sf_bam
+        self.sf_folder = working_folder + global_values.EVIDENCE_FOLDER + "/" + get_bam_key(sf_bam) + "/"
+        self.m_reads = {}
+        self.m_windows = {}
+        self.l_references = None
+
+    def get_folder(self):
+        return self.sf_folder
+
+    def _get_reads_file(self, chrm):
+        return self.sf_folder + chrm + global_values.EVIDENCE_READS_SUFFIX
+
+    def _get_windows_file(self, chrm):
+        return self.sf_folder + chrm + global_values.EVIDENCE_WINDOWS_SUFFIX
+
+    ####the store is complete, and saved from the current version of the bam
+    def is_available(self):
+        if os.path.isfile(self.sf_folder + global_values.EVIDENCE_REFERENCES) == False:
+            return False
+        return is_bam_stamp_matched(self.sf_folder + global_values.BAM_STAMP_FILE, self.sf_bam)
+
+    ####save the references (in order of tid) and the stamp of the bam, called once all the chromosomes are scanned,
+    ####this marks the store as available
+    def save_references(self, l_references):
+        if os.path.exists(self.sf_folder) == False:
+            os.makedirs(self.sf_folder, exist_ok=True)
+        save_bam_stamp(self.sf_folder + global_values.BAM_STAMP_FILE, self.sf_bam)
+        with open(self.sf_folder + global_values.EVIDENCE_REFERENCES, "w") as fout_ref:
+            for chrm in l_references:
+                fout_ref.write(chrm + "\n")
+
+    def get_references(self):
+        if self.l_references is None:
+            self.l_references = []
+            with open(self.sf_folder + global_values.EVIDENCE_REFERENCES) as fin_ref:
+                for line in fin_ref:
+                    self.l_references.append(line.rstrip())
+        return self.l_references
+
+    #the evidence of one chromosome may be scanned in several parts, each part is saved as a "chromosome" of its own
+    def _get_part_name(self, chrm, i_part):
+        return "{0}.part{1}".format(chrm, i_part)
+
+    ####l_windows: [(fetch_start, fetch_end, max_read_span)]
+    def save_chrm(self, chrm, l_reads, l_windows, i_part=None):
+        if os.path.exists(self.sf_folder) == False:
+            os.makedirs(self.sf_folder, exist_ok=True)
+        if i_part is not None:
+            chrm = self._get_part_name(chrm, i_part)
+        i_max_name = 1
+        for rcd in l_reads:
+            if len(rcd[-1]) > i_max_name:
+                i_max_name = len(rcd[-1])
+        a_reads = np.array(l_reads, dtype=self._get_disk_dtype(i_max_name))
+        np.save(self._get_reads_file(chrm), a_reads)
+        np.save(self._get_windows_file(chrm), np.array(l_windows, dtype=np.int64).reshape(-1, 3))
+
+    ####stitch the parts (scanned in order of position) of one chromosome into one, and remove the parts
+    def merge_chrm_parts(self, chrm, n_parts):
+        l_reads = []
+        l_windows = []
+        i_max_name = 1
+        for i_part in range(n_parts):
+            s_part = self._get_part_name(chrm, i_part)
+            a_reads = np.load(self._get_reads_file(s_part))
+            if a_reads.dtype["qname"].itemsize > i_max_name:
+                i_max_name = a_reads.dtype["qname"].itemsize
+            l_reads.append(a_reads)
+            l_windows.append(np.load(self._get_windows_file(s_part)))
+        l_reads = [a_reads.astype(self._get_disk_dtype(i_max_name)) for a_reads in l_reads]
+        np.save(self._get_reads_file(chrm), np.concatenate(l_reads))
+        np.save(self._get_windows_file(chrm), np.concatenate(l_windows).reshape(-1, 3))
+        for i_part in range(n_parts):
+            s_part = self._get_part_name(chrm, i_part)
+            os.remove(self._get_reads_file(s_part))
+            os.remove(self._get_windows_file(s_part))
+
+    #query names are saved as fixed length bytes, so the array can be saved/loaded without pickle
+    def _get_disk_dtype(self, i_max_name):
+        l_dtype = []
+        for (s_field, s_type) in EVIDENCE_READ_DTYPE:
+            if s_field == "qname":
+                s_type = "S{0}".format(i_max_name)
+            l_dtype.append((s_field, s_type))
+        return l_dtype
+
+    def _load_chrm(self, chrm):
+        if chrm in self.m_windows:
+            return True
+        sf_windows = self._get_windows_file(chrm)
+        if os.path.isfile(sf_windows) == False:
+            return False
+        self.m_windows[chrm] = np.load(sf_windows)
+        self.m_reads[chrm] = np.load(self._get_reads_file(chrm), mmap_mode="r")
+        return True
+
+    ####return the saved (reads, windows) arrays of the chromosome, or (None, None) if it was not scanned
+    def get_chrm(self, chrm):
+        if self._load_chrm(chrm) == False:
+            return None, None
+        return self.m_reads[chrm], self.m_windows[chrm]
+
+    ####check whether all the reads overlapping [start, end) were scanned
+    def is_covered(self, chrm, start, end):
+        if self._load_chrm(chrm) == False:
+            return False
+        a_windows = self.m_windows[chrm]
+        idx = int(np.searchsorted(a_windows[:, 0], start, side="right")) - 1
+        if idx < 0:
+            return False
+        return end <= a_windows[idx][1]
+
+    ####return the records of the reads overlapping [start, end), same as "samfile.fetch(chrm, start, end)"
+    ####the records are returned as a structured array in format of EVIDENCE_READ_DTYPE
+    def fetch(self, chrm, start, end):
+        if self._load_chrm(chrm) == False:
+            return np.zeros(0, dtype=self._get_disk_dtype(1))
+        #a read may be saved with an earlier window, so use the maximum span of the whole chromosome
+        a_windows = self.m_windows[chrm]
+        i_max_span = 0
+        if len(a_windows) > 0:
+            i_max_span = int(a_windows[:, 2].max())
+        a_reads = self.m_reads[chrm]
+        i_lo = int(np.searchsorted(a_reads["start"], start - i_max_span, side="left"))
+        i_hi = int(np.searchsorted(a_reads["start"], end, side="left"))
+        a_hits = a_reads[i_lo:i_hi]
+        return a_hits[a_hits["end"] > start]
+####
+
+####Return the evidence store of the bam if it was saved by the clip step, otherwise None.
+####The later steps may run in a sub-folder of the clip step working folder (e.g. "tmp/cns/"), so also check the parent.
+####A store is only used if it was saved from the same bam (real path, size and mtime)
+def get_evidence_store(working_folder, sf_bam):
+    l_folders = [working_folder]
+    s_parent = os.path.dirname(working_folder.rstrip("/"))
+    if len(s_parent) > 0:
+        l_folders.append(s_parent)
+    for s_tmp_folder in l_folders:
+        xstore = XEvidenceStore(s_tmp_folder, sf_bam)
+        if xstore.is_available() == True:
+            return xstore
+    return None
+####
+
+class XEvidenceScanner():
+    def __init__(self, working_folder, sf_bam):
+        self.xstore = XEvidenceStore(working_folder, sf_bam)
+        self.xpolyA = PolyA()
+
+    def get_store(self):
+        return self.xstore
+
+    ####plan the windows to scan for the given loci of one chromosome
+    ####return (focal_windows, l_scan): the disjoint focal (+/-NEARBY_REGION) windows as (l_sub_start, l_sub_end),
+    ####and the coalesced scan windows in format: [(fetch_start, fetch_end, sub_windows)]
+    def plan_locus_scan(self, l_locus, i_scan_extnd=None):
+        if i_scan_extnd is None:
+            i_scan_extnd = global_values.EVIDENCE_SCAN_EXTND
+        xplanner = XRegionPlanner()
+        l_focal = xplanner.coalesce_locus_windows(l_locus)
+        l_focal_start, l_focal_end = xplanner.flatten_sub_windows(l_focal)
+        l_scan_windows = xplanner.extend_windows(list(zip(l_focal_start, l_focal_end)), i_scan_extnd)
+        return (l_focal_start, l_focal_end), xplanner.coalesce_windows(l_scan_windows)
+
+    ####Stream the reads around the given loci of one chromosome only once.
+    ####All reads are summarized into the store, and those overlapping the focal windows are yielded to the caller
+    ####Note: the evidence is saved only after the generator is exhausted
+    def iter_locus_reads(self, samfile, chrm, l_locus, i_scan_extnd=None):
+        focal_windows, l_scan = self.plan_locus_scan(l_locus, i_scan_extnd)
+        for algnmt in self.iter_scan_windows(samfile, chrm, focal_windows, l_scan):
+            yield algnmt
+
+    ####Stream the reads of the given scan windows, which may be only part of the planned windows of the chromosome.
+    ####i_prev_end is the end of the last window scanned before (by another part), reads start before it are skipped.
+    ####If i_part is set, the evidence is saved as one part of the chromosome, see "XEvidenceStore.merge_chrm_parts"
+    def iter_scan_windows(self, samfile, chrm, focal_windows, l_scan, i_prev_end=-1, i_part=None):
+        xplanner = XRegionPlanner()
+        l_reads = []
+        l_windows = []
+        for (start_pos, end_pos, sub_windows) in l_scan:
+            i_max_span = 0
+            for algnmt in samfile.fetch(chrm, start_pos, end_pos):
+                if algnmt.reference_start < i_prev_end:  # already streamed with the previous window
+                    continue
+                if algnmt.is_unmapped == True:
+                    continue
+                if algnmt.cigartuples is None:  # no cigar, and "reference_end" is None
+                    continue
+                rcd = self._summarize_read(algnmt)
+                if rcd is not None:
+                    l_reads.append(rcd)
+                    if (rcd[1] - rcd[0]) > i_max_span:
+                        i_max_span = rcd[1] - rcd[0]
+                if xplanner.is_overlap_sub_windows(algnmt.reference_start, algnmt.reference_end, focal_windows):
+                    yield algnmt
+            l_windows.append((start_pos, end_pos, i_max_span))
+            i_prev_end = end_pos
+        self.xstore.save_chrm(chrm, l_reads, l_windows, i_part)
+
+    ####summarize one read with the fields needed by the discordant, depth and genotype features
+    def _summarize_read(self, algnmt):
+        if algnmt.is_duplicate == True:
+            return None
+        l_cigar = algnmt.cigartuples
+        if l_cigar is None or len(l_cigar) < 1:
+            return None
+        map_pos = algnmt.reference_start
+        b_rc = algnmt.is_reverse
+        query_seq = algnmt.query_sequence
+        if query_seq is None:
+            query_seq = ""
+
+        rclip_pos = map_pos
+        for (type, lenth) in l_cigar[:-1]:
+            if type == 4 or type == 5 or type == 1:  # (1 for insertion)
+                continue
+            rclip_pos += lenth
+
+        map_end = rclip_pos
+        if l_cigar[-1][0] != 4 and l_cigar[-1][0] != 5 and l_cigar[-1][0] != 1:
+            map_end += l_cigar[-1][1]
+
+        full_map_len = 0
+        if len(l_cigar) == 1 and l_cigar[0][0] == 0:  ##fully mapped
+            full_map_len = l_cigar[0][1]
+
+        b_large_indel = False
+        for (type, lenth) in l_cigar[:-1]:
+            if (type == 1 or type == 2) and (lenth >= global_values.LARGE_INDEL_IN_READ):
+                b_large_indel = True
+                break
+
+        #polyA of the clipped part close to the breakpoint (same as the genotype features)
+        b_lpolyA = False
+        if l_cigar[0][0] == 4:
+            clipped_seq = query_seq[:l_cigar[0][1]]
+            if b_rc == False:
+                s_clip_seq_ck = clipped_seq[-1 * global_values.CK_POLYA_SEQ_MAX:]
+            else:
+                s_clip_seq_ck = clipped_seq[:global_values.CK_POLYA_SEQ_MAX]
+            b_lpolyA = self.xpolyA.is_consecutive_polyA_T(s_clip_seq_ck)
+        b_rpolyA = False
+        if l_cigar[-1][0] == 4:
+            clipped_seq = query_seq[-1 * l_cigar[-1][1]:]
+            if b_rc == False:
+                s_clip_seq_ck = clipped_seq[:global_values.CK_POLYA_SEQ_MAX]
+            else:
+                s_clip_seq_ck = clipped_seq[-1 * global_values.CK_POLYA_SEQ_MAX:]
+            b_rpolyA = self.xpolyA.is_consecutive_polyA_T(s_clip_seq_ck)
+
+        return (map_pos, algnmt.reference_end, map_end, algnmt.flag, algnmt.mapping_quality,
+                algnmt.next_reference_id, algnmt.next_reference_start,
+                l_cigar[0][0], min(l_cigar[0][1], len(query_seq)), l_cigar[-1][0], min(l_cigar[-1][1], len(query_seq)),
+                rclip_pos, full_map_len, b_large_indel, b_lpolyA, b_rpolyA, algnmt.query_name)
+####
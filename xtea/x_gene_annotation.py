@@ -9,7 +9,7 @@
 ####update on 01/27/2019: replace the query module from binary tree (with bug) to interval tree
 
 import global_values
-from intervaltree import IntervalTree
+from x_interval_index import XIntervalIndex
 
 class GFF3():
     def __init__(self, sf_gff3):
@@ -18,7 +18,7 @@ class GFF3():
         #self.m_gene_chrm_regions = {}
         self.m_region_info={}#key: gene_name. Value:
         self.b_with_chr = True
-        self.m_interval_tree={}#by chrm
+        self.interval_index=XIntervalIndex()#by chrm
 
     # This indicates whether the chromosomes is in format "chr1" or "1"
     def set_with_chr(self, b_with_chr):
@@ -137,11 +137,10 @@ class GFF3():
 #
     def index_gene_annotation_interval_tree(self):
         for chrm in self.m_gene_annotation:
-            interval_tree=IntervalTree()
             for start_pos in self.m_gene_annotation[chrm]:
                 end_pos=self.m_gene_annotation[chrm][start_pos][0][0]
-                interval_tree.addi(start_pos, end_pos)
-            self.m_interval_tree[chrm] = interval_tree
+                self.interval_index.addi(chrm, start_pos, end_pos)
+        self.interval_index.build()
 
     # For a given position, check whether it falls in a region
     # If hit, then return "True, chrm, start_pos_of_region "
@@ -200,12 +199,7 @@ class GFF3():
     def query_by_position(self, chrm1, pos):
         l_hits=[]
         chrm = self._process_chrm_name2(chrm1)
-        if chrm not in self.m_interval_tree:
-            return l_hits
-        tmp_tree=self.m_interval_tree[chrm]
-        set_rslt=tmp_tree[pos]
-        for rcd in set_rslt:
-            start_pos=rcd[0]
+        for start_pos in self.interval_index.query_all(chrm, pos):
             l_hits.append(start_pos)
         return l_hits
 
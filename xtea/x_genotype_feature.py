@@ -7,11 +7,25 @@
 from x_alignments import *
 from global_values import *
 from x_polyA import *
-import pysam
+from x_bam_handle_cache import init_bam_handle_cache, get_bam_handle_and_registry
 
 def unwrap_self_collect_clip_disc_features(arg, **kwarg):
     return XGenotyper.collect_features_one_site(*arg, **kwarg)
 
+def unwrap_self_collect_features_of_sites(arg, **kwarg):
+    return XGenotyper.collect_features_of_sites(*arg, **kwarg)
+
+####Yield the results of "imap_unordered" in the order of the tasks, each result is in format (i_task, rslt).
+####The early finished ones are kept until all the tasks before them are yielded
+def iter_results_in_order(it_rslts):
+    m_waiting = {}
+    i_next = 0
+    for (i_task, rslt) in it_rslts:
+        m_waiting[i_task] = rslt
+        while i_next in m_waiting:
+            yield m_waiting.pop(i_next)
+            i_next += 1
+
 class XGntpFeatures():
     def __init__(self):
         self.n_lclip=0
@@ -56,64 +70,84 @@ class XGenotyper():
                 fields=line.split()
                 sf_bam=fields[0]
                 l_bams.append(sf_bam)
-        i_cnt = 0
-        for sf_bam in l_bams:
-            sf_out_features=sf_out+"{0}.out".format(i_cnt)
-            i_cnt+=1
-            # if len(l_bams) == 1:
-            #     sf_out_features = sf_out
-            l_chrm_records = []
-            with open(sf_candidate_list) as fin_list:
-                for line in fin_list:
-                    fields = line.split()
-                    chrm = fields[0]
-                    pos = int(fields[1])  # candidate insertion sites
-                    tmp_rcd=((chrm, pos, extnd), sf_bam, self.working_folder)
-                    l_chrm_records.append(tmp_rcd)
-                    #self.collect_features_one_site(tmp_rcd)
+        l_sites = []
+        m_sites = {}
+        m_chrm_order = {}
+        with open(sf_candidate_list) as fin_list:
+            for line in fin_list:
+                fields = line.split()
+                chrm = fields[0]
+                pos = int(fields[1])  # candidate insertion sites
+                if (chrm, pos) in m_sites:
+                    continue
+                m_sites[(chrm, pos)] = 1
+                l_sites.append((chrm, pos))
+                if chrm not in m_chrm_order:
+                    m_chrm_order[chrm] = len(m_chrm_order)
+        #sites of the same chrm are grouped, in the same order as the merged output of "merge_features_of_bams"
+        l_sites.sort(key=lambda x: m_chrm_order[x[0]])
+
+        #all the (site batch, bam) pairs are scheduled in one pool, the bams of the same batch are adjacent tasks
+        n_per_task = global_values.GNTP_SITES_PER_TASK
+        l_records = []
+        for i_start in range(0, len(l_sites), n_per_task):
+            for sf_bam in l_bams:
+                l_records.append((len(l_records), l_sites[i_start:i_start + n_per_task], extnd, sf_bam,
+                                  self.working_folder))
 ############
-            pool = Pool(self.n_jobs)
-            pool.map(unwrap_self_collect_clip_disc_features, list(zip([self] * len(l_chrm_records), l_chrm_records)), 1)
-            pool.close()
-            pool.join()
-
-            with open(sf_out_features, "w") as fout_all:
-                for rcd in l_chrm_records:
-                    chrm=rcd[0][0]
-                    ins_pos=rcd[0][1]
-                    s_pos_info = "{0}_{1}".format(chrm, ins_pos)
-                    sf_gntp_features = self.working_folder + s_pos_info + global_values.GNTP_FEATURE_SUFFIX
-                    if os.path.isfile(sf_gntp_features) == False:
-                        continue
-                    with open(sf_gntp_features) as fin_site:
-                        for line in fin_site:
-                            fout_all.write(line)
-                    os.remove(sf_gntp_features)
-
-        #merge the features of different bams
-        i_cnt=0
+        #the features are returned by the workers, and written here in the order of the tasks. Once the features of
+        #a batch are collected from all the bams, they are merged and written out
+        l_fout_bams = [open(sf_out + "{0}.out".format(i_bam), "w") for i_bam in range(len(l_bams))]
+        pool = Pool(self.n_jobs, initializer=init_bam_handle_cache)
+        it_rslts = pool.imap_unordered(unwrap_self_collect_features_of_sites,
+                                       list(zip([self] * len(l_records), l_records)), 1)
+        with open(sf_merged_out, "w") as fout_merged:
+            l_batch = []
+            for l_site_features in iter_results_in_order(it_rslts):
+                i_bam = len(l_batch)
+                for (chrm, ins_pos, rcd_features) in l_site_features:
+                    l_fout_bams[i_bam].write(self._format_site_features(chrm, ins_pos, rcd_features))
+                l_batch.append(l_site_features)
+                if len(l_batch) < len(l_bams):
+                    continue
+                for i_site in range(len(l_batch[0])):
+                    (chrm, ins_pos, rcd_merged) = l_batch[0][i_site]
+                    for i_bam in range(1, len(l_bams)):
+                        rcd_merged = self._merge_features_of_site(rcd_merged, l_batch[i_bam][i_site][2])
+                    fout_merged.write(self._format_site_features(chrm, ins_pos, rcd_merged))
+                l_batch = []
+        pool.close()
+        pool.join()
+        for fout_bam in l_fout_bams:
+            fout_bam.close()
+
+    ####merge the features of the same site collected from two bams, by summing up the counts
+    def _merge_features_of_site(self, rcd_merged, rcd):
+        n_af_clip = int(rcd[0]) + int(rcd_merged[0])
+        n_full_map = int(rcd[1]) + int(rcd_merged[1])
+        n_l_raw_clip = int(rcd[2]) + int(rcd_merged[2])
+        n_r_raw_clip = int(rcd[3]) + int(rcd_merged[3])
+        n_disc_pairs = int(rcd[4]) + int(rcd_merged[4])
+        n_concd_pairs = int(rcd[5]) + int(rcd_merged[5])
+        n_disc_large_indel = int(rcd[6]) + int(rcd_merged[6])
+        s_clip_lens = rcd[7] + ":" + rcd_merged[7]
+        n_polyA = int(rcd[8]) + int(rcd_merged[8])
+        n_disc_chrms = int(rcd[9]) + int(rcd_merged[9])
+        return (n_af_clip, n_full_map, n_l_raw_clip, n_r_raw_clip, n_disc_pairs, n_concd_pairs, n_disc_large_indel,
+                s_clip_lens, n_polyA, n_disc_chrms)
+
+    ####merge the features (of the same sites) collected from different bams, by summing up the counts
+    def merge_features_of_bams(self, l_sf_features, sf_merged_out):
         with open(sf_merged_out, "w") as fout_merged:
             m_merged={}
-            for sf_bam in l_bams:
-                sf_out_features = sf_out + "{0}.out".format(i_cnt)
-                i_cnt += 1
+            for sf_out_features in l_sf_features:
                 m_info=self.load_in_features_from_file(sf_out_features)
                 for ins_chrm in m_info:
                     for ins_pos in m_info[ins_chrm]:
                         if (ins_chrm in m_merged) and (ins_pos in m_merged[ins_chrm]):
                             #merge the information
-                            n_af_clip = int(m_info[ins_chrm][ins_pos][0]) + int(m_merged[ins_chrm][ins_pos][0])
-                            n_full_map = int(m_info[chrm][pos][1]) + int(m_merged[ins_chrm][ins_pos][1])
-                            n_l_raw_clip = int(m_info[chrm][pos][2]) + int(m_merged[ins_chrm][ins_pos][2])
-                            n_r_raw_clip = int(m_info[chrm][pos][3]) + int(m_merged[ins_chrm][ins_pos][3])
-                            n_disc_pairs = int(m_info[chrm][pos][4]) + int(m_merged[ins_chrm][ins_pos][4])
-                            n_concd_pairs = int(m_info[chrm][pos][5]) + int(m_merged[ins_chrm][ins_pos][5])
-                            n_disc_large_indel = int(m_info[chrm][pos][6]) + int(m_merged[ins_chrm][ins_pos][6])
-                            s_clip_lens=m_info[chrm][pos][7]+":"+m_merged[ins_chrm][ins_pos][7]
-                            n_polyA=int(m_info[chrm][pos][8]) + int(m_merged[ins_chrm][ins_pos][8])
-                            n_disc_chrms=int(m_info[chrm][pos][9]) + int(m_merged[ins_chrm][ins_pos][9])
-                            m_merged[ins_chrm][ins_pos]=(n_af_clip, n_full_map, n_l_raw_clip, n_r_raw_clip, n_disc_pairs,
-                                           n_concd_pairs, n_disc_large_indel, s_clip_lens, n_polyA, n_disc_chrms)
+                            m_merged[ins_chrm][ins_pos]=self._merge_features_of_site(m_merged[ins_chrm][ins_pos],
+                                                                                     m_info[ins_chrm][ins_pos])
                         else:
                             if ins_chrm not in m_merged:
                                 m_merged[ins_chrm]={}
@@ -136,8 +170,8 @@ class XGenotyper():
     ####3. # of fully mapped reads bypass the site; 4. # of reads contain small indels
     ####5. clip position vector; 9. # of clipped reads nearby
     # 6. # of left-disc reads; 7. # of right-disc reads; 8. # of concordant pairs
-    #return info:
-    ####chrm pos n_af_clip n_full_map n_l_raw_clip n_r_raw_clip n_disc_pairs n_concd_pairs n_disc_large_indel s_clip_lens
+    #return info: (chrm, pos, features), the features are in format:
+    ####n_af_clip n_full_map n_l_raw_clip n_r_raw_clip n_disc_pairs n_concd_pairs n_disc_large_indel s_clip_lens
     def collect_features_one_site(self, record):
         chrm = record[0][0]  ##this is the chrm style in candidate list
         ins_pos = record[0][1]
@@ -149,11 +183,45 @@ class XGenotyper():
         sf_bam = record[1]
         working_folder = record[2]
 
-        bam_info = BamInfo(sf_bam, self.sf_reference)
-        b_with_chr = bam_info.is_chrm_contain_chr()
+        samfile, xregistry = get_bam_handle_and_registry(sf_bam, self.sf_reference) #mates are checked by tid
+        b_with_chr = xregistry.is_chrm_contain_chr()
         chrm_in_bam = self._process_chrm_name(b_with_chr, chrm)
-        samfile = pysam.AlignmentFile(sf_bam, "rb", reference_filename=self.sf_reference)
-        m_chrm_id=self._get_chrm_id_name(samfile)
+####
+        #the reads around the site are already saved by the clip step, then no need to decode the bam again
+        xstore = get_evidence_store(working_folder, sf_bam)
+        if (xstore is not None) and xstore.is_covered(chrm_in_bam, start_pos, end_pos) == True:
+            rcd_features = self._collect_features_from_evidence(xstore, chrm_in_bam, xregistry, ins_pos, start_pos, end_pos)
+        else:
+            ##fetch reads mapped to "chrm:start_pos-end_pos"
+            rcd_features = self._collect_features_from_reads(samfile.fetch(chrm_in_bam, start_pos, end_pos), chrm_in_bam,
+                                                             xregistry, ins_pos)
+
+        if global_values.KEEP_SITE_FEATURE_FILES == True:#debug only, save the genotype features of the site
+            s_pos_info = "{0}_{1}".format(chrm, ins_pos)
+            sf_gntp_features = working_folder + s_pos_info + global_values.GNTP_FEATURE_SUFFIX
+            with open(sf_gntp_features, "w") as f_gntp_fetures:
+                f_gntp_fetures.write(self._format_site_features(chrm, ins_pos, rcd_features))
+        return (chrm, ins_pos, rcd_features)
+
+    ####collect the features of a batch of sites in one bam
+    ####record: (i_task, [(chrm, ins_pos)], extnd, sf_bam, working_folder)
+    ####return: (i_task, [(chrm, ins_pos, features)]), see "collect_features_one_site"
+    def collect_features_of_sites(self, record):
+        i_task, l_sites, extnd, sf_bam, working_folder = record
+        l_site_features = []
+        for (chrm, ins_pos) in l_sites:
+            l_site_features.append(self.collect_features_one_site(((chrm, ins_pos, extnd), sf_bam, working_folder)))
+        return (i_task, l_site_features)
+
+    ####one line of the feature file: chrm pos features
+    def _format_site_features(self, chrm, ins_pos, rcd_features):
+        return "{0}\t{1}\t".format(chrm, ins_pos) + "\t".join([str(i) for i in rcd_features]) + "\n"
+#
+####
+    ####collect the features of the site from the reads (fetched around the site)
+    ####return: (n_af_clip, n_full_map, n_l_raw_clip, n_r_raw_clip, n_disc_pairs, n_concd_pairs, n_disc_large_indel,
+    ####s_clip_lens, n_polyA, n_disc_chrms)
+    def _collect_features_from_reads(self, iter_reads, chrm_in_bam, xregistry, ins_pos):
         n_disc_pairs = 0
         n_concd_pairs = 0
         n_l_raw_clip = 0 #num of left clipped reads within the region
@@ -171,15 +239,10 @@ class XGenotyper():
         n_polyA=0 #number of polyA reads
         n_disc_chrms=0 #number of chromosomes the mate falls in
         m_mate_chrms={}
-####
-        s_pos_info = "{0}_{1}".format(chrm, ins_pos)
-        sf_gntp_features = working_folder + s_pos_info + global_values.GNTP_FEATURE_SUFFIX  #save the genotype features
-        f_gntp_fetures = open(sf_gntp_features, "w")
-
         l_check_concord=[]
         m_clip_qname={}
         xpolyA = PolyA()
-        for algnmt in samfile.fetch(chrm_in_bam, start_pos, end_pos):  ##fetch reads mapped to "chrm:start_pos-end_pos"
+        for algnmt in iter_reads:
             ##here need to skip the secondary and supplementary alignments?
             # if algnmt.is_secondary or algnmt.is_supplementary:
             #     continue
@@ -201,14 +264,15 @@ class XGenotyper():
             # anchor_map_pos=algnmt.reference_start##original mapping position
             map_pos = algnmt.reference_start
             mate_chrm = '*'
+            mate_tid = -1
             mate_pos = 0
             b_clip_part_rc = False
             if algnmt.is_reverse == True:  # is reverse complementary
                 b_clip_part_rc = True
 ####
-            if (algnmt.next_reference_id in m_chrm_id) and (algnmt.mate_is_unmapped == False)\
-                    and (algnmt.next_reference_id >= 0):
-                mate_chrm = algnmt.next_reference_name
+            if xregistry.is_valid_tid(algnmt.next_reference_id) == True and (algnmt.mate_is_unmapped == False):
+                mate_tid = algnmt.next_reference_id
+                mate_chrm = xregistry.get_name(mate_tid)
                 mate_pos = algnmt.next_reference_start
 
             b_fully_mapped = False
@@ -296,8 +360,7 @@ class XGenotyper():
 
             if mate_chrm == "*":  ##unmapped reads are not interested!
                 continue
-            xchrom = XChromosome()  ###decoy seuqence and contigs are not interested
-            if xchrom.is_decoy_contig_chrms(mate_chrm) == True:
+            if xregistry.is_decoy_tid(mate_tid) == True:  ###decoy seuqence and contigs are not interested
                 continue
 ####
             m_mate_chrms[mate_chrm]=1
@@ -335,14 +398,110 @@ class XGenotyper():
 
         n_disc_chrms=len(m_mate_chrms)
 
-        sinfo="{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t".format(chrm, ins_pos, n_af_clip, n_full_map, n_l_raw_clip, n_r_raw_clip)
-        sinfo1="{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n".format(n_disc_pairs, n_concd_pairs, n_disc_large_indel,
-                                                       s_clip_lens, n_polyA, n_disc_chrms)
-        f_gntp_fetures.write(sinfo+sinfo1)
+        return (n_af_clip, n_full_map, n_l_raw_clip, n_r_raw_clip, n_disc_pairs, n_concd_pairs, n_disc_large_indel,
+                s_clip_lens, n_polyA, n_disc_chrms)
+####
+    ####Same features as "collect_features_one_site", but collected from the evidence store saved by the clip step
+    ####return: (n_af_clip, n_full_map, n_l_raw_clip, n_r_raw_clip, n_disc_pairs, n_concd_pairs, n_disc_large_indel,
+    ####s_clip_lens, n_polyA, n_disc_chrms)
+    def _collect_features_from_evidence(self, xstore, chrm_in_bam, xregistry, ins_pos, start_pos, end_pos):
+        n_disc_pairs = 0
+        n_concd_pairs = 0
+        n_l_raw_clip = 0
+        n_r_raw_clip = 0
+        n_l_af_clip = 0
+        n_r_af_clip = 0
+        n_full_map = 0
+        n_l_full_map = 0
+        n_r_full_map = 0
+        l_lclip_lens = []
+        l_rclip_lens = []
+        n_disc_large_indel = 0
+        n_polyA = 0
+        m_mate_chrms = {}
+        l_check_concord = []
+        m_clip_qname = {}
+        for rcd in xstore.fetch(chrm_in_bam, start_pos, end_pos).tolist():
+            (map_pos, i_end, i_map_end, i_flag, i_mapq, mate_tid, i_mate_pos, lclip_type, lclip_len, rclip_type,
+             rclip_len, rclip_pos, full_map_len, b_large_indel, b_lpolyA, b_rpolyA, query_name) = rcd
+            b_supp_or_second = (i_flag & (FLAG_SUPPLEMENTARY | FLAG_SECONDARY)) != 0
+            mate_chrm = '*'
+            mate_pos = 0
+            if xregistry.is_valid_tid(mate_tid) == True and (i_flag & FLAG_MATE_UNMAPPED) == 0:
+                mate_chrm = xregistry.get_name(mate_tid)
+                mate_pos = i_mate_pos
+
+            if full_map_len > 0:##fully mapped
+                i_map_start = map_pos
+                i_map_end = i_map_start + full_map_len
+                if ins_pos >= i_map_start and ins_pos <= i_map_end:
+                    n_full_map += 1
+                    if abs(i_map_start - ins_pos) < global_values.BWA_HALF_READ_MIN_SCORE:
+                        n_r_full_map += 1
+                    elif abs(i_map_end - ins_pos) < global_values.BWA_HALF_READ_MIN_SCORE:
+                        n_l_full_map += 1
+
+            b_polya = False
+            if lclip_type == 4:  # left clipped
+                if b_supp_or_second == True:
+                    continue
+                if abs(map_pos - ins_pos) < global_values.TSD_CUTOFF:
+                    n_l_raw_clip += 1
+                    m_clip_qname[query_name] = 1
+                if abs(map_pos - ins_pos) < global_values.CK_POLYA_CLIP_WIN:
+                    b_polya = b_lpolyA
+                if abs(map_pos - ins_pos) < global_values.CLIP_EXACT_CLIP_SLACK:
+                    n_l_af_clip += 1
+                    l_lclip_lens.append(str(lclip_len))
+
+            if rclip_type == 4:  # right clipped
+                map_pos = rclip_pos
+                if b_supp_or_second == True:
+                    continue
+                if abs(map_pos - ins_pos) < global_values.TSD_CUTOFF:
+                    n_r_raw_clip += 1
+                    m_clip_qname[query_name] = 1
+                if abs(map_pos - ins_pos) < global_values.CK_POLYA_CLIP_WIN:
+                    b_polya = b_rpolyA
+                if abs(map_pos - ins_pos) < global_values.CLIP_EXACT_CLIP_SLACK:
+                    n_r_af_clip += 1
+                    l_rclip_lens.append(str(rclip_len))
+
+            if b_polya == True:
+                n_polyA += 1
+
+            if mate_chrm == "*":  ##unmapped reads are not interested!
+                continue
+            if xregistry.is_decoy_tid(mate_tid) == True:
+                continue
+            m_mate_chrms[mate_chrm] = 1
+            if self.is_discordant(chrm_in_bam, map_pos, mate_chrm, mate_pos, global_values.DISC_THRESHOLD) == True:
+                if b_large_indel == True:
+                    n_disc_large_indel += 1
+                if abs(map_pos - ins_pos) <= global_values.DFT_IS:
+                    n_disc_pairs += 1
+            else:
+                l_check_concord.append((query_name, chrm_in_bam, map_pos, mate_chrm, mate_pos))
+
+        for rcd_tmp in l_check_concord:
+            if rcd_tmp[0] in m_clip_qname:
+                continue
+            if self.is_concrdant(rcd_tmp[1], rcd_tmp[2], rcd_tmp[3], rcd_tmp[4], ins_pos, global_values.DFT_IS) == True:
+                n_concd_pairs += 1
+
+        n_af_clip = n_l_af_clip
+        n_full_map = n_full_map - n_l_full_map
+        s_clip_lens = ":".join(l_lclip_lens)
+        if n_l_af_clip < n_r_af_clip:
+            n_af_clip = n_r_af_clip
+            n_full_map = n_full_map - n_r_full_map
+            s_clip_lens = ":".join(l_rclip_lens)
+        if len(s_clip_lens) <= 0:
+            s_clip_lens = "none"
+        n_disc_chrms = len(m_mate_chrms)
+        return (n_af_clip, n_full_map, n_l_raw_clip, n_r_raw_clip, n_disc_pairs, n_concd_pairs, n_disc_large_indel,
+                s_clip_lens, n_polyA, n_disc_chrms)
 
-        f_gntp_fetures.close()
-        samfile.close()
-#
 ####
     def _get_chrm_id_name(self, samfile):
         m_chrm = {}
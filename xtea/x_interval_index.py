@@ -0,0 +1,92 @@
+##10/18/2026
+####Static interval index backed by sorted numpy arrays, used in place of the interval tree for the hot queries.
+####Intervals are half-open [start, end), same as "IntervalTree.addi(start, end)".
+####For each chromosome, the intervals are sorted by start, and for each interval we keep the index of the interval
+####with the largest end among all the ones start before it (running max-end). Then a position "pos" is covered
+####if and only if the running max-end of the last interval starting at or before "pos" is larger than "pos".
+
+import numpy as np
+
+class XIntervalIndex():
+    def __init__(self):
+        self.m_raw = {}  # intervals added but not built yet, in format: {chrm: [(start, end)]}
+        self.m_index = {}  # in format: {chrm: (a_start, a_end, a_pmax)}
+
+    def addi(self, chrm, start, end):
+        if chrm not in self.m_raw:
+            self.m_raw[chrm] = []
+        self.m_raw[chrm].append((start, end))
+
+    ####sort the added intervals, should be called after all the intervals are added
+    def build(self):
+        for chrm in self.m_raw:
+            l_intervals = self.m_raw[chrm]
+            if chrm in self.m_index:  # built before, merge with the old ones
+                a_start, a_end, a_pmax = self.m_index[chrm]
+                l_intervals = l_intervals + list(zip(a_start.tolist(), a_end.tolist()))
+            a_intervals = np.array(sorted(set(l_intervals)), dtype=np.int64).reshape(-1, 2)
+            a_start = np.ascontiguousarray(a_intervals[:, 0])
+            a_end = np.ascontiguousarray(a_intervals[:, 1])
+            self.m_index[chrm] = (a_start, a_end, self._calc_running_max_index(a_end))
+        self.m_raw = {}
+
+    ####for each interval, the index of the one with the largest end among itself and all the ones before it
+    def _calc_running_max_index(self, a_end):
+        n_intervals = len(a_end)
+        if n_intervals == 0:
+            return np.zeros(0, dtype=np.int64)
+        a_max_end = np.maximum.accumulate(a_end)
+        a_is_new_max = np.ones(n_intervals, dtype=bool)
+        a_is_new_max[1:] = a_max_end[1:] > a_max_end[:-1]
+        a_idx = np.where(a_is_new_max, np.arange(n_intervals), 0)
+        return np.maximum.accumulate(a_idx)
+
+    def has_chrm(self, chrm):
+        return chrm in self.m_index
+
+    ####return (True, start of one covering interval) or (False, -1)
+    def query_point(self, chrm, pos):
+        if chrm not in self.m_index:
+            return False, -1
+        a_start, a_end, a_pmax = self.m_index[chrm]
+        idx = int(np.searchsorted(a_start, pos, side="right")) - 1
+        if idx < 0:
+            return False, -1
+        i_pmax = a_pmax[idx]
+        if a_end[i_pmax] > pos:
+            return True, int(a_start[i_pmax])
+        return False, -1
+
+    ####return the start positions of all the intervals covering "pos" (in ascending order)
+    def query_all(self, chrm, pos):
+        l_hits = []
+        if chrm not in self.m_index:
+            return l_hits
+        a_start, a_end, a_pmax = self.m_index[chrm]
+        idx = int(np.searchsorted(a_start, pos, side="right")) - 1
+        #walk back until none of the remaining intervals reaches "pos"
+        while idx >= 0 and a_end[a_pmax[idx]] > pos:
+            if a_end[idx] > pos:
+                l_hits.append(int(a_start[idx]))
+            idx -= 1
+        l_hits.reverse()
+        return l_hits
+
+    ####batch version of "query_point" for an array of positions on the same chromosome
+    ####return two arrays: whether each position is covered, and the start of one covering interval (-1 if not)
+    def query_points(self, chrm, a_pos):
+        a_pos = np.asarray(a_pos, dtype=np.int64)
+        a_hit = np.zeros(len(a_pos), dtype=bool)
+        a_hit_start = np.full(len(a_pos), -1, dtype=np.int64)
+        if chrm not in self.m_index or len(a_pos) == 0:
+            return a_hit, a_hit_start
+        a_start, a_end, a_pmax = self.m_index[chrm]
+        if len(a_start) == 0:
+            return a_hit, a_hit_start
+        a_idx = np.searchsorted(a_start, a_pos, side="right") - 1
+        a_valid = a_idx >= 0
+        a_pmax_idx = a_pmax[np.maximum(a_idx, 0)]
+        a_hit = a_valid & (a_end[a_pmax_idx] > a_pos)
+        a_hit_start[a_hit] = a_start[a_pmax_idx[a_hit]]
+        return a_hit, a_hit_start
+####
@@ -0,0 +1,178 @@
+##10/18/2026
+####k-mer prefilter of the clipped parts before they are realigned to the repeat consensus (first stage of
+####"BWAlign.two_stage_realign").
+####"bwa mem" only extends the alignments from exact matches (seeds) of at least "-k" bases, so a part sharing no k-mer
+####(on either strand) with the consensus, with k the "-k" of the realignment, can't be aligned to it and is output as
+####unmapped. Such parts are sent to bwa as a one base placeholder, and the unmapped record is restored with the original
+####sequence (see XStreamAligner), so the output is the same as without the prefilter, and the read order (used by bwa
+####to break the ties of equally good hits) is kept. A larger k would drop parts aligned from a shorter seed.
+####The copies (second stage) are not screened, as their k-mers cover almost all the possible 9-mers.
+####"bwa index" replaces the ambiguous bases (e.g. "N") of the reference by random ones, so the reference windows with a
+####few ambiguous bases are expanded to all the possible k-mers, and with more, the reference can't be screened.
+
+import os
+import re
+import itertools
+import numpy as np
+import pysam
+import global_values
+
+#2-bit code of the bases, all the others (e.g. "N") are coded as 4, and break the k-mers
+BASE_CODE = np.full(256, 4, dtype=np.uint8)
+for i_code, s_base in enumerate("ACGT"):
+    BASE_CODE[ord(s_base)] = i_code
+    BASE_CODE[ord(s_base.lower())] = i_code
+
+####canonical k-mers (min of forward and reverse complementary ones) of all the sequences
+####return two arrays: the k-mers, and the index of the sequence each k-mer comes from
+def get_canonical_kmers(l_seqs, k):
+    a_len = np.array([len(s_seq) for s_seq in l_seqs], dtype=np.int64)
+    n_bases = int(a_len.sum())
+    if n_bases < k:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    a_codes = BASE_CODE[np.frombuffer("".join(l_seqs).encode(), dtype=np.uint8)]
+    n_win = n_bases - k + 1
+    #windows with invalid bases
+    a_invalid_cum = np.concatenate(([0], np.cumsum(a_codes == 4)))
+    a_valid = (a_invalid_cum[k:] - a_invalid_cum[:-k]) == 0
+    #windows crossing two sequences
+    a_seq_idx = np.repeat(np.arange(len(l_seqs), dtype=np.int64), a_len)
+    a_valid &= (a_seq_idx[:n_win] == a_seq_idx[k - 1:])
+
+    a_base = np.minimum(a_codes, 3).astype(np.uint64)
+    a_fwd = np.zeros(n_win, dtype=np.uint64)
+    a_rc = np.zeros(n_win, dtype=np.uint64)
+    for j in range(k):
+        a_seg = a_base[j:j + n_win]
+        a_fwd = (a_fwd << np.uint64(2)) | a_seg
+        a_rc |= (np.uint64(3) - a_seg) << np.uint64(2 * j)
+    a_kmers = np.minimum(a_fwd, a_rc)
+    return a_kmers[a_valid], a_seq_idx[:n_win][a_valid]
+####
+
+####k-mers of the windows with 1 to "max_ambiguous" ambiguous bases, with each ambiguous base replaced by each of ACGT
+####return None if a window has more ambiguous bases
+def get_ambiguous_window_kmers(l_seqs, k, max_ambiguous):
+    re_ambiguous = re.compile(r"[^ACGTacgt]")
+    l_variants = []
+    for s_seq in l_seqs:
+        s_starts = set()
+        for m_base in re_ambiguous.finditer(s_seq):
+            i_pos = m_base.start()
+            s_starts.update(range(max(0, i_pos - k + 1), min(i_pos, len(s_seq) - k) + 1))
+        for i_start in sorted(s_starts):
+            l_bases = list(s_seq[i_start:i_start + k])
+            l_ambiguous = [i for i, s_base in enumerate(l_bases) if BASE_CODE[ord(s_base)] == 4]
+            if len(l_ambiguous) > max_ambiguous:
+                return None
+            for t_bases in itertools.product("ACGT", repeat=len(l_ambiguous)):
+                for i, s_base in zip(l_ambiguous, t_bases):
+                    l_bases[i] = s_base
+                l_variants.append("".join(l_bases))
+    return get_canonical_kmers(l_variants, k)[0]
+####
+
+class XKmerPrefilter():
+    def __init__(self, k):
+        self.k = k
+        self.a_kmers = np.zeros(0, dtype=np.uint64)
+        self.n_screened = 0
+        self.n_kept = 0
+
+    ####collect the k-mers of the sequences in the fasta files, and save as a sorted array
+    ####the saved one is reused if it is newer than all the fasta files
+    ####return None if the sequences have windows with too many ambiguous bases
+    def compile(self, working_folder, l_sf_fa):
+        if len(working_folder) > 0 and working_folder[-1] != "/":
+            working_folder += "/"
+        s_name = "_".join([os.path.basename(sf_fa) for sf_fa in l_sf_fa])
+        sf_index = working_folder + "{0}.k{1}{2}".format(s_name, self.k, global_values.REALIGN_PREFILTER_SUFFIX)
+        if os.path.isfile(sf_index) == True:
+            f_index_time = os.path.getmtime(sf_index)
+            b_updated = True
+            for sf_fa in l_sf_fa:
+                if os.path.getmtime(sf_fa) > f_index_time:
+                    b_updated = False
+            if b_updated == True:
+                return sf_index
+
+        l_kmers = []
+        l_seqs = []
+        n_batch_bases = 0
+        for sf_fa in l_sf_fa:
+            with pysam.FastxFile(sf_fa) as fin_fa:
+                for entry in fin_fa:
+                    l_seqs.append(entry.sequence)
+                    n_batch_bases += len(entry.sequence)
+                    if n_batch_bases >= global_values.REALIGN_PREFILTER_BATCH_BASES:
+                        if self._collect_kmers(l_seqs, l_kmers) == False:
+                            return None
+                        l_seqs = []
+                        n_batch_bases = 0
+        if len(l_seqs) > 0:
+            if self._collect_kmers(l_seqs, l_kmers) == False:
+                return None
+        a_kmers = np.zeros(0, dtype=np.uint64)
+        if len(l_kmers) > 0:
+            a_kmers = np.unique(np.concatenate(l_kmers))
+        with open(sf_index, "wb") as fout_index:
+            np.save(fout_index, a_kmers)
+        return sf_index
+
+    def _collect_kmers(self, l_seqs, l_kmers):
+        a_ambiguous = get_ambiguous_window_kmers(l_seqs, self.k, global_values.REALIGN_PREFILTER_MAX_AMBIGUOUS)
+        if a_ambiguous is None:
+            return False
+        l_kmers.append(np.unique(get_canonical_kmers(l_seqs, self.k)[0]))
+        l_kmers.append(np.unique(a_ambiguous))
+        return True
+
+    def load(self, sf_index):
+        self.a_kmers = np.load(sf_index)
+
+    ####return whether each sequence shares a k-mer with the reference, the others can't be aligned
+    def screen(self, l_seqs):
+        a_keep = np.zeros(len(l_seqs), dtype=bool)
+        a_kmers, a_seq_idx = get_canonical_kmers(l_seqs, self.k)
+        if len(a_kmers) > 0 and len(self.a_kmers) > 0:
+            a_idx = np.searchsorted(self.a_kmers, a_kmers)
+            a_idx[a_idx >= len(self.a_kmers)] = 0
+            a_hit = self.a_kmers[a_idx] == a_kmers
+            a_keep[a_seq_idx[a_hit]] = True
+        self.n_screened += len(l_seqs)
+        self.n_kept += int(a_keep.sum())
+        return a_keep
+
+    def get_stats(self):
+        return self.n_screened, self.n_kept
+####
+
+####yield the fastq records in batches of "n_batch", each record is a list of the 4 lines
+def iter_fastq_batches(fin_fq, n_batch):
+    l_records = []
+    while True:
+        l_lines = [fin_fq.readline() for i in range(4)]
+        if len(l_lines[0]) == 0:
+            break
+        l_records.append(l_lines)
+        if len(l_records) >= n_batch:
+            yield l_records
+            l_records = []
+    if len(l_records) > 0:
+        yield l_records
+####
+
+####return the loaded prefilter with the k-mers of the given fasta files, or None if the prefilter is disabled or the
+####fasta files can't be screened, "k" is the seed length ("-k") of the realignment
+def get_realign_prefilter(working_folder, l_sf_fa, k):
+    if global_values.REALIGN_PREFILTER == False:
+        return None
+    xprefilter = XKmerPrefilter(k)
+    sf_index = xprefilter.compile(working_folder, l_sf_fa)
+    if sf_index is None:
+        print("Warning: {0} have windows with more than {1} ambiguous bases, the k-mer prefilter is not used for "
+              "them!".format(", ".join(l_sf_fa), global_values.REALIGN_PREFILTER_MAX_AMBIGUOUS))
+        return None
+    xprefilter.load(sf_index)
+    return xprefilter
+####
@@ -8,6 +8,7 @@ from x_polyA import *
 from x_black_list import *
 from x_post_filter import XTEARsltParser
 import global_values
+from x_bam_handle_cache import init_bam_handle_cache, get_bam_handle_and_registry
 
 
 def unwrap_parse_td_sibling_from_bam(arg, **kwarg):
@@ -1179,7 +1180,7 @@ class XOrphanTransduction(XTransduction):
                         s_src=xtea_psr.get_transduction_source(fields)
                         l_chrm_records.append((chrm, pos, sf_bam, n_clip_cutoff, n_disc_cutoff, s_src))
 
-                pool = Pool(self.n_jobs)
+                pool = Pool(self.n_jobs, initializer=init_bam_handle_cache)
                 rslts = pool.map(unwrap_check_features_for_one_site,
                                  list(zip([self] * len(l_chrm_records), l_chrm_records)), 1)
                 pool.close()
@@ -1252,12 +1253,10 @@ class XOrphanTransduction(XTransduction):
             if abs(region_end)==1:
                 region_end=region_start+100
 
-        bam_info = BamInfo(sf_bam, self.sf_reference)
-        b_with_chr = bam_info.is_chrm_contain_chr()
+        samfile, xregistry = get_bam_handle_and_registry(sf_bam, self.sf_reference)
+        b_with_chr = xregistry.is_chrm_contain_chr()
         chrm_in_bam = self._process_chrm_name(b_with_chr, chrm)
 
-        samfile = pysam.AlignmentFile(sf_bam, "rb", reference_filename=self.sf_reference)
-        m_chrm_id = self._get_chrm_id_name(samfile)
         start_pos=pos-global_values.MAX_NORMAL_INSERT_SIZE
         end_pos=pos+global_values.MAX_NORMAL_INSERT_SIZE
         xchrm = XChromosome()
@@ -1363,9 +1362,8 @@ class XOrphanTransduction(XTransduction):
                             n_rpolyT += 1
                     l_rclip_pos.append(clip_pos)
                     ####
-            if (algnmt.next_reference_id in m_chrm_id) and (algnmt.mate_is_unmapped == False) \
-                    and (algnmt.next_reference_id >= 0):
-                mate_chrm = algnmt.next_reference_name
+            if xregistry.is_valid_tid(algnmt.next_reference_id) == True and (algnmt.mate_is_unmapped == False):
+                mate_chrm = xregistry.get_name(algnmt.next_reference_id)
                 # skip the decoy sequence and contigs
                 if xchrm.is_decoy_contig_chrms(mate_chrm) == True:
                     continue
@@ -1406,7 +1404,6 @@ class XOrphanTransduction(XTransduction):
         #2) enough polyA/T reads
         if n_lpolyA > n_clip_cutoff/2 or n_rpolyT > n_clip_cutoff/2:
             return (chrm, pos, False)
-        samfile.close()
         return (chrm, pos, True)
 ####
 ####
@@ -0,0 +1,185 @@
+##10/18/2026
+####Persistent cache of the realignments of the clipped parts (and discordant reads), keyed by the read sequence.
+####bwa mem aligns each single-end read independently and ignores base qualities, so the records of a sequence only
+####depend on the bwa binary (path and version), the reference index and the bwa parameters. One sqlite database is kept
+####for each (bwa, reference index, parameters) combination in the cache folder, mapping the sha1 of the sequence to its SAM records (with the read name and
+####base qualities removed). When the same sequences are realigned again (other bams of the sample, or reruns with
+####different cutoffs), only the missed ones are sent to bwa, and the cached records are restored with the read name.
+####Note: for reads with several equally good hits, bwa picks one randomly (seeded by the read order), so a cached
+####record may report another one of the equal hits than a fresh run.
+
+import os
+import re
+import hashlib
+import sqlite3
+import shutil
+import threading
+import subprocess
+import global_values
+
+QUAL_PLACEHOLDER = "Q"  # the stored records have this in the QUAL field if the qualities were output by bwa
+#id of the bwa binaries checked by this process, in format: {sf_bwa: id}
+M_BWA_ID = {}
+
+####the bwa binary is identified by its real path and the version printed in its usage (run once for each process)
+def get_bwa_id(sf_bwa):
+    if sf_bwa in M_BWA_ID:
+        return M_BWA_ID[sf_bwa]
+    sf_bwa_path = shutil.which(sf_bwa)
+    if sf_bwa_path is None:
+        sf_bwa_path = sf_bwa
+    s_version = "unknown"
+    try:
+        #"bwa" without arguments prints the usage (with the version) to stderr and exits with 1
+        p_bwa = subprocess.run([sf_bwa_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               universal_newlines=True)
+        m_version = re.search(r"Version:\s*(\S+)", p_bwa.stdout + p_bwa.stderr)
+        if m_version is not None:
+            s_version = m_version.group(1)
+    except OSError:
+        pass
+    s_id = "{0}|{1}".format(os.path.realpath(sf_bwa_path), s_version)
+    M_BWA_ID[sf_bwa] = s_id
+    return s_id
+
+####return the sam record without read name and base qualities, to be saved in the cache
+def strip_record(line):
+    fields = line.rstrip("\n").split("\t")
+    if fields[10] != "*":
+        fields[10] = QUAL_PLACEHOLDER
+    return "\t".join(fields[1:])
+
+####restore the sam record of a read from the cached one
+####"s_qual" is the base qualities of the read (as in the fastq), or None for fasta reads
+def restore_record(s_qname, s_qual, s_record, re_hclip):
+    fields = s_record.split("\t")
+    if fields[9] == QUAL_PLACEHOLDER:
+        if s_qual is None:
+            fields[9] = "*"
+        else:
+            if int(fields[0]) & 0x10:
+                s_qual = s_qual[::-1]
+            #hard clipped bases (e.g. supplementary alignments) are not included
+            m_hclip = re_hclip.match(fields[4])
+            i_left = 0
+            i_right = len(s_qual)
+            if m_hclip is not None:
+                if m_hclip.group(1) is not None:
+                    i_left = int(m_hclip.group(1))
+                if m_hclip.group(2) is not None:
+                    i_right -= int(m_hclip.group(2))
+            fields[9] = s_qual[i_left:i_right]
+    return s_qname + "\t" + "\t".join(fields) + "\n"
+
+class XRealignCache():
+    def __init__(self, sf_folder, sf_ref, s_params, sf_bwa=None):
+        if len(sf_folder) > 0 and sf_folder[-1] != "/":
+            sf_folder += "/"
+        if os.path.exists(sf_folder) == False:
+            os.makedirs(sf_folder, exist_ok=True)
+        if sf_bwa is None:
+            sf_bwa = global_values.BWA_PATH
+        s_id = get_bwa_id(sf_bwa) + "|" + self._get_ref_index_id(sf_ref) + "|" + s_params
+        sf_db = sf_folder + "{0}.{1}{2}".format(os.path.basename(sf_ref), hashlib.sha1(s_id.encode()).hexdigest()[:16],
+                                                global_values.REALIGN_CACHE_SUFFIX)
+        self.conn = sqlite3.connect(sf_db, timeout=600, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS algnmt (seq_hash BLOB PRIMARY KEY, records TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS header (id INTEGER PRIMARY KEY, lines TEXT)")
+        self.conn.commit()
+        self.lock = threading.Lock()  # the streamed aligner saves the records in its reader thread
+        self.l_pending = []
+        self.re_hclip = re.compile(r"^(?:(\d+)H)?.*?(?:(\d+)H)?$")
+        self.n_hits = 0
+        self.n_misses = 0
+
+    ####the reference index is identified by its path, and the size and modification time of the ".bwt" file
+    def _get_ref_index_id(self, sf_ref):
+        sf_bwt = sf_ref + ".bwt"
+        s_id = os.path.realpath(sf_ref)
+        if os.path.isfile(sf_bwt) == True:
+            s_id += "|{0}|{1}".format(os.path.getsize(sf_bwt), os.path.getmtime(sf_bwt))
+        return s_id
+
+    def _hash_seq(self, s_seq):
+        return hashlib.sha1(s_seq.encode()).digest()
+
+    ####return the cached records of the sequences, in format: {seq: [record]}
+    def lookup(self, l_seqs):
+        m_seq_hash = {}
+        for s_seq in l_seqs:
+            m_seq_hash[self._hash_seq(s_seq)] = s_seq
+        l_hash = list(m_seq_hash.keys())
+        m_hits = {}
+        with self.lock:
+            for i_start in range(0, len(l_hash), global_values.REALIGN_CACHE_QUERY_SIZE):
+                l_sub = l_hash[i_start:i_start + global_values.REALIGN_CACHE_QUERY_SIZE]
+                s_query = "SELECT seq_hash, records FROM algnmt WHERE seq_hash IN ({0})".format(",".join(["?"] * len(l_sub)))
+                for (seq_hash, s_records) in self.conn.execute(s_query, l_sub):
+                    m_hits[m_seq_hash[bytes(seq_hash)]] = s_records.split("\n")
+        return m_hits
+
+    ####restore the sam records of one read from the cached ones
+    def restore(self, s_qname, s_qual, l_records):
+        return "".join([restore_record(s_qname, s_qual, s_record, self.re_hclip) for s_record in l_records])
+
+    ####save the sam records (of one read) output by bwa
+    def add(self, s_seq, l_lines):
+        s_records = "\n".join([strip_record(line) for line in l_lines])
+        with self.lock:
+            self.l_pending.append((self._hash_seq(s_seq), s_records))
+            if len(self.l_pending) >= global_values.REALIGN_CACHE_QUERY_SIZE:
+                self._flush()
+
+    def _flush(self):
+        if len(self.l_pending) > 0:
+            self.conn.executemany("INSERT OR REPLACE INTO algnmt VALUES (?, ?)", self.l_pending)
+            self.conn.commit()
+            self.l_pending = []
+
+    ####the sam header of the reference (used when all the reads are cached)
+    def set_header(self, l_lines):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO header VALUES (0, ?)", ("".join(l_lines),))
+            self.conn.commit()
+
+    def get_header(self):
+        with self.lock:
+            for (s_lines,) in self.conn.execute("SELECT lines FROM header WHERE id=0"):
+                return s_lines
+        return ""
+
+    def count_hits(self, n_hits, n_misses):
+        self.n_hits += n_hits
+        self.n_misses += n_misses
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.conn.close()
+        print("Realignment cache: {0} reads are cached, {1} reads are aligned".format(self.n_hits, self.n_misses))
+####
+
+####read name as output by bwa ("/1" or "/2" at the end is trimmed)
+def get_sam_qname(s_name):
+    if len(s_name) > 2 and (s_name[-2:] == "/1" or s_name[-2:] == "/2"):
+        return s_name[:-2]
+    return s_name
+
+####collect the sam records of each read from a sam file output by bwa (records of one read are consecutive)
+####yield (read name, [records]), and the header lines are appended to "l_header"
+def iter_sam_read_records(fin_sam, l_header):
+    s_qname = None
+    l_lines = []
+    for line in fin_sam:
+        if line[0] == "@":
+            l_header.append(line)
+            continue
+        s_cur_qname = line[:line.find("\t")]
+        if s_cur_qname != s_qname and len(l_lines) > 0:
+            yield s_qname, l_lines
+            l_lines = []
+        s_qname = s_cur_qname
+        l_lines.append(line)
+    if len(l_lines) > 0:
+        yield s_qname, l_lines
+####
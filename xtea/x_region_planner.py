@@ -0,0 +1,108 @@
+##10/18/2026
+####Plan the regions fetched from the alignments.
+####Loci that are close to each other are coalesced into one fetch window, so every read is decoded only once.
+
+import bisect
+import global_values
+
+class XRegionPlanner():
+    def __init__(self, i_extnd=None, i_merge_gap=None):
+        self.i_extnd = i_extnd
+        if i_extnd is None:
+            self.i_extnd = global_values.NEARBY_REGION
+        self.i_merge_gap = i_merge_gap
+        if i_merge_gap is None:
+            self.i_merge_gap = global_values.LOCUS_FETCH_MERGE_GAP
+
+    ####given one locus record, return the [start, end) window to check
+    ####record in format: (pos, family) or (start, end, family), as loaded by "load_locus_file"
+    def get_locus_window(self, rcd):
+        if len(rcd) >= 3:
+            start_pos = int(rcd[0])
+            end_pos = int(rcd[1])
+        else:
+            start_pos = int(rcd[0]) - self.i_extnd
+            end_pos = int(rcd[0]) + self.i_extnd + 1
+        if start_pos <= 0:
+            start_pos = 1
+        return (start_pos, end_pos)
+
+    ####Sort the windows of the loci, and merge the overlapped or nearby (within i_merge_gap) ones
+    ####Return a list in format: [(fetch_start, fetch_end, (l_sub_start, l_sub_end))]
+    ####(l_sub_start, l_sub_end) are the disjoint sub-windows (union of the original windows) within the fetch window,
+    ####which are used to skip the reads falling in the gap between two merged loci
+    def coalesce_locus_windows(self, l_locus):
+        l_windows = [self.get_locus_window(rcd) for rcd in l_locus]
+        return self.coalesce_windows(l_windows)
+
+    def coalesce_windows(self, l_windows):
+        l_fetch = []
+        if len(l_windows) == 0:
+            return l_fetch
+        l_windows = sorted(l_windows)
+        fetch_start, fetch_end = l_windows[0]
+        l_sub_start = [fetch_start]
+        l_sub_end = [fetch_end]
+        for (start_pos, end_pos) in l_windows[1:]:
+            if start_pos > fetch_end + self.i_merge_gap:  # far away, push out current window
+                l_fetch.append((fetch_start, fetch_end, (l_sub_start, l_sub_end)))
+                fetch_start, fetch_end = start_pos, end_pos
+                l_sub_start = [start_pos]
+                l_sub_end = [end_pos]
+                continue
+            if start_pos <= l_sub_end[-1]:  # overlap with the last sub-window
+                if end_pos > l_sub_end[-1]:
+                    l_sub_end[-1] = end_pos
+            else:
+                l_sub_start.append(start_pos)
+                l_sub_end.append(end_pos)
+            if end_pos > fetch_end:
+                fetch_end = end_pos
+        l_fetch.append((fetch_start, fetch_end, (l_sub_start, l_sub_end)))
+        return l_fetch
+
+    ####extend each [start, end) window on both sides
+    def extend_windows(self, l_windows, i_extnd):
+        l_extnd = []
+        for (start_pos, end_pos) in l_windows:
+            extd_start = start_pos - i_extnd
+            if extd_start <= 0:
+                extd_start = 1
+            l_extnd.append((extd_start, end_pos + i_extnd))
+        return l_extnd
+
+    ####split the sorted fetch windows into consecutive groups of about i_unit_size bp (at least one window per group)
+    ####so one chromosome can be scanned by several workers
+    def split_windows(self, l_fetch, i_unit_size):
+        l_groups = []
+        l_cur = []
+        i_cur_size = 0
+        for rcd in l_fetch:
+            if len(l_cur) > 0 and i_cur_size + (rcd[1] - rcd[0]) > i_unit_size:
+                l_groups.append(l_cur)
+                l_cur = []
+                i_cur_size = 0
+            l_cur.append(rcd)
+            i_cur_size += (rcd[1] - rcd[0])
+        if len(l_cur) > 0:
+            l_groups.append(l_cur)
+        return l_groups
+
+    ####collect the sub-windows of all the fetch windows into one sorted disjoint list: (l_sub_start, l_sub_end)
+    def flatten_sub_windows(self, l_fetch):
+        l_all_start = []
+        l_all_end = []
+        for (fetch_start, fetch_end, (l_sub_start, l_sub_end)) in l_fetch:
+            l_all_start.extend(l_sub_start)
+            l_all_end.extend(l_sub_end)
+        return l_all_start, l_all_end
+
+    ####check whether read [start, end) overlaps with any of the sub-windows
+    ####sub-windows are disjoint and sorted, so the last one starting before "end" is the only one to check
+    def is_overlap_sub_windows(self, start, end, sub_windows):
+        l_sub_start, l_sub_end = sub_windows
+        idx = bisect.bisect_left(l_sub_start, end) - 1
+        if idx < 0:
+            return False
+        return l_sub_end[idx] > start
+####
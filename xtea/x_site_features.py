@@ -0,0 +1,157 @@
+##10/18/2026
+####Fused per-site feature extractor of the genotyping stage.
+####For each (site, bam), the reads of the widest window needed by the left/right focal depth (ReadDepth), the clip,
+####disc and concordant features (XGenotyper) and the clip/disc allele frequency (XClipDisc) are fetched and decoded
+####once, and the three feature sets are computed from the same reads. Each feature only counts the reads overlapping
+####its own window, same as the separated versions, and the outputs are written in the same formats.
+
+from multiprocessing import Pool
+from x_coverage import ReadDepth
+from x_genotype_feature import XGenotyper
+from x_clip_disc_filter import XClipDisc
+from x_evidence_scanner import get_evidence_store
+from x_bam_handle_cache import init_bam_handle_cache, get_bam_handle_and_registry
+
+def unwrap_self_collect_site_features(arg, **kwarg):
+    return XSiteFeatures.collect_features_one_site(*arg, **kwarg)
+
+class XSiteFeatures():
+    def __init__(self, sf_ref, working_folder, n_jobs):
+        self.sf_reference = sf_ref
+        self.working_folder = working_folder
+        if len(self.working_folder) > 0 and self.working_folder[-1] != "/":
+            self.working_folder += "/"
+        self.n_jobs = n_jobs
+        self.rd = ReadDepth(self.working_folder, n_jobs, sf_ref)
+        self.x_gntper = XGenotyper(sf_ref, self.working_folder, n_jobs)
+        self.xclip_disc = XClipDisc(None, self.working_folder, n_jobs, sf_ref)
+
+    ####the reads (fetched from a wider window) overlapping [start, end), same as "samfile.fetch(chrm, start, end)"
+    def _iter_overlap_reads(self, l_reads, start, end):
+        for algnmt in l_reads:
+            i_map_end = algnmt.reference_end
+            if i_map_end is None:
+                i_map_end = algnmt.reference_start + 1
+            if algnmt.reference_start < end and i_map_end > start:
+                yield algnmt
+
+    ####record: ((chrm, ins_pos), sf_bam, working_folder, (search_win, focal_win, focal_win2, gntp_extnd, af_extnd,
+    ####clip_extnd)), the AF is skipped if af_extnd is None
+    ####return: (chrm, ins_pos, (lcov, rcov, lcov2, rcov2), genotype features, AF counts or None)
+    def collect_features_one_site(self, record):
+        chrm = record[0][0]  ##this is the chrm style in candidate list
+        ins_pos = record[0][1]
+        sf_bam = record[1]
+        working_folder = record[2]
+        search_win, focal_win, focal_win2, gntp_extnd, af_extnd, clip_extnd = record[3]
+
+        samfile, xregistry = get_bam_handle_and_registry(sf_bam, self.sf_reference)
+        chrm_in_bam = self.x_gntper._process_chrm_name(xregistry.is_chrm_contain_chr(), chrm)
+        xstore = get_evidence_store(working_folder, sf_bam)
+
+        #windows of each feature, same as "_calc_depth_one_site2", "collect_features_one_site" and "calc_AF_of_site"
+        l_fetch_windows = []
+        t_depth = None
+        depth_start = ins_pos - search_win
+        depth_end = ins_pos + search_win
+        if depth_start <= 0:
+            t_depth = (0, 0, 0, 0)
+        elif (xstore is not None) and xstore.is_covered(chrm_in_bam, depth_start, depth_end) == True:
+            a_reads = xstore.fetch(chrm_in_bam, depth_start, depth_end)
+            t_depth = tuple(self.rd._calc_depth_from_evidence(a_reads, ins_pos, [focal_win, focal_win2]))
+        else:
+            l_fetch_windows.append((depth_start, depth_end))
+
+        rcd_gntp = None
+        gntp_start = max(ins_pos - gntp_extnd, 1)
+        gntp_end = ins_pos + gntp_extnd
+        if (xstore is not None) and xstore.is_covered(chrm_in_bam, gntp_start, gntp_end) == True:
+            rcd_gntp = self.x_gntper._collect_features_from_evidence(xstore, chrm_in_bam, xregistry, ins_pos,
+                                                                     gntp_start, gntp_end)
+        else:
+            l_fetch_windows.append((gntp_start, gntp_end))
+
+        rcd_af = None
+        if af_extnd is not None:
+            af_start = max(ins_pos - af_extnd, 1)
+            af_end = ins_pos + af_extnd
+            l_fetch_windows.append((af_start, af_end))
+
+        #fetch and decode the reads of the widest window only once
+        l_reads = []
+        if len(l_fetch_windows) > 0:
+            l_reads = list(samfile.fetch(chrm_in_bam, min([rgn[0] for rgn in l_fetch_windows]),
+                                         max([rgn[1] for rgn in l_fetch_windows])))
+
+        if t_depth is None:
+            t_depth = tuple(self.rd._calc_depth_of_reads(self._iter_overlap_reads(l_reads, depth_start, depth_end),
+                                                         ins_pos, [focal_win, focal_win2]))
+        if rcd_gntp is None:
+            rcd_gntp = self.x_gntper._collect_features_from_reads(self._iter_overlap_reads(l_reads, gntp_start, gntp_end),
+                                                                  chrm_in_bam, xregistry, ins_pos)
+        if af_extnd is not None:
+            rcd_af = self.xclip_disc._cnt_AF_reads(self._iter_overlap_reads(l_reads, af_start, af_end), chrm_in_bam,
+                                                   xregistry, ins_pos, af_extnd, clip_extnd)
+        return (chrm, ins_pos, t_depth, rcd_gntp, rcd_af)
+
+    ####Collect the depth, genotype features and (optionally) AF of the candidate sites in all the bams.
+    ####Same outputs as "ReadDepth.calc_coverage_of_two_regions" (returned), "XGenotyper.call_genotype" (sf_gntp_out)
+    ####and "XClipDisc.calc_AF_by_clip_reads_of_given_list" (sf_af_out, only if af_extnd is not None)
+    def collect_features(self, sf_bam_list, sf_candidate_list, search_win, focal_win, focal_win2, gntp_extnd,
+                         sf_gntp_out, af_extnd=None, clip_extnd=None, af_cutoff=None, sf_af_out=None):
+        l_bams = []
+        with open(sf_bam_list) as fin_bam_list:
+            for line in fin_bam_list:
+                fields = line.split()
+                l_bams.append(fields[0])
+        l_sites = []
+        m_sites = {}
+        with open(sf_candidate_list) as fin_list:
+            for line in fin_list:
+                fields = line.split()
+                chrm = fields[0]
+                pos = int(fields[1])  # candidate insertion sites
+                if (chrm, pos) in m_sites:
+                    continue
+                m_sites[(chrm, pos)] = 1
+                l_sites.append((chrm, pos))
+
+        t_params = (search_win, focal_win, focal_win2, gntp_extnd, af_extnd, clip_extnd)
+        m_site_cov = {}  # in format: {ins_chrm: {ins_pos: [lfcov, rfcov, lfcov2, rfcov2]}}
+        m_af = {}  # in format: {ins_chrm: {ins_pos: [AF counts of each bam]}}
+        l_sf_features = []
+        for i_bam, sf_bam in enumerate(l_bams):
+            l_records = []
+            for (chrm, pos) in l_sites:
+                l_records.append(((chrm, pos), sf_bam, self.working_folder, t_params))
+            pool = Pool(self.n_jobs, initializer=init_bam_handle_cache)
+            l_site_features = pool.map(unwrap_self_collect_site_features, list(zip([self] * len(l_records), l_records)),
+                                       1)
+            pool.close()
+            pool.join()
+
+            sf_out_features = sf_gntp_out + "{0}.out".format(i_bam)
+            l_sf_features.append(sf_out_features)
+            with open(sf_out_features, "w") as fout_all:
+                for (ins_chrm, ins_pos, t_depth, rcd_gntp, rcd_af) in l_site_features:
+                    fout_all.write(self.x_gntper._format_site_features(ins_chrm, ins_pos, rcd_gntp))
+                    if ins_chrm not in m_site_cov:
+                        m_site_cov[ins_chrm] = {}
+                    if ins_pos not in m_site_cov[ins_chrm]:
+                        m_site_cov[ins_chrm][ins_pos] = [0, 0, 0, 0]
+                    for i_cov in range(4):
+                        m_site_cov[ins_chrm][ins_pos][i_cov] += t_depth[i_cov]
+                    if rcd_af is not None:
+                        if ins_chrm not in m_af:
+                            m_af[ins_chrm] = {}
+                        if ins_pos not in m_af[ins_chrm]:
+                            m_af[ins_chrm][ins_pos] = []
+                        m_af[ins_chrm][ins_pos].append(rcd_af)
+
+        self.x_gntper.merge_features_of_bams(l_sf_features, sf_gntp_out)
+        if af_extnd is not None:
+            with open(sf_af_out, "w") as fout_af:
+                for ins_chrm in m_af:
+                    self.xclip_disc._write_AF_of_sites(ins_chrm, m_af[ins_chrm], af_cutoff, fout_af)
+        return m_site_cov
+####
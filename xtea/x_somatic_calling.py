@@ -10,6 +10,7 @@ from x_clip_disc_filter import *
 from x_genotype_feature import *
 from x_transduction import *
 from x_orphan_transduction import *
+from x_site_features import XSiteFeatures
 
 ####
 class CaseControlMode():
@@ -56,22 +57,20 @@ class CaseControlMode():
 
     #extract genotype features and left/right region depths of given sites (this is for the control sample)
     def extract_sites_raw_gntp_feature_depth(self, sf_candidate_list, sf_bam_list):#
-        # get the depth information
+        # get the depth and the genotype information, with the reads of each site fetched only once
         rd = ReadDepth(self.s_wfolder, self.n_jobs, self.sf_ref)
         search_win = global_values.COV_SEARCH_WINDOW  # this region is to collect the reads, by default 1000
         focal_win = global_values.LOCAL_COV_WIN  # this region is used to search for coverage island, by default 900
         focal_win2 = global_values.COV_ISD_CHK_WIN  # this region is to calculate the local coverage, by default 200
-        m_sites=self.load_sites(sf_candidate_list)
-        m_read_depth = rd.calc_coverage_of_two_regions(m_sites, sf_bam_list, search_win,
-                                                       focal_win, focal_win2)
-        sf_depth=sf_candidate_list + ".read_depth"
-        rd.dump_coverage_info(m_read_depth, sf_depth)
-
-        # get the genotype information
         x_gntper = XGenotyper(self.sf_ref, self.s_wfolder, self.n_jobs)
         is_extnd = global_values.DFT_IS
         sf_gntp_feature = sf_candidate_list + ".gntp.features"
-        x_gntper.call_genotype(sf_bam_list, sf_candidate_list, is_extnd, sf_gntp_feature)
+        xsite_features = XSiteFeatures(self.sf_ref, self.s_wfolder, self.n_jobs)
+        m_read_depth = xsite_features.collect_features(sf_bam_list, sf_candidate_list, search_win, focal_win,
+                                                       focal_win2, is_extnd, sf_gntp_feature)
+        sf_depth=sf_candidate_list + ".read_depth"
+        rd.dump_coverage_info(m_read_depth, sf_depth)
+
         # load in features, also filter out sites with very large clipped reads at the breakpoints
         i_total_cov = global_values.AVE_COVERAGE
         i_max_cov = global_values.MAX_COV_TIMES * i_total_cov
@@ -192,6 +192,9 @@ class XTransduction():
         bwa_align = BWAlign(global_values.BWA_PATH, global_values.BWA_REALIGN_CUTOFF, self.n_jobs)
         cmd = "{0} index {1}".format(global_values.BWA_PATH, sf_flank_with_poly)
         self.cmd_runner.run_cmd_small_output(cmd)####
+        ####the clipped and discordant reads are aligned to the flanks several times
+        xbwa_session = XBwaIndexSession()
+        xbwa_session.preload([sf_flank_with_poly, sf_cns])
 
         # 2. re-collect the reads for the sites
         sf_clip_fq = self.working_folder + "raw_candidate_sites_all_clip.fq"
@@ -255,6 +258,7 @@ class XTransduction():
         ##3.3.1 re-align the selected disc reads to consensus
         sf_disc_algnmt_cns = self.working_folder + "temp_transduction_disc_cns.sam"
         bwa_align.realign_disc_reads(sf_cns, sf_disc_fa2, sf_disc_algnmt_cns)
+        xbwa_session.close()
         ##3.3.2 align the clipped reads to flanking regions
         # first only select those related clipped reads
         #sf_clip_fa2 = self.working_folder + "raw_candidate_sites_all_clip_focal_sites.fa"